@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
-import astropy, astroquery, sys
-import matplotlib.pyplot
-from matplotlib.patches import Circle
-from matplotlib.collections import PatchCollection
-from astroquery.gaia import Gaia
+import sys, os
 import gaiaClass
+import backends
+import stageMetrics
 
 import argparse
 
@@ -15,16 +13,29 @@ if __name__ == "__main__":
     parser.add_argument('adql', type=str, help='File containing ADQL query.')
     parser.add_argument('columns', type=str, help='A text file containing a list of column names.')
     
+    parser.add_argument('--output', type=str, default='gaiasample.csv', help='Output table; .csv, .fits, .parquet or .hdf5 (default=gaiasample.csv).')
     parser.add_argument('--version', action='store_true', help='Show Astropy and Astroquery versions.')
+    parser.add_argument('--fits', type=str, default='gaiasample', help='Prefix for the FITS results; chunks are saved as <prefix>_NNN.fits (default=gaiasample).')
+    parser.add_argument('--chunks', type=int, default=1, help='Split the query into this many jobs by random_index or source_id range; not for queries with TOP, DISTINCT, GROUP BY or ORDER BY (default=1).')
+    parser.add_argument('--split', type=str, default='random_index', help='Column used to split the query; may carry a table alias, e.g. g.random_index (default=random_index).')
+    parser.add_argument('--jobs', type=int, default=4, help='Maximum number of ADQL jobs running at once (default=4).')
+    parser.add_argument('--restart', action='store_true', help='Ignore the job ledger <prefix>.jobs.json instead of resuming the jobs it records.')
+    parser.add_argument('--index', action='store_true', help='Save a sky index next to the saved FITS table, used by local ADQL cone queries on it.')
+    parser.add_argument('--local', type=str, help='Run the query on a local FITS table or tile store instead of the GAIA archive; the result is saved as <prefix>.fits.')
+    backends.addBackendArguments(parser)
+    stageMetrics.addMetricsArguments(parser)
     arg = parser.parse_args()
+    stageMetrics.metricsFromArguments(arg)
+    tap = backends.backendFromArguments(arg).getTap()
 
     if arg.version:
+        import astropy, astroquery
         print("Astropy version: ", astropy.__version__)
         print("Astroquery version: ", astroquery.__version__)
         sys.exit()
 
     if arg.columns=='show':
-        job = Gaia.launch_job("SELECT TOP 10 * FROM gaiadr2.gaia_source")
+        job = tap.launch_job("SELECT TOP 10 * FROM gaiadr2.gaia_source")
         r = job.get_results()
         print(r.keys())
         sys.exit()
@@ -46,22 +57,50 @@ if __name__ == "__main__":
         text = line.strip()
         if len(text)==0: continue
         if text[0]=='#': continue
-        query = query + text
+        query = query + ' ' + text
 
     
     print("Executing query: " + query)
-    job = Gaia.launch_job_async(query)
-    results = job.get_results()
-
-    results.write("gaiasample.fits", format="fits")
+    if arg.local is not None:
+        import localADQL
+        results = localADQL.executeQuery(query, defaultSource = arg.local)
+        outputs = [arg.fits + '.fits']
+        with stageMetrics.stage('export', rows = len(results)):
+            results.write(outputs[0], format='fits', overwrite=True)
+        stageMetrics.countFile('export', outputs[0])
+        del results
+    else:
+        import adqlJobs
+        ledgerFilename = arg.fits + '.jobs.json'
+        if arg.restart and os.path.exists(ledgerFilename): os.remove(ledgerFilename)
+        manager = adqlJobs.adqlJobManager(ledgerFilename, tap = tap, maxActive = arg.jobs)
+        try:
+            manager.prepare(query, arg.fits, numChunks = arg.chunks, splitColumn = arg.split)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        outputs = manager.run()
 
+    from astropy.table import Table
     resultsTable = gaiaClass.gaiaTABLE()
     resultsTable.setColumns(columns)
-    for count, r in enumerate(results):
-        resultsTable.addItem(str(r['source_id']), results.keys(), r)
-        if (count % 100) == 0:
-            print(count)
+    for output in outputs:
+        with stageMetrics.stage('load') as counts:
+            results = Table.read(output, format='fits')
+            counts['rows'] = len(results)
+            counts['bytes'] = os.path.getsize(output)
+        if arg.index:
+            import skyIndex
+            index = skyIndex.skyIndex(results['ra'], results['dec'], source = output)
+            print("Sky index written to %s"%index.save())
+        chunkSize = 100000
+        with stageMetrics.stage('table', rows = len(results)):
+            for start in range(0, len(results), chunkSize):
+                chunk = results[start:start + chunkSize]
+                resultsTable.addRows([str(id) for id in chunk['source_id']], chunk)
+        print("%d rows read from %s"%(len(results), output))
+        del results
 
     print('%d items added to the table.'%resultsTable.getLength())
-    resultsTable.writeAsCSV('gaiasample.csv')
-    sys.exit()
\ No newline at end of file
+    resultsTable.write(arg.output)
+    sys.exit()
@@ -0,0 +1,143 @@
+import json, os, re, time
+import tableExport
+
+# Runs a large ADQL query on the Gaia archive as several asynchronous jobs,
+# each restricted to one slice of random_index (or source_id). Up to
+# 'maxActive' jobs run at once; finished results are streamed straight to disk
+# and the state of every slice is kept in a JSON ledger, so an interrupted run
+# picks up where it left off: finished slices are kept, running jobs are
+# polled again and failed ones are resubmitted.
+
+splitRanges = {'random_index': (0, 1692919134), 'source_id': (0, 6917528997577384320)}
+
+def addCondition(query, condition):
+    # ANDs 'condition' into the WHERE clause, which comes before any GROUP BY,
+    # HAVING or ORDER BY.
+    tail = ''
+    clause = re.search(r'\b(GROUP\s+BY|HAVING|ORDER\s+BY)\b', query, re.IGNORECASE)
+    if clause is not None:
+        query, tail = query[:clause.start()].rstrip(), ' ' + query[clause.start():]
+    where = re.search(r'\bWHERE\b', query, re.IGNORECASE)
+    if where is not None:
+        return query[:where.end()] + ' (' + condition + ') AND (' + query[where.end():].strip() + ')' + tail
+    return query.rstrip() + ' WHERE ' + condition + tail
+
+def unsplittableClauses(query):
+    # Clauses whose result over the whole table is not the chunks' results put
+    # together.
+    found = []
+    for name, pattern in [('TOP', r'\bSELECT\s+(?:ALL\s+|DISTINCT\s+)?TOP\b'), ('DISTINCT', r'\bSELECT\s+DISTINCT\b'), ('GROUP BY', r'\bGROUP\s+BY\b'), ('ORDER BY', r'\bORDER\s+BY\b')]:
+        if re.search(pattern, query, re.IGNORECASE): found.append(name)
+    return found
+
+def splitQuery(query, numChunks, column = 'random_index'):
+    # One query per slice of 'column', which may be qualified with a table alias.
+    if numChunks <= 1: return [query]
+    clauses = unsplittableClauses(query)
+    if len(clauses) > 0:
+        raise ValueError("A query with %s cannot be split into chunks; run it as one job"%' or '.join(clauses))
+    low, high = splitRanges[column.split('.')[-1]]
+    edges = [low + (high - low + 1) * i // numChunks for i in range(numChunks + 1)]
+    return [addCondition(query, "%s BETWEEN %d AND %d"%(column, edges[i], edges[i + 1] - 1)) for i in range(numChunks)]
+
+
+class adqlJobManager:
+    def __init__(self, ledgerFilename, tap = None, maxActive = 4, pollInterval = 5., retries = 2):
+        if tap is None:
+            from astroquery.gaia import Gaia
+            tap = Gaia
+        self.tap = tap
+        self.ledgerFilename = ledgerFilename
+        self.maxActive = maxActive
+        self.pollInterval = pollInterval
+        self.retries = retries
+        self.jobs = {}
+        self.ledger = None
+
+    def readLedger(self):
+        try:
+            with open(self.ledgerFilename, 'rt') as ledgerFile:
+                return json.load(ledgerFile)
+        except (OSError, ValueError):
+            return None
+
+    def writeLedger(self):
+        with tableExport.atomicOutput(self.ledgerFilename) as tempName:
+            with open(tempName, 'wt') as ledgerFile:
+                json.dump(self.ledger, ledgerFile, indent=1)
+
+    def prepare(self, query, outputPrefix, numChunks = 1, splitColumn = 'random_index'):
+        # Sets up the slices for a query, or resumes them from the ledger if it
+        # records the same query. Returns the list of output files.
+        ledger = self.readLedger()
+        if ledger is not None and ledger['query'] == query and ledger['numChunks'] == numChunks and ledger['splitColumn'] == splitColumn:
+            print("Resuming %d jobs from %s"%(len(ledger['chunks']), self.ledgerFilename))
+            self.ledger = ledger
+            return [chunk['output'] for chunk in self.ledger['chunks']]
+        if numChunks > 1:
+            outputs = ["%s_%03d.fits"%(outputPrefix, i) for i in range(numChunks)]
+        else:
+            outputs = [outputPrefix + ".fits"]
+        chunks = [{'query': q, 'output': o, 'jobid': None, 'state': 'new', 'attempts': 0} for q, o in zip(splitQuery(query, numChunks, splitColumn), outputs)]
+        self.ledger = {'query': query, 'numChunks': numChunks, 'splitColumn': splitColumn, 'chunks': chunks}
+        self.writeLedger()
+        return outputs
+
+    def submit(self, chunk):
+        job = self.tap.launch_job_async(chunk['query'], output_format='fits', background=True)
+        chunk['jobid'] = job.jobid
+        chunk['state'] = 'submitted'
+        chunk['attempts']+= 1
+        self.jobs[job.jobid] = job
+        print("Submitted job %s for %s"%(job.jobid, chunk['output']))
+
+    def getJob(self, chunk):
+        if chunk['jobid'] not in self.jobs:
+            self.jobs[chunk['jobid']] = self.tap.load_async_job(jobid=chunk['jobid'], load_results=False)
+        return self.jobs[chunk['jobid']]
+
+    def download(self, job, chunk):
+        with tableExport.atomicOutput(chunk['output']) as tempName:
+            job.outputFileUser = tempName
+            job.save_results()
+        chunk['state'] = 'done'
+        print("Job %s finished, results saved to %s"%(chunk['jobid'], chunk['output']))
+
+    def poll(self, chunk):
+        try:
+            job = self.getJob(chunk)
+            phase = job.get_phase(update=True).upper().strip()
+            chunk['pollFailures'] = 0
+        except Exception as e:
+            print("Could not reach job %s: %s"%(chunk['jobid'], e))
+            chunk['pollFailures'] = chunk.get('pollFailures', 0) + 1
+            if chunk['pollFailures'] < 5: return
+            phase = 'ERROR'
+        if phase == 'COMPLETED':
+            self.download(job, chunk)
+        elif phase in ('ERROR', 'ABORTED', 'UNKNOWN'):
+            self.jobs.pop(chunk['jobid'], None)
+            chunk['state'] = 'failed' if chunk['attempts'] > self.retries else 'new'
+            print("Job %s ended in phase %s%s"%(chunk['jobid'], phase, ", resubmitting" if chunk['state'] == 'new' else ""))
+
+    def run(self):
+        while True:
+            chunks = self.ledger['chunks']
+            for chunk in chunks:
+                if chunk['state'] == 'done' and not os.path.exists(chunk['output']):
+                    chunk['state'] = 'new'
+            active = [chunk for chunk in chunks if chunk['state'] == 'submitted']
+            for chunk in active:
+                self.poll(chunk)
+                self.writeLedger()
+            active = [chunk for chunk in chunks if chunk['state'] == 'submitted']
+            for chunk in [chunk for chunk in chunks if chunk['state'] == 'new'][:max(0, self.maxActive - len(active))]:
+                self.submit(chunk)
+                self.writeLedger()
+            remaining = [chunk for chunk in chunks if chunk['state'] in ('new', 'submitted')]
+            if len(remaining) == 0: break
+            time.sleep(self.pollInterval)
+        failed = [chunk['output'] for chunk in self.ledger['chunks'] if chunk['state'] == 'failed']
+        if len(failed) > 0:
+            raise RuntimeError("ADQL jobs failed for: %s"%', '.join(failed))
+        return [chunk['output'] for chunk in self.ledger['chunks']]
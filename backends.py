@@ -0,0 +1,475 @@
+import io, json, os, threading, time, uuid
+import numpy
+import queryCache
+import stageMetrics
+
+# Every request the scripts make to SIMBAD, VizieR and the Gaia archive goes
+# through a backend as call(service, method, params), with plain JSON-able
+# parameters, and comes back as a list of tables (or a small dict for the
+# state of an asynchronous TAP job). The clients returned by getSimbad(),
+# getVizier() and getTap() offer the subset of the astroquery interfaces the
+# scripts use, so the same code runs against:
+#
+#   astroqueryBackend   the live services, through astroquery
+#   httpBackend         a stand-in server (standInServer.py) on another host or port
+#   replayBackend       responses saved by a recordingBackend, then a fallback
+#   localBackend        a local tile store, FITS table and name list
+#   recordingBackend    any of the above, saving each response for replay
+
+def requestKey(service, method, params):
+    return queryCache.makeKey({'service': service, 'method': method, 'params': params})
+
+def writeTables(tables):
+    # A list of tables as the bytes of one VOTable, one RESOURCE per table.
+    from astropy.io import votable
+    document = None
+    for table in tables:
+        part = votable.from_table(table)
+        if document is None:
+            document = part
+        else:
+            document.resources.extend(part.resources)
+    output = io.BytesIO()
+    document.to_xml(output)
+    return output.getvalue()
+
+def readTables(data):
+    from astropy.io import votable
+    document = votable.parse(io.BytesIO(data), verify='ignore')
+    return [table.to_table(use_names_over_ids=True) for table in document.iter_tables()]
+
+def fetch(backend, service, method, params):
+    with stageMetrics.stage(service) as counts:
+        result = backend.call(service, method, params)
+        if isinstance(result, list): counts['rows'] = stageMetrics.tableRows(result)
+        return result
+
+def arcsec(radius):
+    # Radii may be given as astropy quantities or as plain arcseconds.
+    if radius is None: return None
+    if hasattr(radius, 'unit'):
+        from astropy import units as u
+        return float(radius.to(u.arcsec).value)
+    return float(radius)
+
+
+class simbadClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def query_object(self, name):
+        tables = fetch(self.backend, 'simbad', 'query_object', {'name': name})
+        return tables[0] if len(tables) > 0 else None
+
+    def query_objects(self, names):
+        tables = fetch(self.backend, 'simbad', 'query_objects', {'names': list(names)})
+        return tables[0] if len(tables) > 0 else None
+
+
+class vizierClient:
+    def __init__(self, backend, columns = ["all"], catalog = 'I/345/gaia2', rowLimit = 25000, column_filters = {}):
+        self.backend = backend
+        self.settings = {'columns': list(columns), 'catalog': catalog, 'rowLimit': rowLimit, 'filters': dict(column_filters)}
+
+    def query_object(self, name, catalog = None, radius = None):
+        params = dict(self.settings, name = name, radius = arcsec(radius))
+        if catalog is not None: params['catalog'] = catalog
+        return fetch(self.backend, 'vizier', 'query_object', params)
+
+    def query_region(self, coordinates, radius = None, catalog = None):
+        params = dict(self.settings, ra = [float(ra) for ra in numpy.atleast_1d(coordinates.icrs.ra.deg)], dec = [float(dec) for dec in numpy.atleast_1d(coordinates.icrs.dec.deg)], radius = arcsec(radius))
+        if catalog is not None: params['catalog'] = catalog
+        return fetch(self.backend, 'vizier', 'query_region', params)
+
+    def get_catalogs(self, catalog):
+        return fetch(self.backend, 'vizier', 'get_catalogs', dict(self.settings, catalog = catalog))
+
+
+class tapJob:
+    # Stands in for an astroquery TAP job: a jobid, its phase and its results.
+    def __init__(self, backend, jobid = None, results = None, outputFormat = 'votable'):
+        self.backend = backend
+        self.jobid = jobid
+        self.results = results
+        self.outputFormat = outputFormat
+        self.outputFileUser = None
+
+    def get_phase(self, update = False):
+        if self.results is not None: return 'COMPLETED'
+        return fetch(self.backend, 'tap', 'phase', {'jobid': self.jobid})['phase']
+
+    def get_results(self):
+        if self.results is None:
+            self.results = fetch(self.backend, 'tap', 'results', {'jobid': self.jobid})[0]
+        return self.results
+
+    def save_results(self, verbose = False):
+        with stageMetrics.stage('tap') as counts:
+            self.backend.saveResults(self)
+            counts['bytes'] = os.path.getsize(self.outputFileUser)
+
+
+class tapClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def uploadParams(self, query, upload_resource, upload_table_name, output_format = 'votable'):
+        params = {'query': query, 'upload': None, 'uploadName': upload_table_name}
+        if output_format != 'votable': params['format'] = output_format
+        if upload_resource is not None:
+            with open(upload_resource, 'rt') as uploadFile:
+                params['upload'] = uploadFile.read()
+        return params
+
+    def launch_job(self, query, output_format = 'votable', upload_resource = None, upload_table_name = None, **kwargs):
+        tables = fetch(self.backend, 'tap', 'launch_job', self.uploadParams(query, upload_resource, upload_table_name, output_format))
+        return tapJob(self.backend, results = tables[0], outputFormat = output_format)
+
+    def launch_job_async(self, query, output_format = 'votable', background = False, upload_resource = None, upload_table_name = None, **kwargs):
+        jobid = fetch(self.backend, 'tap', 'launch_job_async', self.uploadParams(query, upload_resource, upload_table_name, output_format))['jobid']
+        job = tapJob(self.backend, jobid = jobid, outputFormat = output_format)
+        if not background:
+            while job.get_phase(update = True) not in ('COMPLETED', 'ERROR', 'ABORTED'):
+                time.sleep(0.5)
+        return job
+
+    def load_async_job(self, jobid = None, load_results = False, **kwargs):
+        return tapJob(self.backend, jobid = jobid)
+
+
+class backend:
+    # Runs asynchronous TAP jobs as synchronous queries that report COMPLETED
+    # 'jobTime' seconds after they were submitted. Subclasses implement request().
+    jobTime = 0.
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def getSimbad(self):
+        return simbadClient(self)
+
+    def getVizier(self, columns = ["all"], catalog = 'I/345/gaia2', rowLimit = 25000, column_filters = {}):
+        return vizierClient(self, columns, catalog, rowLimit, column_filters)
+
+    def getTap(self):
+        return tapClient(self)
+
+    def getJobParams(self, jobid):
+        with self.lock:
+            if jobid not in self.jobs:
+                raise LookupError("Unknown job %s"%jobid)
+            return self.jobs[jobid]
+
+    def call(self, service, method, params):
+        if service == 'tap' and method == 'launch_job_async':
+            jobid = uuid.uuid4().hex
+            with self.lock:
+                self.jobs[jobid] = (params, time.time() + self.jobTime)
+            return {'jobid': jobid}
+        if service == 'tap' and method == 'phase':
+            params, ready = self.getJobParams(params['jobid'])
+            return {'phase': 'COMPLETED' if time.time() >= ready else 'EXECUTING'}
+        if service == 'tap' and method == 'results':
+            return self.request('tap', 'launch_job', self.getJobParams(params['jobid'])[0])
+        return self.request(service, method, params)
+
+    def request(self, service, method, params):
+        raise NotImplementedError
+
+    def saveResults(self, job):
+        # Writes the results of a tapJob to job.outputFileUser.
+        job.get_results().write(job.outputFileUser, format = 'fits' if job.outputFormat == 'fits' else 'votable', overwrite = True)
+
+
+class astroqueryBackend(backend):
+    def __init__(self):
+        backend.__init__(self)
+        self.services = {}
+
+    def getService(self, service, settings = None):
+        key = (service, queryCache.makeKey(settings))
+        with self.lock:
+            if key not in self.services:
+                if service == 'simbad':
+                    from astroquery.simbad import Simbad
+                    self.services[key] = Simbad()
+                elif service == 'vizier':
+                    from astroquery.vizier import Vizier
+                    v = Vizier(columns=settings['columns'], catalog=settings['catalog'], column_filters=settings['filters'])
+                    v.ROW_LIMIT = settings['rowLimit']
+                    self.services[key] = v
+                else:
+                    from astroquery.gaia import Gaia
+                    self.services[key] = Gaia
+            return self.services[key]
+
+    def launchTap(self, params, asynchronous):
+        import tempfile
+        tap = self.getService('tap')
+        uploadFilename = None
+        try:
+            if params.get('upload') is not None:
+                handle, uploadFilename = tempfile.mkstemp(suffix='.xml')
+                with os.fdopen(handle, 'wt') as uploadFile:
+                    uploadFile.write(params['upload'])
+            outputFormat = params.get('format', 'votable')
+            if asynchronous:
+                return tap.launch_job_async(params['query'], output_format=outputFormat, background=True, upload_resource=uploadFilename, upload_table_name=params.get('uploadName'))
+            return tap.launch_job(params['query'], output_format=outputFormat, upload_resource=uploadFilename, upload_table_name=params.get('uploadName'))
+        finally:
+            if uploadFilename is not None: os.remove(uploadFilename)
+
+    def call(self, service, method, params):
+        if service != 'tap' or method not in ('launch_job_async', 'phase', 'results'):
+            return self.request(service, method, params)
+        if method == 'launch_job_async':
+            job = self.launchTap(params, True)
+            with self.lock:
+                self.jobs[job.jobid] = job
+            return {'jobid': job.jobid}
+        job = self.getJob(params['jobid'])
+        if method == 'phase':
+            return {'phase': job.get_phase(update=True).upper().strip()}
+        return [job.get_results()]
+
+    def getJob(self, jobid):
+        with self.lock:
+            job = self.jobs.get(jobid)
+        if job is None:
+            job = self.getService('tap').load_async_job(jobid=jobid, load_results=False)
+            with self.lock:
+                self.jobs[jobid] = job
+        return job
+
+    def saveResults(self, job):
+        # Asynchronous results are streamed to the file by astroquery itself,
+        # in the format the job was launched with, without parsing them here.
+        if job.results is not None: return backend.saveResults(self, job)
+        astroqueryJob = self.getJob(job.jobid)
+        astroqueryJob.outputFileUser = job.outputFileUser
+        astroqueryJob.save_results()
+
+    def request(self, service, method, params):
+        from astropy import units as u
+        if service == 'simbad':
+            if method == 'query_objects':
+                result = self.getService('simbad').query_objects(params['names'])
+            else:
+                result = self.getService('simbad').query_object(params['name'])
+            return [] if result is None or len(result) == 0 else [result]
+        if service == 'vizier':
+            settings = {k: params[k] for k in ('columns', 'catalog', 'rowLimit', 'filters')}
+            vizier = self.getService('vizier', settings)
+            radius = None if params.get('radius') is None else params['radius'] * u.arcsec
+            if method == 'query_object':
+                if radius is None: return list(vizier.query_object(params['name'], catalog=params['catalog']))
+                return list(vizier.query_object(params['name'], catalog=params['catalog'], radius=radius))
+            if method == 'query_region':
+                from astropy.coordinates import SkyCoord
+                coordinates = SkyCoord(params['ra'], params['dec'], unit=(u.deg, u.deg), frame='icrs')
+                return list(vizier.query_region(coordinates, radius=radius, catalog=params['catalog']))
+            if method == 'get_catalogs':
+                return list(vizier.get_catalogs(params['catalog']))
+        if service == 'tap' and method == 'launch_job':
+            return [self.launchTap(params, False).get_results()]
+        raise ValueError("Unsupported request %s.%s"%(service, method))
+
+
+class httpBackend(backend):
+    # Sends each call as a JSON POST to <url>/<service>/<method>.
+    def __init__(self, url, timeout = 600.):
+        backend.__init__(self)
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def call(self, service, method, params):
+        import urllib.error, urllib.request
+        request = urllib.request.Request('%s/%s/%s'%(self.url, service, method), data=json.dumps(params).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                contentType = response.headers.get('Content-Type', '')
+                data = response.read()
+                stageMetrics.count(service, bytes = len(data))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise LookupError("%s.%s: %s"%(service, method, e.read().decode('utf-8', 'replace'))) from None
+            raise
+        if contentType.startswith('application/json'):
+            return json.loads(data.decode('utf-8'))
+        return readTables(data)
+
+
+class replayBackend(backend):
+    # Answers from the files saved by a recordingBackend, then from 'fallback'.
+    def __init__(self, directory, fallback = None):
+        backend.__init__(self)
+        self.directory = directory
+        self.fallback = fallback
+
+    def request(self, service, method, params):
+        filename = os.path.join(self.directory, requestKey(service, method, params))
+        if os.path.exists(filename + '.xml'):
+            with open(filename + '.xml', 'rb') as recording:
+                return readTables(recording.read())
+        if os.path.exists(filename + '.json'):
+            return []
+        if self.fallback is not None:
+            return self.fallback.request(service, method, params)
+        raise LookupError("No recording for %s.%s %s"%(service, method, json.dumps(params)[:200]))
+
+
+class recordingBackend(backend):
+    def __init__(self, inner, directory):
+        backend.__init__(self)
+        self.inner = inner
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, service, method, params, tables):
+        import tableExport
+        filename = os.path.join(self.directory, requestKey(service, method, params))
+        extension = '.xml' if len(tables) > 0 else '.json'
+        with tableExport.atomicOutput(filename + extension) as tempName:
+            with open(tempName, 'wb') as recording:
+                recording.write(writeTables(tables) if len(tables) > 0 else b'[]')
+
+    def call(self, service, method, params):
+        result = self.inner.call(service, method, params)
+        if service == 'tap' and method == 'launch_job_async':
+            with self.lock:
+                self.jobs[result['jobid']] = (params, 0.)
+        elif service == 'tap' and method == 'results':
+            # Saved as the equivalent synchronous query, so either can replay it.
+            with self.lock:
+                jobParams = self.jobs.get(params['jobid'])
+            if jobParams is not None: self.record('tap', 'launch_job', jobParams[0], result)
+        elif isinstance(result, list):
+            self.record(service, method, params, result)
+        return result
+
+
+class localBackend(backend):
+    # Answers from local data: VizieR searches from a tileStore, TAP queries
+    # with localADQL on a FITS table or tile store, and SIMBAD lookups from a
+    # table of names with 'name', 'ra' and 'dec' (degrees) columns. SIMBAD
+    # lookups of other names go to 'fallback' (e.g. the live services), and
+    # the coordinates it returns are kept for the VizieR searches that follow.
+    def __init__(self, source = None, names = None, fallback = None):
+        backend.__init__(self)
+        self.source = source
+        self.fallback = fallback
+        self.store = None
+        if source is not None and not os.path.exists(source):
+            raise FileNotFoundError("No local tile store or FITS table at %s"%source)
+        if source is not None and os.path.isdir(source):
+            import tileStore
+            self.store = tileStore.tileStore(source)
+        self.names = {}
+        if names is not None:
+            from astropy.io import ascii
+            for row in ascii.read(names):
+                self.names[str(row['name']).strip()] = (float(row['ra']), float(row['dec']))
+
+    def resolve(self, name):
+        if name.strip() not in self.names and self.fallback is not None:
+            self.askFallback('query_object', {'name': name})
+        if name.strip() not in self.names:
+            raise LookupError("Unknown object %s"%name)
+        return self.names[name.strip()]
+
+    def askFallback(self, method, params):
+        import nameResolver
+        tables = self.fallback.call('simbad', method, params)
+        if len(tables) > 0 and len(tables[0]) > 0:
+            names = params['names'] if method == 'query_objects' else [params['name']]
+            rows = nameResolver.alignResults(names, tables[0]) if method == 'query_objects' else numpy.zeros(1, dtype=numpy.int64)
+            found = rows >= 0
+            ra, dec, bad = nameResolver.simbadCoordinates(tables[0][rows[found]])
+            for name, r, d, isBad in zip(numpy.array(names)[found], ra, dec, bad):
+                if not isBad: self.names[name.strip()] = (float(r), float(d))
+        return tables
+
+    def getStore(self):
+        if self.store is None:
+            raise LookupError("No local tile store to answer VizieR requests")
+        return self.store
+
+    def vizierFilters(self, params):
+        # VizieR constraints such as {"e_Plx": "<0.1", "RandomI": "1..2"}
+        filters = []
+        for column, constraint in params.get('filters', {}).items():
+            constraint = constraint.strip()
+            if '..' in constraint:
+                low, high = constraint.split('..')
+                filters+= [(column, '>=', float(low)), (column, '<=', float(high))]
+            else:
+                filters.append("%s %s"%(column, constraint))
+        return filters
+
+    def request(self, service, method, params):
+        from astropy.table import Table
+        if service == 'simbad':
+            from astropy.coordinates import Angle
+            names = params['names'] if method == 'query_objects' else [params['name']]
+            known = [name.strip() in self.names for name in names]
+            if self.fallback is not None and not all(known): return self.askFallback(method, params)
+            if method == 'query_object' and not known[0]: return []
+            ra = numpy.array([self.names[name.strip()][0] if k else 0. for name, k in zip(names, known)])
+            dec = numpy.array([self.names[name.strip()][1] if k else 0. for name, k in zip(names, known)])
+            mask = ~numpy.array(known, dtype=bool)
+            table = Table({'MAIN_ID': [name if k else '' for name, k in zip(names, known)],
+                           'RA': Angle(ra, unit='deg').to_string(unit='hour', sep=' ', precision=4, pad=True),
+                           'DEC': Angle(dec, unit='deg').to_string(unit='deg', sep=' ', precision=3, alwayssign=True, pad=True)}, masked=True)
+            table['ra'] = numpy.ma.array(ra, mask=mask)
+            table['dec'] = numpy.ma.array(dec, mask=mask)
+            table['RA'].mask = mask
+            table['DEC'].mask = mask
+            if method == 'query_objects': table['user_specified_id'] = names
+            return [table]
+        if service == 'vizier':
+            store = self.getStore()
+            filters = self.vizierFilters(params)
+            if method == 'get_catalogs':
+                limit = params['rowLimit'] if params['rowLimit'] > 0 else None
+                return [store.query(filters=filters, limit=limit, vizier=True)]
+            radius = params.get('radius') or 120.
+            if method == 'query_object':
+                ra, dec = self.resolve(params['name'])
+                table = store.cone(ra, dec, radius, filters=filters, vizier=True)
+                return [table] if len(table) > 0 else []
+            if method == 'query_region':
+                from astropy.table import vstack
+                parts = []
+                for index, (ra, dec) in enumerate(zip(params['ra'], params['dec'])):
+                    part = store.cone(ra, dec, radius, filters=filters, vizier=True)
+                    part['_q'] = numpy.full(len(part), index + 1, dtype=numpy.int64)
+                    parts.append(part)
+                table = vstack(parts) if len(parts) > 0 else Table()
+                return [table] if len(table) > 0 else []
+        if service == 'tap' and method == 'launch_job':
+            import localADQL
+            if params.get('upload') is not None:
+                raise ValueError("Local TAP queries cannot use uploaded tables")
+            if self.source is None:
+                raise LookupError("No local table to run ADQL on")
+            return [localADQL.executeQuery(params['query'], defaultSource = self.source)]
+        raise ValueError("Unsupported request %s.%s"%(service, method))
+
+
+def addBackendArguments(parser):
+    parser.add_argument('--service', type=str, help='Send SIMBAD, VizieR and Gaia requests to this stand-in server (see standInServer.py) instead of the live services.')
+    parser.add_argument('--record', type=str, help='Save every response in this directory, for standInServer.py to replay.')
+
+def backendFromArguments(arg, local = None):
+    # With 'local' (a tile store or FITS table), Gaia data comes from there and
+    # only SIMBAD lookups go to the services.
+    if arg.service is not None:
+        source = httpBackend(arg.service)
+    else:
+        source = astroqueryBackend()
+    if arg.record is not None:
+        source = recordingBackend(source, arg.record)
+    if local is not None:
+        source = localBackend(local, fallback = source)
+    return source
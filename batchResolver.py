@@ -0,0 +1,77 @@
+import random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs the per-target lookups of a --list file on a bounded pool of threads.
+# Each remote service gets its own concurrency limit so that, for example,
+# SIMBAD is not hit by more than a few requests at once, and failed calls are
+# retried with exponential backoff. Only transient failures are retried:
+# connection errors and timeouts, and HTTP 408, 429 and 5xx responses; other
+# HTTP errors (which are OSErrors too) are raised at once. Results always come
+# back in input order.
+
+def httpStatus(error):
+    # The status of an HTTP error from urllib or requests, otherwise None.
+    status = getattr(error, 'code', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+def isTransient(error):
+    status = httpStatus(error)
+    if status is not None:
+        return status in (408, 429) or status >= 500
+    return True
+
+class batchResolver:
+    def __init__(self, workers = 4, limits = None, retries = 3, backoff = 1.0, retryOn = (OSError,)):
+        if limits is None: limits = {'simbad': 4, 'vizier': 4, 'tap': 2}
+        self.workers = max(1, workers)
+        self.semaphores = {service: threading.BoundedSemaphore(max(1, limit)) for service, limit in limits.items()}
+        self.retries = retries
+        self.backoff = backoff
+        self.retryOn = retryOn
+
+    def call(self, service, function, *args, **kwargs):
+        # Calls function(*args, **kwargs) within the concurrency limit of 'service'.
+        semaphore = self.semaphores.get(service)
+        attempt = 0
+        while True:
+            try:
+                if semaphore is None:
+                    return function(*args, **kwargs)
+                with semaphore:
+                    return function(*args, **kwargs)
+            except self.retryOn as e:
+                if attempt >= self.retries or not isTransient(e): raise
+                delay = self.backoff * 2**attempt * (1 + random.random())
+                print("%s call failed (%s), retrying in %.1f seconds"%(service, e, delay))
+                time.sleep(delay)
+                attempt+= 1
+
+    def map(self, function, items):
+        # Yields a (result, exception) pair for each item, in input order, as
+        # soon as that item and those before it are done, so the caller can
+        # work on early results while later ones are still being fetched.
+        def run(item):
+            try:
+                return function(item), None
+            except Exception as e:
+                return None, e
+        if self.workers == 1:
+            for item in items:
+                yield run(item)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(run, item) for item in items]
+            for future in futures:
+                yield future.result()
+
+
+def addResolverArguments(parser):
+    parser.add_argument('--workers', type=int, default=4, help='Number of targets to resolve concurrently (default=4).')
+    parser.add_argument('--simbadlimit', type=int, default=4, help='Maximum concurrent SIMBAD requests (default=4).')
+    parser.add_argument('--vizierlimit', type=int, default=4, help='Maximum concurrent VizieR requests (default=4).')
+    parser.add_argument('--retries', type=int, default=3, help='Retries for a failed network request (default=3).')
+
+def resolverFromArguments(arg):
+    return batchResolver(arg.workers, limits = {'simbad': arg.simbadlimit, 'vizier': arg.vizierlimit, 'tap': 2}, retries = arg.retries)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import contextlib, io, json, os, platform, subprocess, sys, tempfile, time, tracemalloc
+import numpy
+
+# Times the main data paths on synthetic Gaia-like tables of increasing size
+# and records the peak memory they allocate (traced in a separate run, as
+# tracemalloc slows code down). Results are written as JSON, and --compare
+# checks a run against an earlier one, listing every case that got slower or
+# needed more memory by more than --threshold. --startup also times how long
+# each script takes to start (running it with --help) against a budget.
+
+def makeGaiaTable(numRows, seed = 0):
+    # VizieR-style columns, as returned by the VizieR queries in getGAIA.py and pullGAIATable.py.
+    from astropy.table import Table
+    rng = numpy.random.default_rng(seed)
+    ra = rng.uniform(0., 360., numRows)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1., 1., numRows)))
+    step = 6917528997577384320 // numRows
+    source = numpy.arange(numRows, dtype=numpy.int64) * step + rng.integers(0, step, numRows)   # unique and sorted
+    gmag = rng.uniform(6., 21., numRows)
+    colour = rng.normal(1., 0.5, numRows)
+    table = Table({
+        'Source': source, 'DR2Name': numpy.char.add('Gaia DR2 ', source.astype(str)),
+        'RA_ICRS': ra, 'DE_ICRS': dec, 'RAJ2000': ra, 'DEJ2000': dec,
+        'Plx': rng.normal(1., 2., numRows), 'e_Plx': rng.uniform(0.01, 1., numRows),
+        'pmRA': rng.normal(0., 10., numRows), 'pmDE': rng.normal(0., 10., numRows),
+        'Gmag': gmag, 'BPmag': gmag + colour / 2, 'RPmag': gmag - colour / 2,
+    })
+    missing = rng.random(numRows) < 0.05
+    table['BPmag'][missing] = numpy.nan
+    return table
+
+def makeSexagesimal(numRows, seed = 0):
+    from astropy.coordinates import Angle
+    rng = numpy.random.default_rng(seed)
+    ra = Angle(rng.uniform(0., 360., numRows), unit='deg').to_string(unit='hour', sep=' ', precision=2, pad=True)
+    dec = Angle(rng.uniform(-89., 89., numRows), unit='deg').to_string(unit='deg', sep=' ', precision=1, alwayssign=True, pad=True)
+    return [str(s) for s in ra], [str(s) for s in dec]
+
+
+# Each case is set up outside the timed region and returns the function to time.
+
+def setupCalcAngularDistance(table, workDir):
+    import gaiaClass
+    target = (float(table['RAJ2000'][len(table) // 2]) + 1e-4, float(table['DEJ2000'][len(table) // 2]))
+    def run():
+        objects = gaiaClass.GAIAObjects(gaiaTable = table)
+        with contextlib.redirect_stdout(io.StringIO()):
+            objects.calcAngularDistance(*target)
+    return run
+
+def setupGetObjectByDR2Name(table, workDir):
+    import gaiaClass
+    rng = numpy.random.default_rng(1)
+    names = [str(name) for name in table['DR2Name'][rng.integers(0, len(table), 1000)]]
+    def run():
+        objects = gaiaClass.GAIAObjects(gaiaTable = table)
+        for name in names:
+            objects.getObjectByDR2Name(name)
+    return run
+
+def setupAddItemWriteCSV(table, workDir):
+    import gaiaClass
+    columns = ['RA_ICRS', 'DE_ICRS', 'Plx', 'e_Plx', 'Gmag', 'BPmag', 'RPmag']
+    values = [table[c].tolist() for c in columns]
+    names = [str(name) for name in table['DR2Name']]
+    filename = os.path.join(workDir, 'table.csv')
+    def run():
+        resultsTable = gaiaClass.gaiaTABLE()
+        resultsTable.setColumns(columns)
+        for name, row in zip(names, zip(*values)):
+            resultsTable.addItem(name, columns, dict(zip(columns, row)))
+        resultsTable.writeAsCSV(filename)
+    return run
+
+def setupHRReduction(table, workDir):
+    import drawHRdiagram, gaiaColumns
+    from astropy.table import Table
+    filename = os.path.join(workDir, 'sources.fits')
+    archive = Table({gaiaColumns.toArchiveName(c): table[c] for c in ['Source', 'Plx', 'Gmag', 'BPmag', 'RPmag']})
+    archive.write(filename, overwrite=True)
+    def run():
+        data = drawHRdiagram.gaiaData()
+        data.loadFromFITS(filename, drawHRdiagram.hrColumns)
+        data.computeAbsG()
+        data.computeColour()
+        data.filter()
+    return run
+
+def setupParseCoords(table, workDir):
+    import generalUtils
+    raStrings, decStrings = makeSexagesimal(len(table))
+    def run():
+        generalUtils.parseSexagesimal(raStrings, decStrings)
+    return run
+
+cases = {
+    'calcAngularDistance': setupCalcAngularDistance,
+    'getObjectByDR2Name': setupGetObjectByDR2Name,
+    'addItem+writeAsCSV': setupAddItemWriteCSV,
+    'loadFromFITS+HRreduction': setupHRReduction,
+    'parseCoords': setupParseCoords,
+}
+
+def measure(run, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'meanSeconds': sum(times) / len(times), 'peakBytes': peak}
+
+def runBenchmarks(sizes, names, repeat = 3, seed = 0):
+    results = {name: {} for name in names}
+    with tempfile.TemporaryDirectory() as workDir:
+        for size in sizes:
+            table = makeGaiaTable(size, seed)
+            for name in names:
+                run = cases[name](table, workDir)
+                results[name][str(size)] = measure(run, repeat)
+                result = results[name][str(size)]
+                print("%-26s %10d rows  %10.4f s  %10.1f MB peak"%(name, size, result['seconds'], result['peakBytes'] / 1024.**2))
+                sys.stdout.flush()
+            del table
+    return results
+
+# Seconds each script may take to start, as measured by 'script --help'.
+# Heavy packages (astropy, astroquery, matplotlib) are imported only where
+# they are needed, so none of the scripts should load them just to start.
+startupBudgets = {
+    'getGAIA.py': 0.5, 'pullGAIATable.py': 0.5, 'adqlGAIATable.py': 0.5, 'drawHRdiagram.py': 0.5,
+    'tileStore.py': 0.5, 'localADQL.py': 0.5, 'standInServer.py': 0.5,
+}
+
+def measureStartup(script, repeat):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(directory, script), '--help'], stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'meanSeconds': sum(times) / len(times), 'peakBytes': 0}
+
+def runStartup(scripts, repeat = 3):
+    # Results are kept as a case of their own, so that --compare covers them too.
+    results = {}
+    for script in scripts:
+        results[script] = measureStartup(script, repeat)
+        seconds = results[script]['seconds']
+        flag = "OVER BUDGET" if seconds > startupBudgets[script] else ""
+        print("%-26s startup  %10.4f s  (budget %.2f s) %s"%(script, seconds, startupBudgets[script], flag))
+        sys.stdout.flush()
+    return {'startup': results}
+
+def overBudget(benchmarks):
+    return [script for script, result in benchmarks.get('startup', {}).items() if result['seconds'] > startupBudgets[script]]
+
+def compareResults(baseline, current, threshold = 0.2, minSeconds = 0.01):
+    # Returns the (case, size, measure, old, new) entries that regressed. Times
+    # below 'minSeconds' are too noisy to judge and never count as regressions.
+    regressions = []
+    for name, sizes in current['results'].items():
+        for size, result in sizes.items():
+            old = baseline['results'].get(name, {}).get(size)
+            if old is None: continue
+            for key in ('seconds', 'peakBytes'):
+                ratio = result[key] / old[key] if old[key] > 0 else 1.
+                flag = "REGRESSION" if ratio > 1 + threshold and (key != 'seconds' or result[key] >= minSeconds) else ""
+                print("%-26s %10s rows  %-10s %12.4g -> %12.4g  (x%.2f) %s"%(name, size, key, old[key], result[key], ratio, flag))
+                if flag: regressions.append((name, size, key, old[key], result[key]))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks the GAIA table tools on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='Table sizes in rows (default=1000 10000 100000 1000000; up to 10000000 is practical).')
+    parser.add_argument('--cases', type=str, nargs='+', choices=list(cases.keys()), default=list(cases.keys()), help='Benchmarks to run (default=all).')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each case; the fastest is reported (default=3).')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic tables (default=0).')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='JSON file for the results (default=benchmark.json).')
+    parser.add_argument('--compare', type=str, help='JSON results of an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Fractional slowdown or memory growth reported as a regression (default=0.2).')
+    parser.add_argument('--minseconds', type=float, default=0.01, help='Shortest time that can count as a regression (default=0.01).')
+    parser.add_argument('--startup', type=str, nargs='*', choices=list(startupBudgets.keys()), help='Time the start up of these scripts (default=all) against their budgets instead of running the cases.')
+    arg = parser.parse_args()
+
+    if arg.startup is not None:
+        benchmarks = runStartup(arg.startup or list(startupBudgets.keys()), arg.repeat)
+    else:
+        benchmarks = runBenchmarks(arg.sizes, arg.cases, arg.repeat, arg.seed)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': numpy.__version__,
+        'platform': platform.platform(), 'repeat': arg.repeat, 'seed': arg.seed,
+        'results': benchmarks,
+    }
+    with open(arg.output, 'wt') as outputFile:
+        json.dump(results, outputFile, indent=1)
+    print("Results written to %s"%arg.output)
+
+    if arg.compare is not None:
+        with open(arg.compare, 'rt') as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = compareResults(baseline, results, arg.threshold, arg.minseconds)
+        if len(regressions) > 0:
+            print("%d regressions beyond %.0f%%"%(len(regressions), arg.threshold * 100))
+            sys.exit(1)
+
+    if len(overBudget(benchmarks)) > 0:
+        print("Over the startup budget: %s"%', '.join(overBudget(benchmarks)))
+        sys.exit(1)
@@ -0,0 +1,71 @@
+import os, tempfile
+import numpy
+import crossMatch
+import gaiaColumns
+import stageMetrics
+
+# Cross-matches a whole target list against Gaia DR2 in a single request,
+# either as a VizieR multi-position cone search or as a TAP upload join
+# against gaiadr2.gaia_source, and joins the nearest match back to each
+# target name locally.
+
+uploadQuery = """SELECT t.target_id, DISTANCE(POINT('ICRS', g.ra, g.dec), POINT('ICRS', t.ra, t.dec)) AS separation, g.* FROM gaiadr2.gaia_source AS g JOIN tap_upload.targets AS t ON 1=CONTAINS(POINT('ICRS', g.ra, g.dec), CIRCLE('ICRS', t.ra, t.dec, %.10f))"""
+
+def nearestPerTarget(targetIndex, separations, numTargets):
+    # For rows tagged with a 0-based target index, returns the row of the
+    # closest match for each target, or -1 where a target has no rows.
+    with stageMetrics.stage('crossmatch', rows = numTargets):
+        targetIndex = numpy.asarray(targetIndex, dtype=numpy.int64)
+        separations = numpy.asarray(separations, dtype=numpy.float64)
+        order = numpy.lexsort((separations, targetIndex))
+        targets, first = numpy.unique(targetIndex[order], return_index=True)
+        rows = numpy.full(numTargets, -1, dtype=numpy.int64)
+        rows[targets] = order[first]
+        return rows
+
+def joinNearest(names, table, rows):
+    # Returns the matched rows in target order with a 'Name' column in front,
+    # plus the names that had no match.
+    matched = rows >= 0
+    result = table[rows[matched]]
+    result.add_column([name for name, m in zip(names, matched) if m], name='Name', index=0)
+    unmatched = [name for name, m in zip(names, matched) if not m]
+    return result, unmatched
+
+def vizierMultiMatch(names, RAs, DECs, radius, vizier, catalog = 'I/345/gaia2'):
+    # 'vizier' is an astroquery Vizier instance; its ROW_LIMIT applies to the
+    # whole request, so it should be unlimited (-1) or large enough for all targets.
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    RAs = numpy.asarray(RAs, dtype=numpy.float64)
+    DECs = numpy.asarray(DECs, dtype=numpy.float64)
+    coordinates = SkyCoord(RAs, DECs, unit=(u.deg, u.deg), frame='icrs')
+    results = vizier.query_region(coordinates, radius = radius * u.arcsec, catalog = catalog)
+    if len(results) == 0:
+        return None, list(names)
+    table = results[0]
+    targetIndex = numpy.asarray(table['_q'], dtype=numpy.int64) - 1
+    separations = crossMatch.angularSeparation(RAs[targetIndex], DECs[targetIndex], numpy.asarray(table['RAJ2000'], dtype=numpy.float64), numpy.asarray(table['DEJ2000'], dtype=numpy.float64))
+    table['_sep'] = separations
+    rows = nearestPerTarget(targetIndex, separations, len(names))
+    return joinNearest(names, table, rows)
+
+def tapUploadMatch(names, RAs, DECs, radius, tap = None):
+    # 'tap' is any astroquery TapPlus-like object (the Gaia archive by default,
+    # or a TapPlus pointed at a recorded or stand-in TAP server).
+    from astropy.table import Table
+    if tap is None:
+        from astroquery.gaia import Gaia
+        tap = Gaia
+    targets = Table({'target_id': numpy.arange(len(names), dtype=numpy.int32), 'ra': numpy.asarray(RAs, dtype=numpy.float64), 'dec': numpy.asarray(DECs, dtype=numpy.float64)})
+    handle, uploadFilename = tempfile.mkstemp(suffix='.xml')
+    os.close(handle)
+    try:
+        targets.write(uploadFilename, format='votable', overwrite=True)
+        job = tap.launch_job_async(uploadQuery%(radius / 3600.), upload_resource=uploadFilename, upload_table_name='targets')
+        table = job.get_results()
+    finally:
+        os.remove(uploadFilename)
+    rows = nearestPerTarget(table['target_id'], table['separation'], len(names))
+    # The join returns archive column names; the callers expect VizieR's.
+    return joinNearest(names, gaiaColumns.toVizierTable(table), rows)
@@ -0,0 +1,92 @@
+import numpy
+
+# Angular separations use the Vincenty formula, which stays accurate from
+# sub-milliarcsecond separations right up to antipodal points, unlike arccos.
+
+def angularSeparation(ra1, dec1, ra2, dec2):
+    # All inputs in degrees (scalars or broadcastable arrays), result in arcseconds.
+    ra1 = numpy.radians(ra1)
+    dec1 = numpy.radians(dec1)
+    ra2 = numpy.radians(ra2)
+    dec2 = numpy.radians(dec2)
+    deltaRA = ra2 - ra1
+    sinDeltaRA = numpy.sin(deltaRA)
+    cosDeltaRA = numpy.cos(deltaRA)
+    sinDec1 = numpy.sin(dec1)
+    cosDec1 = numpy.cos(dec1)
+    sinDec2 = numpy.sin(dec2)
+    cosDec2 = numpy.cos(dec2)
+    num1 = cosDec2 * sinDeltaRA
+    num2 = cosDec1 * sinDec2 - sinDec1 * cosDec2 * cosDeltaRA
+    denominator = sinDec1 * sinDec2 + cosDec1 * cosDec2 * cosDeltaRA
+    return numpy.degrees(numpy.arctan2(numpy.hypot(num1, num2), denominator)) * 3600.
+
+
+class crossMatcher:
+    # Holds a catalogue sorted by declination so that radius-limited queries
+    # only have to look at the declination band around each target.
+    def __init__(self, RAs, DECs, chunkSize = 4000000):
+        self.RAs = numpy.asarray(RAs, dtype=numpy.float64)
+        self.DECs = numpy.asarray(DECs, dtype=numpy.float64)
+        self.length = len(self.RAs)
+        self.chunkSize = chunkSize
+        self.order = numpy.argsort(self.DECs, kind='stable')
+        self.sortedRAs = self.RAs[self.order]
+        self.sortedDECs = self.DECs[self.order]
+
+    def getLength(self):
+        return self.length
+
+    def _band(self, dec, radius):
+        radiusDeg = radius / 3600.
+        start = numpy.searchsorted(self.sortedDECs, dec - radiusDeg, side='left')
+        end = numpy.searchsorted(self.sortedDECs, dec + radiusDeg, side='right')
+        return start, end
+
+    def nearest(self, targetRAs, targetDECs, radius = None):
+        # Returns (indices, separations in arcsec) for the closest catalogue entry
+        # to each target. Targets with nothing inside 'radius' get index -1 and a
+        # separation of NaN.
+        targetRAs = numpy.atleast_1d(numpy.asarray(targetRAs, dtype=numpy.float64))
+        targetDECs = numpy.atleast_1d(numpy.asarray(targetDECs, dtype=numpy.float64))
+        numTargets = len(targetRAs)
+        indices = numpy.full(numTargets, -1, dtype=numpy.int64)
+        separations = numpy.full(numTargets, numpy.nan)
+        if self.length == 0 or numTargets == 0:
+            return indices, separations
+
+        if radius is not None:
+            for i, (ra, dec) in enumerate(zip(targetRAs, targetDECs)):
+                start, end = self._band(dec, radius)
+                if end <= start: continue
+                seps = angularSeparation(ra, dec, self.sortedRAs[start:end], self.sortedDECs[start:end])
+                best = numpy.argmin(seps)
+                if seps[best] <= radius:
+                    indices[i] = self.order[start + best]
+                    separations[i] = seps[best]
+            return indices, separations
+
+        step = max(1, self.chunkSize // self.length)
+        for start in range(0, numTargets, step):
+            end = min(start + step, numTargets)
+            seps = angularSeparation(targetRAs[start:end, None], targetDECs[start:end, None], self.RAs[None, :], self.DECs[None, :])
+            best = numpy.argmin(seps, axis=1)
+            indices[start:end] = best
+            separations[start:end] = seps[numpy.arange(end - start), best]
+        return indices, separations
+
+    def within(self, targetRAs, targetDECs, radius, k = None):
+        # Returns one (indices, separations) pair per target, holding every
+        # catalogue entry inside 'radius' arcseconds sorted by separation and
+        # truncated to the k closest when k is given.
+        targetRAs = numpy.atleast_1d(numpy.asarray(targetRAs, dtype=numpy.float64))
+        targetDECs = numpy.atleast_1d(numpy.asarray(targetDECs, dtype=numpy.float64))
+        matches = []
+        for ra, dec in zip(targetRAs, targetDECs):
+            start, end = self._band(dec, radius)
+            seps = angularSeparation(ra, dec, self.sortedRAs[start:end], self.sortedDECs[start:end])
+            inside = numpy.nonzero(seps <= radius)[0]
+            ranked = inside[numpy.argsort(seps[inside], kind='stable')]
+            if k is not None: ranked = ranked[:k]
+            matches.append((self.order[start + ranked], seps[ranked]))
+        return matches
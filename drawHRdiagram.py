@@ -1,63 +1,68 @@
 #!/usr/bin/env python3
-import astropy, astroquery, sys, numpy
-import matplotlib.pyplot
-from matplotlib.patches import Circle
-from matplotlib.collections import PatchCollection
-from astropy.visualization import LogStretch
-from astropy.visualization import SqrtStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-
-from astropy.io import fits
+import sys, numpy
 import gaiaClass
 import generalUtils
-import mpl_scatter_density
+import hrDensity
+import stageMetrics
 import argparse
 
-class gaiaTarget():
-    def __init__(self):
-        self.data = {}
-
-    def addData(self, columns, data):
-        dataObject = {}
-        for c, d in zip(columns, data):
-            dataObject[c] = d
-        self.data = dataObject
+class gaiaTargets():
+    # A whole CSV of special objects held as masked arrays, with '--'
+    # placeholders read as masked values and the derived columns computed for
+    # every row at once.
+    def __init__(self, data=None):
+        self.data = data
 
-    def __str__(self):
-        return str(self.data)
+    def loadFromCSV(self, filename):
+        from astropy.io import ascii
+        table = ascii.read(filename, format='csv', comment='#', fill_values=[('--', '0'), ('', '0')])
+        # Trailing separators in older CSV files give an unnamed, empty last column
+        for c in list(table.colnames):
+            if c.startswith('col') and numpy.ma.getmaskarray(table[c]).all():
+                table.remove_column(c)
+        self.data = {c: numpy.ma.array(numpy.array(table[c]), mask=numpy.ma.getmaskarray(table[c])) for c in table.colnames}
+        return len(table)
+
+    def getLength(self):
+        return len(self.data['Name'])
+
+    def getColumn(self, name):
+        return numpy.ma.array(self.data[name], dtype=numpy.float64)
+
+    def rejectMask(self):
+        reject = numpy.zeros(self.getLength(), dtype=bool)
+        for c in ['phot_bp_mean_mag', 'phot_rp_mean_mag', 'parallax']:
+            reject|= numpy.ma.getmaskarray(self.data[c])
+        return reject
+
+    def reject(self):
+        keep = ~self.rejectMask()
+        self.data = {c: values[keep] for c, values in self.data.items()}
+        return int((~keep).sum())
 
     def computeDistance(self):
-        parallax = self.data['parallax']
-        distance = 1000/parallax
-        self.data['distance'] = distance
-        return distance
+        parallax = numpy.ma.masked_less_equal(self.getColumn('parallax'), 0)
+        self.data['distance'] = 1000 / parallax
+        return self.data['distance']
 
     def computeAbsoluteG(self):
-        gmag = self.data['phot_g_mean_mag']
-        parallax = self.data['parallax']
-        absG = gmag + 5 * numpy.log10(parallax/100)
-        self.data['absG'] = absG
-        return absG
+        parallax = numpy.ma.masked_less_equal(self.getColumn('parallax'), 0)
+        self.data['absG'] = self.getColumn('phot_g_mean_mag') + 5 * numpy.ma.log10(parallax / 100)
+        return self.data['absG']
 
     def computeColour(self):
-        try: 
-            colour = self.data['phot_bp_mean_mag'] - self.data['phot_rp_mean_mag']
-            self.data['colour'] = colour
-        except TypeError:
-            colour = 0
-        return colour
-
-    def rejectMe(self):
-        if self.data['phot_bp_mean_mag'] == '--': return True
-        if self.data['phot_rp_mean_mag'] == '--': return True
-        if self.data['parallax'] == '--': return True
-        return False
+        self.data['colour'] = self.getColumn('phot_bp_mean_mag') - self.getColumn('phot_rp_mean_mag')
+        return self.data['colour']
 
 
 class gaiaData():
-    def __init__(self, data=None):
+    # Derived quantities are computed on whole columns at once. Rows with a
+    # non-positive parallax or missing photometry come out as NaN, and filter()
+    # drops them. 'dtype' (e.g. numpy.float32) sets the precision of the outputs.
+    def __init__(self, data=None, dtype=numpy.float64):
         self.data = data
         self.columns = None
+        self.dtype = dtype
 
     def setColumns(self, columns):
         self.columns = columns
@@ -65,14 +70,21 @@ class gaiaData():
     def setData(self, data):
         self.data = data
 
-    def loadFromFITS(self, filename):
-        hdu = fits.open(filename)
+    def loadFromFITS(self, filename, columns=None):
+        # With 'columns', only those columns are copied out of the memory-mapped
+        # table; otherwise the whole table is kept as before.
+        from astropy.io import fits
+        hdu = fits.open(filename, memmap=True)
         data = hdu[1].data # assuming the first extension is a table
-        columns = hdu[1].columns
+        self.setColumns(hdu[1].columns)
+        if columns is not None:
+            data = {c: numpy.array(data[c]) for c in columns}
+            length = hdu[1].header['NAXIS2']
+        else:
+            length = len(data)
         hdu.close()
-        self.setColumns(columns)
         self.setData(data)
-        return len(data)
+        return length
     
     def showColumns(self):
         if self.columns is None:
@@ -82,134 +94,250 @@ class gaiaData():
             retStr+= str(c) + " \n" 
         return retStr
 
+    def getColumn(self, name):
+        column = self.data[name]
+        values = numpy.array(numpy.ma.getdata(column), dtype=self.dtype)
+        values[numpy.ma.getmaskarray(column)] = numpy.nan
+        return values
+
+    def getParallax(self):
+        parallax = self.getColumn('parallax')
+        parallax[~(parallax > 0)] = numpy.nan
+        return parallax
+
     def computeDistance(self):
-        distances = [1000/parallax for parallax in self.data['parallax']]
-        print(self.data['parallax'])
-        self.distances = distances
+        self.distances = 1000 / self.getParallax()
+        return self.distances
 
     def computeAbsG(self):
-        gmag = self.data['phot_g_mean_mag']
-        parallax = self.data['parallax']
-        absG = [ float(gmag + 5 * numpy.log10(parallax/100)) for gmag, parallax in zip(gmag, parallax) ]
-        self.absG = absG
+        with numpy.errstate(invalid='ignore'):
+            self.absG = self.getColumn('phot_g_mean_mag') + 5 * numpy.log10(self.getParallax() / 100)
+        return self.absG
 
     def computeColour(self):
-        colours = [float(bp - rp) for bp, rp in zip(self.data['phot_bp_mean_mag'], self.data['phot_rp_mean_mag']) ]
-        self.colours = colours
+        self.colours = self.getColumn('phot_bp_mean_mag') - self.getColumn('phot_rp_mean_mag')
+        return self.colours
         
     def filter(self):
-        newColours = []
-        newG = []
-        for colour, g in zip(self.colours, self.absG):
-            if numpy.isnan(colour): continue
-            if numpy.isnan(g): continue
-            newColours.append(colour)
-            newG.append(g)
-        self.colours = newColours
-        self.absG = newG
+        good = numpy.isfinite(self.colours) & numpy.isfinite(self.absG)
+        self.colours = self.colours[good]
+        self.absG = self.absG[good]
+        return good
+
+    def reduce(self):
+        # The whole pipeline: returns the filtered (colours, absG) arrays.
+        self.computeAbsG()
+        self.computeColour()
+        self.filter()
+        return self.colours, self.absG
 
 
         
+hrColumns = ['parallax', 'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag']
+
+def loadSources(filenames, columns=hrColumns, dtype=numpy.float64, blockSize=1000000):
+    # Reads 'columns' from many FITS tables into one set of preallocated arrays.
+    # The tables are memory-mapped and copied across a block of rows at a time,
+    # so only the output arrays are ever held in memory.
+    from astropy.io import fits
+    lengths = [fits.getheader(filename, 1)['NAXIS2'] for filename in filenames]
+    output = {c: numpy.empty(sum(lengths), dtype=dtype) for c in columns}
+    offset = 0
+    for filename, length in zip(filenames, lengths):
+        hdu = fits.open(filename, memmap=True)
+        data = hdu[1].data
+        for c in columns:
+            column = data[c]
+            for start in range(0, length, blockSize):
+                end = min(start + blockSize, length)
+                output[c][offset + start:offset + end] = column[start:end]
+        del data, column
+        hdu.close()
+        print("Loaded %d rows of Gaia data from %s"%(length, filename))
+        offset+= length
+    return gaiaData(data=output, dtype=dtype)
+
+def countRows(filenames):
+    from astropy.io import fits
+    return {filename: fits.getheader(filename, 1)['NAXIS2'] for filename in filenames}
+
+def getSlices(filenames, sliceSize, lengths=None):
+    # Splits the input tables into (filename, start, end) row ranges, the units
+    # of work handed to the worker processes.
+    if lengths is None: lengths = countRows(filenames)
+    slices = []
+    for filename in filenames:
+        length = lengths[filename]
+        for start in range(0, length, sliceSize):
+            slices.append((filename, start, min(start + sliceSize, length)))
+    return slices
+
+def reduceSlice(filename, start, end, columns=hrColumns, dtype=numpy.float64, blockSize=1000000, grid=None):
+    # Runs rows start:end of a memory-mapped table through gaiaData a block at
+    # a time. Adds the results to 'grid' and returns it, or without a grid
+    # returns the filtered (colours, absG) arrays.
+    from astropy.io import fits
+    hdu = fits.open(filename, memmap=True)
+    data = hdu[1].data
+    colourBlocks = []
+    absGBlocks = []
+    for blockStart in range(start, end, blockSize):
+        blockEnd = min(blockStart + blockSize, end)
+        block = gaiaData(data={c: data[c][blockStart:blockEnd] for c in columns}, dtype=dtype)
+        colours, absG = block.reduce()
+        if grid is not None:
+            grid.accumulate(colours, absG)
+        else:
+            colourBlocks.append(colours)
+            absGBlocks.append(absG)
+    del data
+    hdu.close()
+    if grid is not None: return grid
+    return numpy.concatenate(colourBlocks + [numpy.empty(0, dtype=dtype)]), numpy.concatenate(absGBlocks + [numpy.empty(0, dtype=dtype)])
+
+def reduceWork(work):
+    filename, start, end, columns, dtype, blockSize, grid = work
+    return reduceSlice(filename, start, end, columns, dtype, blockSize, grid)
+
+def reduceSources(filenames, workers=1, grid=None, columns=hrColumns, dtype=numpy.float64, blockSize=1000000, sliceSize=None):
+    # Reduces all the sources, split into slices, on a pool of 'workers'
+    # processes. Each worker returns a partial grid (when 'grid' is given) or
+    # its compact (colours, absG) arrays, and these are combined in slice
+    # order so the result does not depend on the number of workers.
+    # By default there are about four slices per worker, to keep them all busy
+    # to the end, but no slice is smaller than a block.
+    lengths = countRows(filenames)
+    if sliceSize is None: sliceSize = max(blockSize, -(-sum(lengths.values()) // (4 * workers)))
+    slices = getSlices(filenames, sliceSize, lengths)
+    workGrid = grid
+    if grid is not None and workers > 1:
+        workGrid = hrDensity.hrDensityGrid(grid.colourRange, grid.magRange, grid.bins)
+    work = [(filename, start, end, columns, dtype, blockSize, workGrid) for filename, start, end in slices]
+    colourParts = [numpy.empty(0, dtype=dtype)]
+    absGParts = [numpy.empty(0, dtype=dtype)]
+    pool = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(reduceWork, work)
+    else:
+        results = map(reduceWork, work)
+    for result in results:
+        if grid is None:
+            colourParts.append(result[0])
+            absGParts.append(result[1])
+        elif result is not grid:
+            grid.merge(result)
+    if pool is not None: pool.shutdown()
+    for filename in filenames:
+        rows = sum(end - start for f, start, end in slices if f == filename)
+        print("Reduced %d rows of Gaia data from %s"%(rows, filename))
+    if grid is not None: return grid
+    return numpy.concatenate(colourParts), numpy.concatenate(absGParts)
+
+def accumulateSources(filenames, grid, columns=hrColumns, dtype=numpy.float64, blockSize=1000000, workers=1):
+    # Streams the memory-mapped tables through gaiaData a block of rows at a
+    # time and adds each block to an hrDensityGrid, so memory use is bounded
+    # by the block size however large the inputs are.
+    return reduceSources(filenames, workers, grid, columns, dtype, blockSize)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Draws an HR diagram based on saved GAIA data.')
     parser.add_argument('sources', type=str, nargs='*', help='File containing a table of GAIA data.')
     parser.add_argument('--extra', type=str, help='File containing a table of special objects.' )
+    parser.add_argument('--maxlabels', type=int, default=100, help='Only label the special objects if there are at most this many (default=100).')
     
+    parser.add_argument('--stream', action='store_true', help='Accumulate the sources into a fixed density grid a chunk at a time instead of holding every point.')
+    parser.add_argument('--chunk', type=int, default=1000000, help='Rows per chunk in --stream mode (default=1000000).')
+    parser.add_argument('--bins', type=int, nargs=2, default=[460, 680], help='Colour and magnitude bins of the density grid (default=460 680).')
+    parser.add_argument('--grid', type=str, nargs='*', default=[], help='Saved density grids (.npz) to merge into the diagram; implies --stream.')
+    parser.add_argument('--savegrid', type=str, help='Save the accumulated density grid to this .npz file.')
+    parser.add_argument('--stretch', type=str, default='sqrt', choices=['sqrt', 'log', 'linear'], help='Stretch used to render the density (default=sqrt).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to load and reduce the sources (default=1).')
+    parser.add_argument('--float32', action='store_true', help='Compute colours and magnitudes in single precision to halve memory use.')
+    parser.add_argument('--noshow', action='store_true', help='Only save hr_diagram.pdf, without opening a window.')
     parser.add_argument('--version', action='store_true', help='Show Astropy and Astroquery versions.')
+    stageMetrics.addMetricsArguments(parser)
     arg = parser.parse_args()
+    stageMetrics.metricsFromArguments(arg)
 
     if arg.version:
+        import astropy, astroquery
         print("Astropy version: ", astropy.__version__)
         print("Astroquery version: ", astroquery.__version__)
         sys.exit()
 
   	# Set up the matplotlib environment
+    display = generalUtils.selectBackend(not arg.noshow)
+    import matplotlib.pyplot
+    from astropy.visualization import LogStretch, SqrtStretch, LinearStretch
+    from astropy.visualization.mpl_normalize import ImageNormalize
     generalUtils.setMatplotlibDefaults()
     params = {	'axes.labelsize': 'large',
 				'xtick.labelsize': 'large',
 				'ytick.labelsize': 'large',
 			}
     matplotlib.rcParams.update(params)
-    norm = ImageNormalize(stretch=SqrtStretch())
-
-
-    sourceData = []
-    for s in arg.sources:
-        sampleGaiaData = gaiaData()
-        numRows = sampleGaiaData.loadFromFITS(s)
-        print("Loaded %d rows of Gaia data from %s"%(numRows, s))
-        sampleGaiaData.computeDistance()
-        sampleGaiaData.computeAbsG()
-        sampleGaiaData.computeColour()
-        sourceData.append(sampleGaiaData)
-    #print(sampleGaiaData.showColumns())
+    stretches = {'sqrt': SqrtStretch(), 'log': LogStretch(), 'linear': LinearStretch()}
+    norm = ImageNormalize(stretch=stretches[arg.stretch])
+    dtype = numpy.float32 if arg.float32 else numpy.float64
+
+    if arg.stream or len(arg.grid) > 0 or arg.savegrid is not None:
+        grid = hrDensity.hrDensityGrid(bins = arg.bins)
+        for g in arg.grid:
+            grid.merge(hrDensity.hrDensityGrid.load(g))
+        with stageMetrics.stage('derived') as counts:
+            accumulateSources(arg.sources, grid, dtype = dtype, blockSize = arg.chunk, workers = arg.workers)
+            counts['rows'] = grid.getTotal()
+        print(grid.getTotal())
+        if arg.savegrid is not None:
+            grid.save(arg.savegrid)
+            print("Density grid saved to %s"%arg.savegrid)
+
+        HRdiagram = matplotlib.pyplot.figure(figsize=(9, 10))
+        ax = matplotlib.pyplot.gcf().add_subplot(1, 1, 1)
+        grid.render(ax, norm=norm)
+    else:
+        if arg.workers > 1:
+            with stageMetrics.stage('derived') as counts:
+                allColours, allG = reduceSources(arg.sources, arg.workers, dtype = dtype, blockSize = arg.chunk)
+                counts['rows'] = len(allColours)
+        else:
+            with stageMetrics.stage('load') as counts:
+                sources = loadSources(arg.sources, dtype = dtype)
+                counts['rows'] = len(sources.data[hrColumns[0]])
+            with stageMetrics.stage('derived', rows = counts['rows']):
+                allColours, allG = sources.reduce()
+        #print(sampleGaiaData.showColumns())
     
-    HRdiagram = matplotlib.pyplot.figure(figsize=(9, 10))
-
-    allColours = []
-    allG = []
-    for sources in sourceData:
-        sources.filter()
-        allG+= sources.absG
-        allColours+= sources.colours
-        print(len(sources.absG))
+        import mpl_scatter_density
+        HRdiagram = matplotlib.pyplot.figure(figsize=(9, 10))
 
-    print(len(allColours))
+        print(len(allColours))
 
-    ax = matplotlib.pyplot.gcf().add_subplot(1, 1, 1, projection='scatter_density')
-    ax.scatter_density(allColours, allG, norm=norm, color="black")
+        ax = matplotlib.pyplot.gcf().add_subplot(1, 1, 1, projection='scatter_density')
+        ax.scatter_density(allColours, allG, norm=norm, color="black")
     #matplotlib.pyplot.scatter(colours, absG, marker=".", alpha=0.5, color='grey')
     matplotlib.pyplot.gca().invert_yaxis()
 
 
     
     if arg.extra is not None:
-        dataFile = open(arg.extra, 'rt')
-        targets = []
-        lineCounter = 0
-        headings = []
-        for line in dataFile:
-            if len(line)<1: continue
-            if line[0]=='#': continue
-            params = line.strip().split(',')
-            if lineCounter==0:
-                for p in params:
-                    headings.append(str(p.strip()))
-            else:
-                data = []
-                for p in params:
-                    try:
-                        value = float(p)
-                    except ValueError:
-                        value = str(p.strip())
-                    data.append(value)
-                target = gaiaTarget()
-                target.addData(headings, data)
-                targets.append(target)
-            lineCounter+= 1
-        print(headings)
-        print(str(lineCounter-1) + " lines read from " + arg.extra)
-        
-        for t in targets:
-            print(t)
-        
-        filteredTargets = []
-        for t in targets:
-            if not t.rejectMe(): filteredTargets.append(t)
-
-        targets = filteredTargets
-
-        for index, t in enumerate(targets):
-            t.computeDistance()
-            t.computeAbsoluteG()
-            t.computeColour()
-    
-        absG = [t.data['absG'] for t in targets]
-        colours = [t.data['colour'] for t in targets]
+        targets = gaiaTargets()
+        numTargets = targets.loadFromCSV(arg.extra)
+        print(list(targets.data.keys()))
+        print(str(numTargets) + " lines read from " + arg.extra)
+        if numTargets <= arg.maxlabels:
+            for i in range(numTargets):
+                print({c: values[i] for c, values in targets.data.items()})
+
+        print("%d targets rejected"%targets.reject())
+        targets.computeDistance()
+        absG = targets.computeAbsoluteG()
+        colours = targets.computeColour()
     
         matplotlib.pyplot.scatter(colours, absG, color='k', marker='.')
-        names = [t.data['Name'][2:] for t in targets]
+        names = [str(name)[2:] for name in targets.data['Name']]
         offsets = [ (0, 0),    #0023 
                     (0, 0),    #0145
                     (0, -0.45), #0303
@@ -231,19 +359,24 @@ if __name__ == "__main__":
                     (-0.1, 0),   #1517
                     (-0.4, 0),   #2257
                     (-0.3, 0) ]  #2317 
-        print(len(targets), len(names), len(offsets))
-        print(names)
-        for i, txt in enumerate(names):
-            ax.annotate(txt, (colours[i]+.04+offsets[i][0],absG[i]-0.1-offsets[i][1]),  fontsize=13)
-            print(i, txt, offsets[i])
+        if len(names) != len(offsets):
+            offsets = [(0, 0)] * len(names)
+        print(targets.getLength(), len(names), len(offsets))
+        if len(names) <= arg.maxlabels:
+            print(names)
+            for i, txt in enumerate(names):
+                ax.annotate(txt, (colours[i]+.04+offsets[i][0],absG[i]-0.1-offsets[i][1]),  fontsize=13)
+                print(i, txt, offsets[i])
 
     matplotlib.pyplot.xlim((-0.6, 4.0))
     matplotlib.pyplot.ylim((17.0, 0.0))
     matplotlib.pyplot.ylabel('$\mathrm{M}_{G}$')
     matplotlib.pyplot.xlabel('$G_{BP} - G_{RP}$')
 
-    matplotlib.pyplot.savefig("hr_diagram.pdf")
-
-    matplotlib.pyplot.show(block = False)
+    with stageMetrics.stage('render'):
+        matplotlib.pyplot.savefig("hr_diagram.pdf")
+    stageMetrics.countFile('render', "hr_diagram.pdf")
 
-    input("Press enter to continue")
+    if display:
+        matplotlib.pyplot.show(block = False)
+        input("Press enter to continue")
@@ -1,51 +1,108 @@
-import numpy
+import numpy, sys
+import crossMatch
+import tableExport
+import stageMetrics
+
+def columnArray(column):
+    # Copies an astropy (Masked)Column, or a slice of one, into a numpy masked array.
+    return numpy.ma.array(numpy.array(column, copy=True), mask=numpy.ma.getmaskarray(column).copy())
+
+def valuesArray(values):
+    # Turns a list of row values, which may include numpy.ma.masked, into a masked array.
+    mask = numpy.array([v is numpy.ma.masked for v in values], dtype=bool)
+    if mask.any():
+        fill = next((v for v, m in zip(values, mask) if not m), 0)
+        values = [fill if m else v for v, m in zip(values, mask)]
+    return numpy.ma.array(numpy.array(values), mask=mask)
+
 
 class gaiaTABLE:
-    def __init__(self):
+    # Column-oriented: each stored column is a list of masked array chunks, so
+    # a row costs the bytes of its values rather than a Python dict. Rows added
+    # one at a time with addItem are buffered and packed every 'chunkSize' rows.
+    def __init__(self, chunkSize = 4096):
         self.length = 0
-        self.objects = []
         self.columns = None
+        self.chunkSize = chunkSize
+        self.storedColumns = None
+        self.names = []
+        self.data = {}
+        self.pendingNames = []
+        self.pending = {}
 
     def getLength(self):
-        return len(self.objects)
+        return self.length
 
     def setColumns(self, columns):
         self.columns = columns
 
+    def setStoredColumns(self, keys):
+        if self.storedColumns is not None: return
+        if self.columns is not None:
+            self.storedColumns = list(self.columns)
+        else:
+            self.storedColumns = list(keys)
+        self.data = {col: [] for col in self.storedColumns}
+        self.pending = {col: [] for col in self.storedColumns}
+
+    def flush(self):
+        if len(self.pendingNames) == 0: return
+        self.names.append(numpy.array(self.pendingNames, dtype=str))
+        for col in self.storedColumns:
+            self.data[col].append(valuesArray(self.pending[col]))
+            self.pending[col] = []
+        self.pendingNames = []
+
     def addItem(self, name, keys, item):
-        # print("Adding item")
-        object = {'name': name}
-        for key in keys:
-            object[key] = item[key]
-        self.objects.append(object)
-        # print("added object called: %s"%name)
-        # print(object)
+        # Only the selected columns (or every key, if none are selected yet) are kept.
+        self.setStoredColumns(keys)
+        self.pendingNames.append(name)
+        for col in self.storedColumns:
+            self.pending[col].append(item[col])
+        self.length+= 1
+        if len(self.pendingNames) >= self.chunkSize: self.flush()
+
+    def addRows(self, names, table):
+        # Adds a whole chunk of rows from an astropy Table (or slice of one) at once.
+        self.setStoredColumns(table.keys())
+        self.flush()
+        self.names.append(numpy.array(names, dtype=str))
+        for col in self.storedColumns:
+            self.data[col].append(columnArray(table[col]))
+        self.length+= len(names)
+
+    def getNames(self):
+        self.flush()
+        if len(self.names) == 0: return numpy.array([], dtype=str)
+        if len(self.names) > 1: self.names = [numpy.concatenate(self.names)]
+        return self.names[0]
+
+    def getColumn(self, col):
+        # A selected column with no rows added yet comes back empty.
+        self.flush()
+        chunks = self.data.get(col, [])
+        if len(chunks) == 0: return numpy.ma.array([])
+        if len(chunks) > 1: self.data[col] = chunks = [numpy.ma.concatenate(chunks)]
+        return chunks[0]
+
+    def getColumns(self):
+        columns = {'Name': self.getNames()}
+        for col in self.columns:
+            columns[col] = self.getColumn(col)
+        return columns
 
     def dumpTable(self):
         if self.columns is None: return
-        print("Name", end='\t')
-        for col in self.columns:
-            print(col, end="\t")
-        print()
-        for row in self.objects:
-            print(row['name'], end='\t')
-            for col in self.columns:
-                print(row[col], end='\t')    
-            print()
+        tableExport.writeDelimited(sys.stdout, self.getColumns(), delimiter='\t')
 
     def writeAsCSV(self, filename):
         if self.columns is None: return
-        outputFile = open(filename, 'wt')
-        outputFile.write("Name, ")
-        for col in self.columns:
-            outputFile.write(col + ', ')
-        outputFile.write('\n')
-        for row in self.objects:
-            outputFile.write(row['name'] + ', ')
-            for col in self.columns:
-                outputFile.write(str(row[col]) + ', ')    
-            outputFile.write('\n')
-        outputFile.close()
+        tableExport.writeCSV(filename, self.getColumns())
+
+    def write(self, filename):
+        # Output format (CSV, FITS, Parquet or HDF5) is chosen from the file extension.
+        if self.columns is None: return
+        tableExport.writeTable(filename, self.getColumns())
 
 
 
@@ -54,6 +111,10 @@ class GAIAObjects:
         self.objects = []
         self.length = 0
         self.GAIATable = gaiaTable
+        self.matcher = None
+        self.objectIndex = None
+        self.sourceIndex = None
+        self.DR2NameIndex = None
 
     def getTableInfo(self):
         print(self.GAIATable)
@@ -63,6 +124,8 @@ class GAIAObjects:
     def addObject(self, object):
         self.objects.append(object)
         self.length = len(self.objects)
+        if self.objectIndex is not None:
+            self.objectIndex.setdefault(object['Source'], object)
 
     def getIDs(self):
         idlist = self.GAIATable['Source']
@@ -72,34 +135,82 @@ class GAIAObjects:
         return self.objects
 
     def getObjectByID(self, id):
-        for o in self.objects:
-            if o['Source']==id: return o
-        return None
+        if self.objectIndex is None:
+            self.objectIndex = {}
+            for o in self.objects:
+                self.objectIndex.setdefault(o['Source'], o)
+        return self.objectIndex.get(id)
+
+    def getSourceIndex(self):
+        if self.sourceIndex is None:
+            self.sourceIndex = {}
+            for row, id in enumerate(self.GAIATable['Source']):
+                self.sourceIndex.setdefault(int(id), row)
+        return self.sourceIndex
+
+    def getDR2NameIndex(self):
+        if self.DR2NameIndex is None:
+            self.DR2NameIndex = {}
+            for row, name in enumerate(self.GAIATable['DR2Name']):
+                self.DR2NameIndex.setdefault(str(name), row)
+        return self.DR2NameIndex
+
+    def getObjectsByIDs(self, ids):
+        # Bulk lookup of source_ids, returned as a sub-table in the order given.
+        index = self.getSourceIndex()
+        missing = [id for id in ids if int(id) not in index]
+        if len(missing) > 0:
+            raise ValueError("Source IDs not in table: %s"%', '.join(str(id) for id in missing))
+        return self.GAIATable[[index[int(id)] for id in ids]]
+
+    def getMatcher(self):
+        if self.matcher is None:
+            RAs = numpy.asarray(self.GAIATable['RAJ2000'], dtype=numpy.float64)
+            DECs = numpy.asarray(self.GAIATable['DEJ2000'], dtype=numpy.float64)
+            self.matcher = crossMatch.crossMatcher(RAs, DECs)
+        return self.matcher
 
     def calcAngularDistance(self, targetRA, targetDEC):
-        RAs =  [float(ra) for ra in self.GAIATable['RAJ2000']]
-        DECs = [float(dec) for dec in self.GAIATable['DEJ2000']]
         DR2Names = self.GAIATable['DR2Name']
-        dec1 = targetDEC/180. * numpy.pi
-        ra1 = targetRA/180. * numpy.pi
         bestMatch = DR2Names[0]
         matchDistance = 120.
-        for name, ra, dec in zip(DR2Names, RAs, DECs):
-            dec2 = dec/180. * numpy.pi
-            ra2 = ra/180. * numpy.pi
-            a = numpy.sin(dec2)*numpy.sin(dec1) + numpy.cos(dec1)*numpy.cos(dec2)*numpy.cos(ra1-ra2)
-            angularSeparation = numpy.arccos(a) * 180 / numpy.pi * 3600.
-            # print(name, ra, dec, angularSeparation)
-            if angularSeparation < matchDistance:
-                matchDistance = angularSeparation
-                bestMatch = name
+        with stageMetrics.stage('crossmatch', rows = 1):
+            indices, separations = self.getMatcher().nearest(targetRA, targetDEC, radius = matchDistance)
+        if indices[0] >= 0 and separations[0] < matchDistance:
+            matchDistance = separations[0]
+            bestMatch = DR2Names[indices[0]]
         print("Bestmatch: %s with separation of %f arcseconds"%(bestMatch, matchDistance))
         return bestMatch
 
+    def crossMatch(self, targetRAs, targetDECs, radius = None, k = None):
+        # Nearest match for many targets in one call: returns the DR2Names
+        # (None where nothing is inside 'radius') and separations in arcsec.
+        # With k set, returns instead a list of (DR2Names, separations) of the
+        # k nearest neighbours within 'radius' for each target.
+        DR2Names = self.GAIATable['DR2Name']
+        matcher = self.getMatcher()
+        if k is not None:
+            if radius is None: radius = 648000.
+            with stageMetrics.stage('crossmatch', rows = len(targetRAs)):
+                return [([DR2Names[i] for i in indices], separations) for indices, separations in matcher.within(targetRAs, targetDECs, radius, k = k)]
+        with stageMetrics.stage('crossmatch', rows = len(targetRAs)):
+            indices, separations = matcher.nearest(targetRAs, targetDECs, radius = radius)
+        names = [DR2Names[i] if i >= 0 else None for i in indices]
+        return names, separations
+
     def getObjectByDR2Name(self, id):
-        DR2Names = [str(name) for name in self.GAIATable['DR2Name']]
-        index = DR2Names.index(id)
-        return self.GAIATable[index]
+        index = self.getDR2NameIndex()
+        if str(id) not in index:
+            raise ValueError("%s is not in table"%id)
+        return self.GAIATable[index[str(id)]]
+
+    def getObjectsByDR2Names(self, names):
+        # Bulk lookup of DR2Names, returned as a sub-table in the order given.
+        index = self.getDR2NameIndex()
+        missing = [name for name in names if str(name) not in index]
+        if len(missing) > 0:
+            raise ValueError("DR2Names not in table: %s"%', '.join(str(name) for name in missing))
+        return self.GAIATable[[index[str(name)] for name in names]]
 
     def getCoords(self):
         RAs =  [float(ra) for ra in self.GAIATable['RAJ2000']]
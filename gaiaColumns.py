@@ -0,0 +1,50 @@
+import numpy
+
+# Column names of gaiadr2.gaia_source in the Gaia archive and their
+# counterparts in the VizieR copy of the catalogue (I/345/gaia2), so that
+# tables from either source can be used where the other is expected.
+
+vizierNames = {
+    'source_id': 'Source', 'designation': 'DR2Name', 'random_index': 'RandomI', 'ref_epoch': 'Epoch',
+    'ra': 'RA_ICRS', 'ra_error': 'e_RA_ICRS', 'dec': 'DE_ICRS', 'dec_error': 'e_DE_ICRS',
+    'parallax': 'Plx', 'parallax_error': 'e_Plx', 'pmra': 'pmRA', 'pmra_error': 'e_pmRA', 'pmdec': 'pmDE', 'pmdec_error': 'e_pmDE',
+    'duplicated_source': 'Dup', 'phot_g_mean_flux': 'FG', 'phot_g_mean_flux_error': 'e_FG', 'phot_g_mean_mag': 'Gmag',
+    'phot_bp_mean_flux': 'FBP', 'phot_bp_mean_flux_error': 'e_FBP', 'phot_bp_mean_mag': 'BPmag',
+    'phot_rp_mean_flux': 'FRP', 'phot_rp_mean_flux_error': 'e_FRP', 'phot_rp_mean_mag': 'RPmag',
+    'bp_rp': 'BP-RP', 'radial_velocity': 'RV', 'radial_velocity_error': 'e_RV', 'teff_val': 'Teff',
+    'a_g_val': 'AG', 'e_bp_min_rp_val': 'E(BP-RP)', 'radius_val': 'Rad', 'lum_val': 'Lum',
+}
+archiveNames = {v: k for k, v in vizierNames.items()}
+
+def toArchiveName(name):
+    return archiveNames.get(name, name)
+
+def toVizierName(name):
+    return vizierNames.get(name, name)
+
+def epoch2000Positions(ra, dec, pmra, pmdec, epoch = 2015.5):
+    # VizieR's RAJ2000/DEJ2000: the positions carried back from the Gaia DR2
+    # epoch with the proper motions (mas/yr). Sources without proper motions
+    # keep their catalogue position.
+    years = 2000. - epoch
+    pmra = numpy.nan_to_num(numpy.asarray(pmra, dtype=numpy.float64))
+    pmdec = numpy.nan_to_num(numpy.asarray(pmdec, dtype=numpy.float64))
+    dec = numpy.asarray(dec, dtype=numpy.float64)
+    ra2000 = numpy.asarray(ra, dtype=numpy.float64) + pmra * years / 3.6e6 / numpy.cos(numpy.radians(dec))
+    dec2000 = dec + pmdec * years / 3.6e6
+    return ra2000 % 360., dec2000
+
+def toVizierTable(table):
+    # Renames the columns of an archive table in place and adds RAJ2000/DEJ2000
+    # when the positions and proper motions are present.
+    for name in list(table.colnames):
+        if name in vizierNames and vizierNames[name] not in table.colnames:
+            table.rename_column(name, vizierNames[name])
+    if 'RA_ICRS' in table.colnames and 'DE_ICRS' in table.colnames and 'RAJ2000' not in table.colnames:
+        if 'pmRA' in table.colnames and 'pmDE' in table.colnames:
+            ra2000, dec2000 = epoch2000Positions(table['RA_ICRS'], table['DE_ICRS'], numpy.ma.filled(table['pmRA'], numpy.nan), numpy.ma.filled(table['pmDE'], numpy.nan))
+        else:
+            ra2000, dec2000 = numpy.array(table['RA_ICRS']), numpy.array(table['DE_ICRS'])
+        table['RAJ2000'] = ra2000
+        table['DEJ2000'] = dec2000
+    return table
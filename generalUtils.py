@@ -1,3 +1,14 @@
+import numpy
+
+def selectBackend(interactive = True):
+	# Switches matplotlib to the non-GUI Agg backend when no window will be
+	# shown, because 'interactive' is off or there is no display to show it on.
+	# Call before matplotlib.pyplot is imported. Returns whether plots can be shown.
+	import matplotlib, os, sys
+	if interactive and (sys.platform in ('darwin', 'win32') or os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+		return True
+	matplotlib.use('Agg')
+	return False
 
 def setMatplotlibDefaults():
 	import matplotlib
@@ -12,3 +23,88 @@ def setMatplotlibDefaults():
 			}
 	matplotlib.rcParams.update(params)
 
+
+separatorCodes = [ord(c) for c in ' \t:hmsd'] + [0]
+
+def characterMatrix(strings):
+	# A column of strings as an (rows, characters) array of character codes,
+	# padded with zeros, so that it can be scanned without a Python loop.
+	strings = numpy.asarray(strings)
+	if strings.dtype.kind not in ('U', 'S'): strings = strings.astype(str)
+	strings = numpy.ascontiguousarray(strings)
+	codeType = numpy.uint32 if strings.dtype.kind == 'U' else numpy.uint8
+	width = strings.dtype.itemsize // numpy.dtype(codeType).itemsize
+	if width == 0: return numpy.zeros((len(strings), 1), dtype=numpy.uint32)
+	return strings.view(codeType).reshape(len(strings), width).astype(numpy.uint32)
+
+def parseSexagesimalColumn(strings, hours):
+	# 'hh mm ss.s' or '+dd mm ss.s' (also with ':' separators or letters, and
+	# with the seconds or minutes missing) to degrees, and a mask of bad values.
+	# The strings are scanned one character position at a time for all rows
+	# at once, accumulating the digits of up to three fields per row.
+	bad = numpy.ma.getmaskarray(strings).copy() if numpy.ma.isMaskedArray(strings) else numpy.zeros(len(strings), dtype=bool)
+	chars = characterMatrix(numpy.ma.getdata(strings))
+	numRows = len(chars)
+	values = numpy.zeros((3, numRows))
+	scales = numpy.ones((3, numRows))
+	hasPoint = numpy.zeros((3, numRows), dtype=bool)
+	hasDigit = numpy.zeros((3, numRows), dtype=bool)
+	field = numpy.zeros(numRows, dtype=numpy.int8)
+	inNumber = numpy.zeros(numRows, dtype=bool)
+	seen = numpy.zeros(numRows, dtype=bool)
+	negative = numpy.zeros(numRows, dtype=bool)
+	for c in numpy.ascontiguousarray(chars.T):
+		isDigit = (c >= 48) & (c <= 57)
+		isPoint = c == 46
+		isSign = (c == 43) | (c == 45)
+		isNumber = isDigit | isPoint
+		isSeparator = numpy.zeros(numRows, dtype=bool)
+		for code in separatorCodes:
+			isSeparator|= c == code
+		bad|= ~(isNumber | isSign | isSeparator)
+		# A sign may only lead the string, and only for declinations
+		bad|= isSign & (seen | hours)
+		negative|= (c == 45) & ~seen
+		seen|= isNumber | isSign
+		field+= isNumber & ~inNumber & (field < 4)
+		inNumber = isNumber
+		digit = c - 48.
+		for k in range(3):
+			inField = field == k + 1
+			digits = isDigit & inField
+			values[k] = numpy.where(digits, values[k] * 10. + digit, values[k])
+			scales[k] = numpy.where(digits & hasPoint[k], scales[k] * 10., scales[k])
+			hasDigit[k]|= digits
+			points = isPoint & inField
+			bad|= points & hasPoint[k]
+			hasPoint[k]|= points
+	bad|= (field == 0) | (field > 3)
+	bad|= ((numpy.arange(1, 4)[:, numpy.newaxis] <= field) & ~hasDigit).any(axis=0)
+	degrees, minutes, seconds = values / scales
+	bad|= (minutes >= 60) | (seconds >= 60)
+	values = degrees + minutes / 60. + seconds / 3600.
+	if hours:
+		values*= 15.
+		bad|= values >= 360.
+	else:
+		bad|= values > 90.
+	values[negative]*= -1.
+	values[bad] = numpy.nan
+	return values, bad
+
+def parseSexagesimal(raStrings, decStrings):
+	# Whole columns of RA and DEC strings, as returned by SIMBAD, to degrees.
+	# Returns the RA and DEC arrays and a mask that is True where either value
+	# is malformed (the coordinates are NaN there).
+	ra, badRA = parseSexagesimalColumn(raStrings, True)
+	dec, badDEC = parseSexagesimalColumn(decStrings, False)
+	bad = badRA | badDEC
+	ra[bad] = numpy.nan
+	dec[bad] = numpy.nan
+	return ra, dec, bad
+
+def parseCoords(raStr, decStr):
+	ra, dec, bad = parseSexagesimal([raStr], [decStr])
+	if bad[0]:
+		raise ValueError("Cannot parse coordinates: %s %s"%(raStr, decStr))
+	return float(ra[0]), float(dec[0])
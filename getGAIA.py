@@ -1,64 +1,106 @@
 #!/usr/bin/env python3
-import astropy, astroquery
-import matplotlib.pyplot
-from matplotlib.patches import Circle
-from matplotlib.collections import PatchCollection
+import os, re, sys
+import numpy
 import gaiaClass
+import generalUtils
+import nameResolver
+import queryCache
+import batchResolver
+import backends
+import stageMetrics
 
 import argparse
 
 
-def parseCoords(raStr, decStr):
-    #print("Given coords: %s %s"%(raStr, decStr))
-    raElements = raStr.split(' ')
-    raHours = int(raElements[0])
-    raMinutes = int(raElements[1])
-    raSeconds = float(raElements[2])
-    raFraction = float(raSeconds)/3600. + float(raMinutes)/60.
-    raTotal = float(raHours) + raFraction
-    raDegrees = raTotal * 15.0
-    decElements = decStr.split(' ')
-    decDegreesString = str(decElements[0])
-    sign = decDegreesString[0]
-    decDegrees = abs(float(decElements[0]))
-    decMinutes = float(decElements[1])
-    decSeconds = float(decElements[2])
-    decCalc = decDegrees + decMinutes/60. + decSeconds/3600.
-    if sign == '-':
-        decCalc = -1.0 * decCalc
-    #print("RA:", raDegrees, "DEC:", decCalc)
-    return raDegrees, decCalc
-
-
 def showVizierCatalogs(name):
-    from astroquery.vizier import Vizier
-    Vizier.ROW_LIMIT = 50
-    from astropy import coordinates
-    from astropy import units as u
-    c = coordinates.SkyCoord(ra,dec,unit=('deg','deg'),frame='icrs')
-    results = Vizier.query_object(name)
+    results = backend.getVizier(catalog=None, rowLimit=50).query_object(name)
     return results
 
+cache = None
+# Gaia results from a --local store are read from it directly, not cached.
+gaiaCache = None
+backend = backends.astroqueryBackend()
+
 def getSimbadCoordinates(name):
-    from astroquery.simbad import Simbad
-    s = Simbad()
-    r = s.query_object(name)
-    # print(r.info())
-    ra = r['RA'][0]
-    dec = r['DEC'][0]
-    return str(ra), str(dec)
+    # RA and DEC of a single object in degrees; lists are resolved in bulk by nameResolver.
+    query = nameResolver.simbadQuery(name)
+    r = queryCache.cachedQuery(cache, query, lambda: backend.getSimbad().query_object(name))
+    if r is None or len(r) == 0:
+        raise LookupError("%s is not known to SIMBAD"%name)
+    ra, dec, bad = nameResolver.simbadCoordinates(r[:1])
+    if bad[0]:
+        raise LookupError("SIMBAD has no coordinates for %s"%name)
+    return float(ra[0]), float(dec[0])
 
 def getVizierResults(name, radius):
-    from astroquery.vizier import Vizier
     from astropy import units as u
-    v = Vizier(columns=["all"], catalog= 'I/345/gaia2')
-    v.ROW_LIMIT = 25000
-    results = v.query_object(name, catalog='I/345/gaia2', radius= radius * u.arcsec)
-    keys = results[0].keys()
-    objectList = gaiaClass.GAIAObjects(gaiaTable = results[0])
+    query = {'service': 'vizier', 'name': name, 'radius': radius, 'catalog': 'I/345/gaia2', 'columns': ["all"], 'rowLimit': 25000}
+    results = queryCache.cachedQuery(gaiaCache, query, lambda: backend.getVizier().query_object(name, catalog='I/345/gaia2', radius= radius * u.arcsec)[0])
+    keys = results.keys()
+    objectList = gaiaClass.GAIAObjects(gaiaTable = results)
 
     return objectList
 
+# The sky and proper motion plots are drawn with one collection each (not a
+# patch or arrow per star) by functions that only need an Axes and the plain
+# arrays from plotData(), so --batch can render targets in worker processes.
+
+factor = 3600   # sorta convert to arcseconds
+
+def plotData(name, simRA, simDEC, objects):
+    table = objects.GAIATable
+    def column(key):
+        if key not in table.colnames: return numpy.full(len(table), numpy.nan)
+        return numpy.ma.filled(numpy.ma.asarray(table[key], dtype=numpy.float64), numpy.nan)
+    return {'name': name, 'simRA': simRA, 'simDEC': simDEC, 'ra': column('RAJ2000'), 'dec': column('DEJ2000'), 'mag': column('Gmag'),
+            'pmRA': column('pmRA'), 'pmDE': column('pmDE'), 'plx': column('Plx'), 'e_plx': column('e_Plx')}
+
+def drawSky(axes, data, pm = False, maxLabels = None):
+    from matplotlib.collections import EllipseCollection
+    c = 20
+    m = -20/21
+    diameters = 2 * (data['mag'] * m + c) / factor
+    offsets = numpy.column_stack((data['ra'], data['dec']))
+    axes.add_collection(EllipseCollection(diameters, diameters, 0., units='xy', offsets=offsets, offset_transform=axes.transData, facecolors='k'), autolim=False)
+    finite = numpy.isfinite(offsets).all(axis=1) & numpy.isfinite(diameters)
+    corners = offsets[finite] + numpy.abs(diameters[finite, None]) / 2
+    axes.update_datalim(numpy.concatenate((corners, corners - numpy.abs(diameters[finite, None]))))
+    axes.scatter(data['simRA'], data['simDEC'], color='r', marker='+')
+    axes.set_title(data['name'])
+    axes.set_xlabel('RA (deg)')
+    axes.set_ylabel('DEC (deg)')
+    axes.axis('equal')
+    if pm:
+        axes.quiver(data['ra'], data['dec'], data['pmRA'] / factor, data['pmDE'] / factor, angles='xy', scale_units='xy', scale=1, units='xy', width=1/factor, color='r', alpha=0.4)
+        if maxLabels is None or len(data['ra']) <= maxLabels:
+            for x, y, parallax, e_p in zip(data['ra'], data['dec'], data['plx'], data['e_plx']):
+                axes.text(x, y, "%.3f[%.3f]"%(parallax, e_p))
+    axes.invert_xaxis()
+
+def drawPM(axes, data):
+    axes.scatter(data['pmRA'], data['pmDE'])
+    axes.set_title(data['name'] + "  Proper motions")
+    axes.set_xlabel('pmRA (mas/year)')
+    axes.set_ylabel('pmDEC (mas/year)')
+    axes.axis('equal')
+
+def imageName(directory, name, kind, format):
+    return os.path.join(directory, "%s_%s.%s"%(re.sub(r'[^\w+\-.]', '_', name), kind, format))
+
+def renderTarget(data, directory, format = 'jpg', pm = False, maxLabels = None):
+    # Draws one target straight to image files, without pyplot, and returns their names.
+    from matplotlib.figure import Figure
+    skyPlot = Figure(figsize=(8, 8))
+    drawSky(skyPlot.add_subplot(1, 1, 1), data, pm, maxLabels)
+    filenames = [imageName(directory, data['name'], 'sky', format)]
+    skyPlot.savefig(filenames[0])
+    if pm:
+        pmPlot = Figure(figsize=(6, 6))
+        drawPM(pmPlot.add_subplot(1, 1, 1), data)
+        filenames.append(imageName(directory, data['name'], 'pm', format))
+        pmPlot.savefig(filenames[1])
+    return filenames
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Goes to VizieR for data on GAIA objects.')
@@ -68,9 +110,23 @@ if __name__ == "__main__":
     parser.add_argument('--version', action='store_true', help='Show Astropy and Astroquery versions.')
     parser.add_argument('--pm', action='store_true', help='Plot proper motions.')
     parser.add_argument('--dump', action='store_true', help='Dump images to jpg.')
+    parser.add_argument('--local', type=str, help='Take Gaia data from this local tile store (see tileStore.py) instead of VizieR; SIMBAD is still asked for coordinates.')
+    parser.add_argument('--batch', type=str, help='Render every target to image files in this directory, without showing anything.')
+    parser.add_argument('--renderers', type=int, default=os.cpu_count(), help='Number of processes rendering images in --batch mode (default=number of CPUs).')
+    parser.add_argument('--format', type=str, default='jpg', help='Image format for --dump and --batch (default=jpg).')
+    parser.add_argument('--maxlabels', type=int, default=100, help='Only label the parallaxes in --pm plots if there are at most this many stars (default=100).')
+    queryCache.addCacheArguments(parser)
+    batchResolver.addResolverArguments(parser)
+    backends.addBackendArguments(parser)
+    stageMetrics.addMetricsArguments(parser)
     arg = parser.parse_args()
+    stageMetrics.metricsFromArguments(arg)
+    cache = queryCache.cacheFromArguments(arg)
+    backend = backends.backendFromArguments(arg, local = arg.local)
+    gaiaCache = cache if arg.local is None else None
 
     if arg.version:
+        import astropy, astroquery
         print("Astropy version: ", astropy.__version__)
         print("Astroquery version: ", astroquery.__version__)
 
@@ -85,66 +141,69 @@ if __name__ == "__main__":
     else:
         inputObjects.append(arg.object)
 
+    resolver = batchResolver.resolverFromArguments(arg)
+    targets = nameResolver.resolveNames(inputObjects, backend, cache, resolver)
+    coordinates = {str(t['Name']): (float(t['ra']), float(t['dec'])) for t in targets if t['resolved']}
+    def getCoordinates(inputObject):
+        if inputObject not in coordinates:
+            raise LookupError("%s is not known to SIMBAD"%inputObject)
+        return coordinates[inputObject]
+    def resolveObject(inputObject):
+        simRA, simDEC = getCoordinates(inputObject)
+        objects = resolver.call('vizier', getVizierResults, inputObject, arg.radius)
+        return simRA, simDEC, objects
+
+    if arg.batch is not None:
+        # Rendering overlaps with fetching: each target is handed to a worker
+        # process as soon as its data arrives. Workers are spawned rather than
+        # forked, as the resolver threads are already running.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        os.makedirs(arg.batch, exist_ok=True)
+        pool = ProcessPoolExecutor(max_workers=max(1, arg.renderers), mp_context=multiprocessing.get_context('spawn'))
+        rendering = []
+        for inputObject, (result, error) in zip(inputObjects, resolver.map(resolveObject, inputObjects)):
+            if error is not None:
+                print("Could not resolve %s: %s"%(inputObject, error))
+                continue
+            simRA, simDEC, objects = result
+            print("Name: %s    SIMBAD RA: %f, DEC: %f"%(inputObject, simRA, simDEC))
+            rendering.append(pool.submit(renderTarget, plotData(inputObject, simRA, simDEC, objects), arg.batch, arg.format, arg.pm, arg.maxlabels))
+        with stageMetrics.stage('render', rows = len(rendering)):
+            numImages = sum(len(r.result()) for r in rendering)
+        pool.shutdown()
+        print("%d images of %d targets written to %s"%(numImages, len(rendering), arg.batch))
+        sys.exit()
+
+    display = generalUtils.selectBackend()
+    import matplotlib.pyplot
     skyPlot = matplotlib.pyplot.figure(figsize=(8, 8))
     if arg.pm: pmPlot = matplotlib.pyplot.figure(figsize=(6, 6))
-    for inputObject in inputObjects:
-        ra, dec = getSimbadCoordinates(inputObject)
-        (simRA, simDEC) = parseCoords(ra, dec)
+
+    lastObjects = None
+    for inputObject, (result, error) in zip(inputObjects, resolver.map(resolveObject, inputObjects)):
+        if error is not None:
+            print("Could not resolve %s: %s"%(inputObject, error))
+            continue
+        simRA, simDEC, objects = result
+        lastObjects = objects
         print("Name: %s    SIMBAD RA: %f, DEC: %f"%(inputObject, simRA, simDEC))
-        objects = getVizierResults(inputObject, arg.radius)
-
-
-        RAs, DECs = objects.getCoords()
-        mags = objects.getMagnitudes()
-        c = 20
-        m = -20/21
-        factor = 3600   # sorta convert to arcseconds
-        radii = [(x * m + c)/factor for x in mags]
-
-        matplotlib.pyplot.figure(skyPlot.number)
-        axes = matplotlib.pyplot.gca()
-
-        patches = []
-        for x, y, r in zip(RAs, DECs, radii):
-            circle = Circle((x, y), r, color='k')
-            patches.append(circle)
-        numObjects = len(patches)
-        p = PatchCollection(patches, alpha=1.0)
-        axes.add_collection(p)
-        matplotlib.pyplot.scatter(simRA, simDEC, color='r', marker='+')
-        matplotlib.pyplot.title(inputObject)
-        matplotlib.pyplot.xlabel('RA (deg)')
-        matplotlib.pyplot.ylabel('DEC (deg)')
-        matplotlib.pyplot.axis('equal')
-        if arg.pm:
-            RApms, DECpms = objects.getPMVectors()
-            RApms =  [r/factor for r in RApms]
-            DECpms = [d/factor for d in DECpms]
-            (parallaxes, p_errors) = objects.getParallaxes()
-            for (x, y, dx, dy, parallax, e_p) in zip(RAs, DECs, RApms, DECpms, parallaxes, p_errors):
-                matplotlib.pyplot.arrow(x, y, dx, dy, hold=None, color='r', width=1/factor, alpha=0.4)
-                matplotlib.pyplot.text(x, y, "%.3f[%.3f]"%(parallax, e_p))
-            RApms, DECpms = objects.getPMVectors()
-            matplotlib.pyplot.figure(pmPlot.number)
-            matplotlib.pyplot.scatter(RApms, DECpms)
-
-            matplotlib.pyplot.title(inputObject + "  Proper motions")
-            matplotlib.pyplot.xlabel('pmRA (mas/year)')
-            matplotlib.pyplot.ylabel('pmDEC (mas/year)')
-            matplotlib.pyplot.axis('equal')
-
-
-        matplotlib.pyplot.figure(skyPlot.number)
-        matplotlib.pyplot.gca().invert_xaxis()
-        matplotlib.pyplot.show(block=False)
-        print("%d objects plotted."%numObjects)
-        input("Press Enter to continue...")
-        if arg.dump: matplotlib.pyplot.savefig("%s_sky.jpg"%inputObject)
-        matplotlib.pyplot.clf()
-        if arg.pm:
-            matplotlib.pyplot.figure(pmPlot.number)
-            if arg.dump: matplotlib.pyplot.savefig("%s_pm.jpg"%inputObject)
-            matplotlib.pyplot.clf()
-
-
-    print(objects.getTableInfo())
+
+        data = plotData(inputObject, simRA, simDEC, objects)
+        with stageMetrics.stage('render', rows = len(data['ra'])):
+            drawSky(skyPlot.gca(), data, arg.pm, arg.maxlabels)
+            if arg.pm: drawPM(pmPlot.gca(), data)
+        print("%d objects plotted."%len(data['ra']))
+        if display:
+            matplotlib.pyplot.show(block=False)
+            input("Press Enter to continue...")
+        with stageMetrics.stage('render'):
+            if arg.dump: skyPlot.savefig(imageName('.', inputObject, 'sky', arg.format))
+            skyPlot.clf()
+            if arg.pm:
+                if arg.dump: pmPlot.savefig(imageName('.', inputObject, 'pm', arg.format))
+                pmPlot.clf()
+
+
+    # The columns of the last target plotted, if any was.
+    if lastObjects is not None: print(lastObjects.getTableInfo())
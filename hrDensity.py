@@ -0,0 +1,55 @@
+import numpy
+
+# A fixed-size 2D histogram of colour (BP-RP) against absolute G magnitude.
+# Points are added a chunk at a time, partial grids from other processes can
+# be merged in, and the counts saved to and loaded from an .npz file, so an HR
+# diagram of any number of stars is drawn from a small array that can be
+# re-rendered with a different stretch without reading the data again.
+
+class hrDensityGrid:
+    def __init__(self, colourRange=(-0.6, 4.0), magRange=(0.0, 17.0), bins=(460, 680)):
+        self.colourRange = (float(colourRange[0]), float(colourRange[1]))
+        self.magRange = (float(magRange[0]), float(magRange[1]))
+        self.bins = (int(bins[0]), int(bins[1]))
+        self.counts = numpy.zeros((self.bins[1], self.bins[0]), dtype=numpy.int64)
+
+    def getTotal(self):
+        return int(self.counts.sum())
+
+    def accumulate(self, colours, absG):
+        # Points outside the grid are ignored. Returns the number of points added.
+        colours = numpy.asarray(colours, dtype=numpy.float64)
+        absG = numpy.asarray(absG, dtype=numpy.float64)
+        x = numpy.floor((colours - self.colourRange[0]) / (self.colourRange[1] - self.colourRange[0]) * self.bins[0])
+        y = numpy.floor((absG - self.magRange[0]) / (self.magRange[1] - self.magRange[0]) * self.bins[1])
+        inside = (x >= 0) & (x < self.bins[0]) & (y >= 0) & (y < self.bins[1])
+        cells = y[inside].astype(numpy.int64) * self.bins[0] + x[inside].astype(numpy.int64)
+        self.counts+= numpy.bincount(cells, minlength=self.counts.size).reshape(self.counts.shape)
+        return len(cells)
+
+    def isCompatible(self, other):
+        return self.colourRange == other.colourRange and self.magRange == other.magRange and self.bins == other.bins
+
+    def merge(self, other):
+        if not self.isCompatible(other):
+            raise ValueError("Cannot merge HR density grids with different ranges or bins")
+        self.counts+= other.counts
+        return self
+
+    def save(self, filename):
+        numpy.savez_compressed(filename, counts=self.counts, colourRange=self.colourRange, magRange=self.magRange, bins=self.bins)
+
+    @classmethod
+    def load(cls, filename):
+        saved = numpy.load(filename)
+        grid = cls(tuple(saved['colourRange']), tuple(saved['magRange']), tuple(saved['bins']))
+        grid.counts = saved['counts'].astype(numpy.int64)
+        return grid
+
+    def getExtent(self):
+        return [self.colourRange[0], self.colourRange[1], self.magRange[1], self.magRange[0]]
+
+    def render(self, axes, norm=None, cmap='Greys'):
+        # Empty cells are left transparent, as mpl_scatter_density does.
+        counts = numpy.ma.masked_equal(self.counts, 0).astype(numpy.float64)
+        return axes.imshow(counts, origin='upper', extent=self.getExtent(), aspect='auto', interpolation='nearest', norm=norm, cmap=cmap)
@@ -0,0 +1,499 @@
+import operator, os, re
+import numpy
+import crossMatch
+import stageMetrics
+
+# Runs a practical subset of ADQL on local tables (FITS files or tileStore
+# directories), so query files written for the Gaia archive can be tried out
+# against a downloaded extract. Supported:
+#
+#   SELECT [TOP n] * | alias.* | expression [AS name], ...
+#   FROM table [AS] [alias]
+#   [WHERE condition]
+#   [ORDER BY expression | position [ASC|DESC], ...]
+#
+# with arithmetic, comparisons, BETWEEN, IS [NOT] NULL, AND/OR/NOT, the usual
+# maths functions, MOD, and POINT/CIRCLE/BOX with CONTAINS and DISTANCE.
+# Conditions are evaluated column by column on whole NumPy arrays, and only
+# the columns the query refers to are read from disk.
+
+tokenPattern = re.compile(r"""\s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?) |
+    (?P<string>'(?:[^']|'')*') |
+    (?P<quoted>"[^"]+") |
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*) |
+    (?P<op><=|>=|<>|!=|\|\||[=<>+\-*/(),.])
+    )""", re.VERBOSE)
+
+keywords = {'SELECT', 'TOP', 'FROM', 'WHERE', 'ORDER', 'BY', 'ASC', 'DESC', 'AS', 'AND', 'OR', 'NOT', 'BETWEEN', 'IS', 'NULL', 'DISTINCT'}
+
+numericFunctions = {
+    'ABS': numpy.abs, 'SQRT': numpy.sqrt, 'LOG10': numpy.log10, 'LOG': numpy.log, 'EXP': numpy.exp,
+    'SIN': lambda x: numpy.sin(numpy.radians(x)), 'COS': lambda x: numpy.cos(numpy.radians(x)), 'TAN': lambda x: numpy.tan(numpy.radians(x)),
+    'ASIN': lambda x: numpy.degrees(numpy.arcsin(x)), 'ACOS': lambda x: numpy.degrees(numpy.arccos(x)), 'ATAN': lambda x: numpy.degrees(numpy.arctan(x)),
+    'ATAN2': lambda y, x: numpy.degrees(numpy.arctan2(y, x)), 'RADIANS': numpy.radians, 'DEGREES': numpy.degrees,
+    'FLOOR': numpy.floor, 'CEILING': numpy.ceil, 'ROUND': numpy.round, 'POWER': numpy.power, 'MOD': numpy.fmod,
+}
+
+# The number of coordinates each geometry takes after its optional coordinate
+# system string.
+geometryArguments = {'POINT': 2, 'CIRCLE': 3, 'BOX': 4}
+
+comparisons = {'=': operator.eq, '!=': operator.ne, '<>': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+class ADQLError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip().rstrip(';')
+    while position < len(text):
+        match = tokenPattern.match(text, position)
+        if match is None or match.end() == position:
+            if text[position:].strip() == '': break
+            raise ADQLError("Cannot parse ADQL near: %s"%text[position:position + 30])
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if re.search(r'[.eE]', value) else int(value)
+        elif kind == 'string':
+            value = value[1:-1].replace("''", "'")
+        elif kind == 'quoted':
+            kind, value = 'name', value[1:-1]
+        elif kind == 'name' and value.upper() in keywords:
+            kind, value = 'keyword', value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+class adqlParser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self, offset = 0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position+= 1
+        return token
+
+    def accept(self, kind, value = None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position+= 1
+            return True
+        return False
+
+    def expect(self, kind, value = None):
+        if not self.accept(kind, value):
+            raise ADQLError("Expected %s but found %s"%(value if value is not None else kind, self.peek()[1]))
+        return self.tokens[self.position - 1][1]
+
+    def parseQuery(self):
+        query = {'top': None, 'select': [], 'where': None, 'orderBy': []}
+        self.expect('keyword', 'SELECT')
+        if self.accept('keyword', 'DISTINCT'):
+            raise ADQLError("SELECT DISTINCT is not supported locally")
+        if self.accept('keyword', 'TOP'):
+            query['top'] = int(self.expect('number'))
+        while True:
+            query['select'].append(self.parseSelectItem())
+            if not self.accept('op', ','): break
+        self.expect('keyword', 'FROM')
+        query['table'] = self.parseTableName()
+        query['alias'] = None
+        if self.accept('keyword', 'AS') or self.peek()[0] == 'name':
+            query['alias'] = self.expect('name')
+        if self.accept('keyword', 'WHERE'):
+            query['where'] = self.parseOr()
+        if self.accept('keyword', 'ORDER'):
+            self.expect('keyword', 'BY')
+            while True:
+                expression = self.parseAdditive()
+                descending = False
+                if self.accept('keyword', 'DESC'):
+                    descending = True
+                else:
+                    self.accept('keyword', 'ASC')
+                query['orderBy'].append((self.sortKey(expression, query['select']), descending))
+                if not self.accept('op', ','): break
+        if self.peek()[0] is not None:
+            raise ADQLError("Unexpected %s at the end of the query"%self.peek()[1])
+        return query
+
+    def sortKey(self, expression, select):
+        # ORDER BY n sorts by the n-th item of the SELECT list.
+        if expression[0] != 'num': return expression
+        position = expression[1]
+        if not isinstance(position, int) or position < 1 or position > len(select):
+            raise ADQLError("ORDER BY %s is not a position in the SELECT list"%position)
+        if any(item[0] == '*' for item in select[:position]):
+            raise ADQLError("ORDER BY a position after * is not supported locally")
+        item, name = select[position - 1]
+        return ('col', name) if name is not None else item
+
+    def parseTableName(self):
+        name = self.expect('name')
+        while self.accept('op', '.'):
+            name+= '.' + self.expect('name')
+        return name
+
+    def parseSelectItem(self):
+        if self.accept('op', '*'):
+            return ('*', None)
+        if self.peek()[0] == 'name' and self.peek(1) == ('op', '.') and self.peek(2) == ('op', '*'):
+            self.position+= 3
+            return ('*', None)
+        expression = self.parseAdditive()
+        name = None
+        if self.accept('keyword', 'AS'):
+            name = self.expect('name')
+        elif self.peek()[0] == 'name':
+            name = self.next()[1]
+        if name is None:
+            name = expression[1] if expression[0] == 'col' else None
+        return (expression, name)
+
+    def parseOr(self):
+        node = self.parseAnd()
+        while self.accept('keyword', 'OR'):
+            node = ('or', node, self.parseAnd())
+        return node
+
+    def parseAnd(self):
+        node = self.parseNot()
+        while self.accept('keyword', 'AND'):
+            node = ('and', node, self.parseNot())
+        return node
+
+    def parseNot(self):
+        if self.accept('keyword', 'NOT'):
+            return ('not', self.parseNot())
+        return self.parseComparison()
+
+    def parseComparison(self):
+        node = self.parseAdditive()
+        token = self.peek()
+        if token[0] == 'op' and token[1] in comparisons:
+            self.next()
+            return ('cmp', token[1], node, self.parseAdditive())
+        negated = False
+        if token == ('keyword', 'NOT') and self.peek(1) == ('keyword', 'BETWEEN'):
+            self.next()
+            negated = True
+        if self.accept('keyword', 'BETWEEN'):
+            low = self.parseAdditive()
+            self.expect('keyword', 'AND')
+            return ('between', node, low, self.parseAdditive(), negated)
+        if self.accept('keyword', 'IS'):
+            negated = self.accept('keyword', 'NOT')
+            self.expect('keyword', 'NULL')
+            return ('isnull', node, negated)
+        return node
+
+    def parseAdditive(self):
+        node = self.parseMultiplicative()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('+', '-'):
+            node = ('bin', self.next()[1], node, self.parseMultiplicative())
+        return node
+
+    def parseMultiplicative(self):
+        node = self.parseUnary()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('*', '/'):
+            node = ('bin', self.next()[1], node, self.parseUnary())
+        return node
+
+    def parseUnary(self):
+        if self.accept('op', '-'):
+            return ('neg', self.parseUnary())
+        if self.accept('op', '+'):
+            return self.parseUnary()
+        return self.parsePrimary()
+
+    def parsePrimary(self):
+        kind, value = self.next()
+        if kind == 'number':
+            return ('num', value)
+        if kind == 'string':
+            return ('str', value)
+        if kind == 'op' and value == '(':
+            node = self.parseOr()
+            self.expect('op', ')')
+            return node
+        if kind == 'name':
+            if self.accept('op', '('):
+                arguments = []
+                if not self.accept('op', ')'):
+                    while True:
+                        arguments.append(self.parseOr())
+                        if not self.accept('op', ','): break
+                    self.expect('op', ')')
+                return ('func', value.upper(), arguments)
+            if self.accept('op', '.'):
+                value = self.expect('name')   # drop the table alias
+            return ('col', value)
+        raise ADQLError("Unexpected %s in expression"%value)
+
+
+def parseQuery(text):
+    return adqlParser(text).parseQuery()
+
+def referencedColumns(node, found = None):
+    if found is None: found = []
+    if isinstance(node, tuple):
+        if node[0] == 'col':
+            if node[1] not in found: found.append(node[1])
+            return found
+        for part in node[1:]:
+            referencedColumns(part, found)
+    elif isinstance(node, list):
+        for part in node:
+            referencedColumns(part, found)
+    return found
+
+def isConstant(node):
+    return len(referencedColumns(node)) == 0
+
+
+def coordinateArguments(name, arguments):
+    # The arguments of a POINT, CIRCLE or BOX without the coordinate system,
+    # which ADQL 2.1 makes optional.
+    if len(arguments) > 0 and arguments[0][0] == 'str':
+        arguments = arguments[1:]
+    if len(arguments) != geometryArguments[name]:
+        raise ADQLError("%s takes %d coordinates, not %d"%(name, geometryArguments[name], len(arguments)))
+    return arguments
+
+def truncatedDivide(left, right):
+    # Integer division rounding towards zero, as in the archive's PostgreSQL.
+    quotient = numpy.floor_divide(left, right)
+    inexact = (left - quotient * right != 0) & ((numpy.asarray(left) < 0) != (numpy.asarray(right) < 0))
+    return quotient + inexact
+
+
+class evaluator:
+    def __init__(self, columns, length):
+        self.columns = columns
+        self.length = length
+
+    def evaluate(self, node):
+        kind = node[0]
+        if kind in ('num', 'str'):
+            return node[1]
+        if kind == 'col':
+            if node[1] not in self.columns:
+                raise ADQLError("Unknown column %s"%node[1])
+            return self.columns[node[1]]
+        if kind == 'neg':
+            return -self.evaluate(node[1])
+        if kind == 'bin':
+            left = self.evaluate(node[2])
+            right = self.evaluate(node[3])
+            if node[1] == '+': return left + right
+            if node[1] == '-': return left - right
+            if node[1] == '*': return left * right
+            if numpy.issubdtype(numpy.asarray(left).dtype, numpy.integer) and numpy.issubdtype(numpy.asarray(right).dtype, numpy.integer):
+                return truncatedDivide(left, right)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return numpy.true_divide(left, right)
+        if kind == 'cmp':
+            with numpy.errstate(invalid='ignore'):
+                return self.broadcast(comparisons[node[1]](self.evaluate(node[2]), self.evaluate(node[3])))
+        if kind == 'between':
+            value = self.evaluate(node[1])
+            with numpy.errstate(invalid='ignore'):
+                inside = (value >= self.evaluate(node[2])) & (value <= self.evaluate(node[3]))
+            return self.broadcast(~inside if node[4] else inside)
+        if kind == 'isnull':
+            value = numpy.asarray(self.evaluate(node[1]))
+            null = numpy.ma.getmaskarray(value) if numpy.ma.isMaskedArray(value) else (numpy.isnan(value) if value.dtype.kind == 'f' else numpy.zeros(value.shape, dtype=bool))
+            return self.broadcast(~null if node[2] else null)
+        if kind == 'and':
+            return self.truth(node[1]) & self.truth(node[2])
+        if kind == 'or':
+            return self.truth(node[1]) | self.truth(node[2])
+        if kind == 'not':
+            return ~self.truth(node[1])
+        if kind == 'func':
+            return self.function(node[1], node[2])
+        raise ADQLError("Cannot evaluate %s"%kind)
+
+    def broadcast(self, value):
+        return numpy.broadcast_to(numpy.asarray(value, dtype=bool), (self.length,))
+
+    def truth(self, node):
+        value = self.evaluate(node)
+        if isinstance(value, tuple):
+            raise ADQLError("A geometry is not a condition")
+        return self.broadcast(numpy.asarray(value) != 0)
+
+    def function(self, name, arguments):
+        if name in geometryArguments:
+            # The coordinate system string is ignored, everything is ICRS.
+            values = [self.evaluate(a) for a in coordinateArguments(name, arguments)]
+            return (name,) + tuple(values)
+        values = [self.evaluate(a) for a in arguments]
+        if name == 'CONTAINS':
+            return self.contains(values[0], values[1])
+        if name == 'DISTANCE':
+            if len(values) == 4:
+                values = [('POINT', values[0], values[1]), ('POINT', values[2], values[3])]
+            return crossMatch.angularSeparation(values[0][1], values[0][2], values[1][1], values[1][2]) / 3600.
+        if name in ('COORD1', 'COORD2'):
+            return values[0][1 if name == 'COORD1' else 2]
+        if name in numericFunctions:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return numericFunctions[name](*values)
+        raise ADQLError("Unsupported function %s"%name)
+
+    def contains(self, point, region):
+        if point[0] != 'POINT':
+            raise ADQLError("CONTAINS needs a POINT as its first argument")
+        ra, dec = point[1], point[2]
+        if region[0] == 'CIRCLE':
+            inside = crossMatch.angularSeparation(region[1], region[2], ra, dec) <= region[3] * 3600.
+        elif region[0] == 'BOX':
+            # BOX(centre RA, centre DEC, width, height), taken as an RA/DEC range
+            centreRA, centreDEC, width, height = region[1:5]
+            halfWidth = width / 2. / numpy.cos(numpy.radians(centreDEC))
+            inside = (numpy.abs(dec - centreDEC) <= height / 2.) & (numpy.abs((ra - centreRA + 180.) % 360. - 180.) <= halfWidth)
+        else:
+            raise ADQLError("CONTAINS needs a CIRCLE or BOX region")
+        return numpy.asarray(inside, dtype=numpy.int32)
+
+
+def findCone(node):
+    # A CONTAINS(POINT(ra, dec), CIRCLE(constant)) term that must hold for the
+    # whole WHERE clause, returned as (raColumn, decColumn, ra, dec, radius in
+    # arcsec) so a tileStore can skip tiles that cannot match.
+    if node is None: return None
+    if node[0] == 'and':
+        return findCone(node[1]) or findCone(node[2])
+    if node[0] == 'cmp' and node[1] == '=':
+        for term, other in ((node[2], node[3]), (node[3], node[2])):
+            if other == ('num', 1) and term[0] == 'func' and term[1] == 'CONTAINS':
+                return findCone(term)
+    if node[0] == 'func' and node[1] == 'CONTAINS' and len(node[2]) == 2:
+        point, circle = node[2]
+        if point[0] == 'func' and point[1] == 'POINT' and circle[0] == 'func' and circle[1] == 'CIRCLE':
+            raColumn, decColumn = coordinateArguments('POINT', point[2])
+            centre = coordinateArguments('CIRCLE', circle[2])
+            if raColumn[0] == 'col' and decColumn[0] == 'col' and all(isConstant(a) for a in centre):
+                constants = evaluator({}, 1)
+                ra, dec, radius = [float(constants.evaluate(a)) for a in centre]
+                return (raColumn[1], decColumn[1], ra, dec, radius * 3600.)
+    return None
+
+def readSource(source, columns, cone = None):
+    # Returns a dict of the requested columns (all of them if 'columns' is None).
+    if os.path.isdir(source):
+        import tileStore
+        store = tileStore.tileStore(source)
+        coneArgument = None
+        if cone is not None and cone[0] == 'ra' and cone[1] == 'dec':
+            coneArgument = cone[2:]
+        table = store.query(columns, cone = coneArgument)
+        return {c: numpy.asarray(table[c]) for c in table.colnames}
+    from astropy.io import fits
+    hdu = fits.open(source, memmap=True)
+    data = hdu[1].data
+    if columns is None: columns = list(data.columns.names)
+    missing = [c for c in columns if c not in data.columns.names]
+    if len(missing) > 0:
+        hdu.close()
+        raise ADQLError("Unknown columns: %s"%', '.join(missing))
+    # A cone on ra/dec only reads the rows a saved sky index finds in it.
+    rows = slice(None)
+    if cone is not None and cone[0] == 'ra' and cone[1] == 'dec':
+        import skyIndex
+        index = skyIndex.skyIndex.forFile(source)
+        if index is not None and index.getLength() == len(data):
+            rows = numpy.sort(index.cone(*cone[2:])[0])
+    values = {}
+    for c in columns:
+        column = numpy.array(data[c][rows])
+        if column.dtype.kind == 'S': column = numpy.char.decode(column, 'ascii')
+        values[c] = column
+    del data
+    hdu.close()
+    return values
+
+def executeQuery(text, tables = {}, defaultSource = None):
+    # 'tables' maps table names used in FROM (e.g. gaiadr2.gaia_source) to local
+    # FITS files or tile stores; any other name goes to 'defaultSource'.
+    from astropy.table import Table
+    query = parseQuery(text)
+    source = tables.get(query['table'], defaultSource)
+    if source is None:
+        raise ADQLError("No local source for table %s"%query['table'])
+    selectAll = any(item[0] == '*' for item in query['select'])
+    aliases = [name for expression, name in query['select'] if expression != '*' and name is not None]
+    needed = referencedColumns([query['where']] + [item[0] for item in query['select'] if item[0] != '*'])
+    for expression, descending in query['orderBy']:
+        # ORDER BY may name a column of the output rather than of the table
+        if expression[0] == 'col' and expression[1] in aliases: continue
+        referencedColumns(expression, needed)
+    with stageMetrics.stage('load') as counts:
+        columns = readSource(source, None if selectAll else needed, findCone(query['where']))
+        length = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+        counts['rows'] = length
+
+    if query['where'] is not None:
+        keep = evaluator(columns, length).truth(query['where'])
+        columns = {c: values[keep] for c, values in columns.items()}
+        length = int(keep.sum())
+    rows = evaluator(columns, length)
+
+    output = {}
+    for expression, name in query['select']:
+        if expression == '*':
+            for c, values in columns.items():
+                output.setdefault(c, values)
+            continue
+        if name is None: name = 'col%d'%len(output)
+        output[name] = numpy.broadcast_to(rows.evaluate(expression), (length,)).copy()
+
+    order = numpy.arange(length)
+    for expression, descending in reversed(query['orderBy']):
+        if expression[0] == 'col' and expression[1] in output:
+            key = output[expression[1]]
+        else:
+            key = numpy.broadcast_to(rows.evaluate(expression), (length,))
+        key = key[order]
+        if descending:
+            ranks = numpy.unique(key, return_inverse=True)[1].reshape(-1)
+            order = order[numpy.argsort(-ranks, kind='stable')]
+        else:
+            order = order[numpy.argsort(key, kind='stable')]
+    if query['top'] is not None:
+        order = order[:query['top']]
+    return Table({name: values[order] for name, values in output.items()})
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs an ADQL query on local GAIA tables.')
+    parser.add_argument('adql', type=str, help='File containing ADQL query.')
+    parser.add_argument('source', type=str, help='Local FITS table or tile store to run the query on.')
+    parser.add_argument('--output', type=str, default='localsample.fits', help='Output table; .csv, .fits, .parquet or .hdf5 (default=localsample.fits).')
+    stageMetrics.addMetricsArguments(parser)
+    arg = parser.parse_args()
+    stageMetrics.metricsFromArguments(arg)
+
+    import tableExport
+    query = ""
+    for line in open(arg.adql, 'rt'):
+        text = line.strip()
+        if len(text)==0 or text[0]=='#': continue
+        query = query + ' ' + text
+    results = executeQuery(query, defaultSource = arg.source)
+    print("%d rows returned"%len(results))
+    tableExport.writeTable(arg.output, {c: results[c] for c in results.colnames})
@@ -0,0 +1,84 @@
+import numpy
+import generalUtils
+import stageMetrics
+
+# Resolves a whole target list with SIMBAD in a few query_objects requests
+# instead of one query_object per name. Each resolved name is also stored in
+# the query cache under the same key as a single lookup, so later runs and
+# getSimbadCoordinates() find it there, and only uncached names are sent.
+
+def simbadQuery(name):
+    return {'service': 'simbad', 'name': name}
+
+def simbadCoordinates(table):
+    # RA and DEC in degrees from a SIMBAD result table, which has 'ra' and
+    # 'dec' in degrees (astroquery 0.4.8 and later) or 'RA' and 'DEC' as
+    # sexagesimal strings (earlier versions). Returns ra, dec and a mask of
+    # the rows without usable coordinates.
+    if 'ra' in table.colnames and 'dec' in table.colnames:
+        ra = numpy.ma.filled(numpy.ma.asarray(table['ra'], dtype=numpy.float64), numpy.nan)
+        dec = numpy.ma.filled(numpy.ma.asarray(table['dec'], dtype=numpy.float64), numpy.nan)
+        bad = ~(numpy.isfinite(ra) & numpy.isfinite(dec))
+        return ra, dec, bad
+    return generalUtils.parseSexagesimal(table['RA'], table['DEC'])
+
+def findNameColumn(table):
+    for name in table.colnames:
+        if name.lower() in ('user_specified_id', 'typed_id'):
+            return name
+    return None
+
+def alignResults(names, table):
+    # Row of 'table' for each name (-1 where SIMBAD returned nothing).
+    rows = numpy.full(len(names), -1, dtype=numpy.int64)
+    if table is None or len(table) == 0: return rows
+    nameColumn = findNameColumn(table)
+    if nameColumn is None:
+        if len(table) != len(names):
+            raise ValueError("Cannot match %d SIMBAD rows to %d names"%(len(table), len(names)))
+        return numpy.arange(len(names))
+    index = {}
+    for row, name in enumerate(table[nameColumn]):
+        index.setdefault(' '.join(str(name).split()), row)
+    for i, name in enumerate(names):
+        rows[i] = index.get(' '.join(name.split()), -1)
+    return rows
+
+def resolveNames(names, backend, cache = None, resolver = None, chunkSize = 500):
+    # Returns a table with one row per name, in order: Name, ra, dec (degrees)
+    # and 'resolved', which is False where SIMBAD does not know the name or
+    # gave no coordinates.
+    with stageMetrics.stage('resolve', rows = len(names)):
+        return resolveTable(names, backend, cache, resolver, chunkSize)
+
+def resolveTable(names, backend, cache, resolver, chunkSize):
+    from astropy.table import Table
+    names = [str(name) for name in names]
+    ra = numpy.full(len(names), numpy.nan)
+    dec = numpy.full(len(names), numpy.nan)
+    missing = []
+    cached = cache.getMany([simbadQuery(name) for name in names]) if cache is not None else [None] * len(names)
+    for i, table in enumerate(cached):
+        if table is None or len(table) == 0:
+            missing.append(i)
+            continue
+        ra[i:i + 1], dec[i:i + 1] = simbadCoordinates(table[:1])[:2]
+    for start in range(0, len(missing), chunkSize):
+        chunk = missing[start:start + chunkSize]
+        chunkNames = [names[i] for i in chunk]
+        simbad = backend.getSimbad()
+        if resolver is not None:
+            table = resolver.call('simbad', simbad.query_objects, chunkNames)
+        else:
+            table = simbad.query_objects(chunkNames)
+        rows = alignResults(chunkNames, table)
+        found = rows >= 0
+        if not found.any(): continue
+        chunkRA, chunkDEC, bad = simbadCoordinates(table[rows[found]])
+        targets = numpy.asarray(chunk)[found]
+        ra[targets] = chunkRA
+        dec[targets] = chunkDEC
+        if cache is not None and not bad.all():
+            cache.putMany([simbadQuery(names[target]) for target in targets[~bad]], table[rows[found][~bad]])
+    resolved = numpy.isfinite(ra) & numpy.isfinite(dec)
+    return Table({'Name': names, 'ra': ra, 'dec': dec, 'resolved': resolved})
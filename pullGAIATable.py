@@ -1,104 +1,93 @@
 #!/usr/bin/env python3
-import astropy, astroquery, sys
-import matplotlib.pyplot
-from matplotlib.patches import Circle
-from matplotlib.collections import PatchCollection
+import sys, numpy
 import gaiaClass
+import nameResolver
+import queryCache
+import batchResolver
+import backends
+import bulkMatch
+import stageMetrics
 
 import argparse
 
 
-def parseCoords(raStr, decStr):
-    #print("Given coords: %s %s"%(raStr, decStr))
-    raElements = raStr.split(' ')
-    raHours = int(raElements[0])
-    raMinutes = int(raElements[1])
-    raSeconds = float(raElements[2])
-    raFraction = float(raSeconds)/3600. + float(raMinutes)/60.
-    raTotal = float(raHours) + raFraction
-    raDegrees = raTotal * 15.0
-    decElements = decStr.split(' ')
-    decDegreesString = str(decElements[0])
-    sign = decDegreesString[0]
-    decDegrees = abs(float(decElements[0]))
-    decMinutes = float(decElements[1])
-    decSeconds = float(decElements[2])
-    decCalc = decDegrees + decMinutes/60. + decSeconds/3600.
-    if sign == '-':
-        decCalc = -1.0 * decCalc
-    #print("RA:", raDegrees, "DEC:", decCalc)
-    return raDegrees, decCalc
-
-
 def showVizierCatalogs(name):
-    from astroquery.vizier import Vizier
-    Vizier.ROW_LIMIT = 50
-    from astropy import coordinates
-    from astropy import units as u
-    c = coordinates.SkyCoord(ra,dec,unit=('deg','deg'),frame='icrs')
-    results = Vizier.query_object(name)
+    results = backend.getVizier(catalog=None, rowLimit=50).query_object(name)
     return results
 
+cache = None
+# Gaia results from a --local store are read from it directly, not cached.
+gaiaCache = None
+backend = backends.astroqueryBackend()
+
 def getSimbadCoordinates(name):
-    from astroquery.simbad import Simbad
-    s = Simbad()
-    r = s.query_object(name)
-    # print(r.info())
-    ra = r['RA'][0]
-    dec = r['DEC'][0]
-    return str(ra), str(dec)
+    # RA and DEC of a single object in degrees; lists are resolved in bulk by nameResolver.
+    query = nameResolver.simbadQuery(name)
+    r = queryCache.cachedQuery(cache, query, lambda: backend.getSimbad().query_object(name))
+    if r is None or len(r) == 0:
+        raise LookupError("%s is not known to SIMBAD"%name)
+    ra, dec, bad = nameResolver.simbadCoordinates(r[:1])
+    if bad[0]:
+        raise LookupError("SIMBAD has no coordinates for %s"%name)
+    return float(ra[0]), float(dec[0])
 
 def getVizierResults(name, radius):
-    from astroquery.vizier import Vizier
     from astropy import units as u
-    v = Vizier(columns=["all"], catalog= 'I/345/gaia2')
-    v.ROW_LIMIT = 25000
-    results = v.query_object(name, catalog='I/345/gaia2', radius = radius * u.arcsec)
-    keys = results[0].keys()
-    results[0].pprint()
-    objectList = gaiaClass.GAIAObjects(gaiaTable = results[0])
+    query = {'service': 'vizier', 'name': name, 'radius': radius, 'catalog': 'I/345/gaia2', 'columns': ["all"], 'rowLimit': 25000}
+    results = queryCache.cachedQuery(gaiaCache, query, lambda: backend.getVizier().query_object(name, catalog='I/345/gaia2', radius = radius * u.arcsec)[0])
+    keys = results.keys()
+    results.pprint()
+    objectList = gaiaClass.GAIAObjects(gaiaTable = results)
 
     return objectList
 
-def getUniqueVizierResult(name, radius):
-    from astroquery.vizier import Vizier
+def getUniqueVizierResult(name, radius, targetRA = None, targetDEC = None):
     from astropy import units as u
-    v = Vizier(columns=["all"], catalog= 'I/345/gaia2')
-    v.ROW_LIMIT = 25000
-    results = v.query_object(name, catalog='I/345/gaia2')
+    if targetRA is None or targetDEC is None:
+        targetRA, targetDEC = getSimbadCoordinates(name)
+    query = {'service': 'vizier', 'name': name, 'catalog': 'I/345/gaia2', 'columns': ["all"], 'rowLimit': 25000}
+    results = queryCache.cachedQuery(gaiaCache, query, lambda: backend.getVizier().query_object(name, catalog='I/345/gaia2')[0])
     # results = v.query_object(name, catalog='I/345/gaia2', radius = radius * u.arcsec)
-    keys = results[0].keys()
-    results[0].pprint()
-    print("Number of results: %d"%len(results[0]))
-    raStr, decStr = getSimbadCoordinates(name)
-    targetRA, targetDEC = parseCoords(raStr, decStr)
+    keys = results.keys()
+    results.pprint()
+    print("Number of results: %d"%len(results))
     print("Location of %s is %f, %f"%(name, targetRA, targetDEC))
-    objectList = gaiaClass.GAIAObjects(gaiaTable = results[0])
+    objectList = gaiaClass.GAIAObjects(gaiaTable = results)
     closestMatch = objectList.calcAngularDistance(targetRA, targetDEC)
     singleResult = objectList.getObjectByDR2Name(closestMatch)
     return keys, singleResult
 
-def getRandomVizier(numResults):
-    from astroquery.vizier import Vizier
-    from astropy import units as u
-    v = Vizier(columns=["all"], catalog= 'I/345/gaia2', column_filters={"RandomI":"830339102..840339102", "e_Plx":"<0.1"})
-    v.ROW_LIMIT = numResults 
-    result = v.get_catalogs('I/345/gaia2')
-    result[0].pprint()
-    return result[0].keys(), result[0]
+def getBulkMatches(names, RAs, DECs, radius, service='vizier'):
+    query = {'service': 'bulk-' + service, 'names': list(names), 'ra': list(RAs), 'dec': list(DECs), 'radius': radius, 'catalog': 'I/345/gaia2'}
+    def fetch():
+        if service == 'tap':
+            matches, unmatched = bulkMatch.tapUploadMatch(names, RAs, DECs, radius, backend.getTap())
+        else:
+            matches, unmatched = bulkMatch.vizierMultiMatch(names, RAs, DECs, radius, backend.getVizier(rowLimit=-1))
+        return matches
+    matches = queryCache.cachedQuery(gaiaCache, query, fetch)
+    if matches is None: return None, list(names)
+    matchedNames = set(str(n) for n in matches['Name'])
+    unmatched = [name for name in names if name not in matchedNames]
+    return matches, unmatched
+
+def getRandomSample(numObjects, columns, minParallaxOverError, maxParallaxError, seed = None, magnitudeEdges = None):
+    import randomSample
+    sampler = randomSample.randomSampler(backend.getTap(), columns, minParallaxOverError, maxParallaxError, cache = gaiaCache)
+    result = sampler.sample(numObjects, seed, magnitudeEdges)
+    print("%d queries sent"%sampler.queries)
+    return result
 
 def getDR2Columns():
-    from astroquery.vizier import Vizier
     from astropy import units as u
     name = "WD 0023+388"
     radius = 30
-    v = Vizier(columns=["all"], catalog= 'I/345/gaia2')
-    v.ROW_LIMIT = 25000
-    results = v.query_object(name, catalog='I/345/gaia2', radius= radius * u.arcsec)
-    keys = results[0].keys()
-    objectList = gaiaClass.GAIAObjects(gaiaTable = results[0])
+    query = {'service': 'vizier', 'name': name, 'radius': radius, 'catalog': 'I/345/gaia2', 'columns': ["all"], 'rowLimit': 25000}
+    results = queryCache.cachedQuery(gaiaCache, query, lambda: backend.getVizier().query_object(name, catalog='I/345/gaia2', radius= radius * u.arcsec)[0])
+    keys = results.keys()
+    objectList = gaiaClass.GAIAObjects(gaiaTable = results)
 
-    return results[0].info()
+    return results.info()
 
 
 if __name__ == "__main__":
@@ -107,27 +96,34 @@ if __name__ == "__main__":
     parser.add_argument('columns', type=str, help='A text file containing a list of column names.')
     
     parser.add_argument('--list', action='store_true', help="Object is a file containing a list of objects.")
+    parser.add_argument('--bulk', type=str, choices=['vizier', 'tap'], help="Cross-match all objects in one request to VizieR or the Gaia archive (TAP upload).")
+    parser.add_argument('--radius', type=float, default=10.0, help='Match radius in arcseconds for --bulk (default=10).')
+    parser.add_argument('--output', type=str, default='pcebs.csv', help='Output table; .csv, .fits, .parquet or .hdf5 (default=pcebs.csv, sample.csv for random).')
     parser.add_argument('--version', action='store_true', help='Show Astropy and Astroquery versions.')
+    parser.add_argument('--local', type=str, help='Take Gaia data from this local tile store (see tileStore.py) instead of VizieR and the Gaia archive; SIMBAD is still asked for coordinates.')
+    parser.add_argument('--incremental', action='store_true', help='Only resolve and match the targets not already in the results ledger, and rebuild the output from it.')
+    parser.add_argument('--ledger', type=str, help='Results ledger for --incremental (default=<output>.ledger.json).')
+    parser.add_argument('--retry', action='store_true', help='With --incremental, also try again the targets that could not be resolved or matched before.')
+    parser.add_argument('--sample', type=int, default=100, help='Number of objects in a random sample (default=100).')
+    parser.add_argument('--minpoe', type=float, default=20., help='Smallest parallax over error in a random sample (default=20).')
+    parser.add_argument('--maxplxerror', type=float, default=0.1, help='Largest parallax error in mas in a random sample (default=0.1).')
+    parser.add_argument('--seed', type=int, help='Seed for a reproducible random sample.')
+    parser.add_argument('--strata', type=float, nargs='+', help='G magnitude bin edges; the random sample is split evenly between the bins.')
+    queryCache.addCacheArguments(parser)
+    batchResolver.addResolverArguments(parser)
+    backends.addBackendArguments(parser)
+    stageMetrics.addMetricsArguments(parser)
     arg = parser.parse_args()
-
-    import astropy.units as u
-    from astropy.coordinates import SkyCoord
-    from astroquery.gaia import Gaia
-
-    coord = SkyCoord(ra=280, dec=-60, unit=(u.degree, u.degree), frame='icrs')
-    width = u.Quantity(0.1, u.deg)
-    height = u.Quantity(0.1, u.deg)
-    #r = Gaia.query_object_async(coordinate=coord, width=width, height=height)
-    #r.pprint()
-    #job = Gaia.launch_job_async("select top 100 * from gaiadr2.gaia_source as gaia order by source_id where gaia.parallax/gaia.parallax_error >= 5")
-    job = Gaia.launch_job_async("SELECT TOP 100 * FROM gaiadr2.gaia_source as g WHERE g.parallax_over_error >= 20 AND MOD(g.random_index, 100) = 0")
-    r = job.get_results()
-    print(r.keys())
-    print(r['source_id'], r['parallax_over_error'], r['phot_g_mean_mag'])
-    sys.exit()
-
+    stageMetrics.metricsFromArguments(arg)
+    cache = queryCache.cacheFromArguments(arg)
+    backend = backends.backendFromArguments(arg, local = arg.local)
+    gaiaCache = cache if arg.local is None else None
+    if arg.local is not None and arg.bulk == 'tap':
+        print("A local store cannot take a TAP upload; matching with one cone search per target instead.")
+        arg.bulk = 'vizier'
 
     if arg.version:
+        import astropy, astroquery
         print("Astropy version: ", astropy.__version__)
         print("Astroquery version: ", astroquery.__version__)
         sys.exit()
@@ -159,27 +155,89 @@ if __name__ == "__main__":
     print(columns)
 
     if arg.object=='random':
-        numObjects = 100
-        print("Getting %d random objects"%numObjects)
-        keys, results = getRandomVizier(numObjects)
+        numObjects = arg.sample
+        seed = arg.seed if arg.seed is not None else int(numpy.random.SeedSequence().entropy % 2**32)
+        print("Getting %d random objects (seed %d)"%(numObjects, seed))
+        results = getRandomSample(numObjects, columns, arg.minpoe, arg.maxplxerror, seed, arg.strata)
         randomTable = gaiaClass.gaiaTABLE()
-        for r in results: 
-            print(r['DR2Name'], r['Plx'], r['e_Plx'], r['Plx']/r['e_Plx'])
-            if r['Plx']/r['e_Plx'] > 20: 
-                randomTable.addItem('random', keys, r)
-        print("Found %d eligible objects"%randomTable.getLength())
         randomTable.setColumns(columns)
-        randomTable.writeAsCSV('sample.csv')
+        if results is not None:
+            for r in results:
+                print(r['DR2Name'], r['Plx'], r['e_Plx'], r['Plx']/r['e_Plx'])
+            with stageMetrics.stage('table', rows = len(results)):
+                randomTable.addRows(['random'] * len(results), results)
+        print("Found %d eligible objects"%randomTable.getLength())
+        randomTable.write('sample.csv' if arg.output=='pcebs.csv' else arg.output)
         sys.exit()
 
     resultsTable = gaiaClass.gaiaTABLE()
     resultsTable.setColumns(columns)
-    for inputObject in inputObjects:
-        ra, dec = getSimbadCoordinates(inputObject)
-        (simRA, simDEC) = parseCoords(ra, dec)
-        print("Name: %s    SIMBAD RA: %f, DEC: %f"%(inputObject, simRA, simDEC))
-        keys, closestMatch = getUniqueVizierResult(inputObject, 10)
-        resultsTable.addItem(inputObject, keys, closestMatch)
+    ledger = None
+    allObjects = inputObjects
+    if arg.incremental:
+        import resultsLedger
+        settings = {'columns': columns, 'bulk': arg.bulk, 'radius': arg.radius if arg.bulk is not None else None, 'local': arg.local}
+        ledger = resultsLedger.resultsLedger(arg.ledger if arg.ledger is not None else arg.output + '.ledger.json', settings)
+        inputObjects = ledger.pending(allObjects, arg.retry)
+        print("%d of %d targets are new or changed"%(len(inputObjects), len(allObjects)))
+    def writeResults():
+        if ledger is not None:
+            ledger.write()
+            with stageMetrics.stage('table') as counts:
+                counts['rows'] = ledger.addRows(allObjects, resultsTable, columns)
+        resultsTable.dumpTable()
+        resultsTable.write(arg.output)
+    if ledger is not None and len(inputObjects) == 0:
+        writeResults()
+        sys.exit()
 
-    resultsTable.dumpTable()
-    resultsTable.writeAsCSV('pcebs.csv')
\ No newline at end of file
+    resolver = batchResolver.resolverFromArguments(arg)
+    targets = nameResolver.resolveNames(inputObjects, backend, cache, resolver)
+    coordinates = {str(t['Name']): (float(t['ra']), float(t['dec'])) for t in targets if t['resolved']}
+    def getCoordinates(inputObject):
+        if inputObject not in coordinates:
+            raise LookupError("%s is not known to SIMBAD"%inputObject)
+        return coordinates[inputObject]
+    if arg.bulk is not None:
+        for name in targets['Name'][~targets['resolved']]:
+            print("Could not resolve %s: not known to SIMBAD"%name)
+            if ledger is not None: ledger.record(str(name), 'unresolved')
+        resolved = targets[targets['resolved']]
+        names, RAs, DECs = [str(name) for name in resolved['Name']], numpy.array(resolved['ra']), numpy.array(resolved['dec'])
+        matches, unmatched = resolver.call(arg.bulk, getBulkMatches, names, RAs, DECs, arg.radius, arg.bulk)
+        for name in unmatched:
+            print("No Gaia match within %.1f arcseconds of %s"%(arg.radius, name))
+            if ledger is not None: ledger.record(name, 'unmatched', *coordinates[name])
+        if matches is not None:
+            with stageMetrics.stage('table', rows = len(matches)):
+                for row in matches:
+                    if ledger is not None:
+                        ledger.record(str(row['Name']), 'matched', *coordinates[str(row['Name'])], row = row, columns = columns)
+                    else:
+                        resultsTable.addItem(str(row['Name']), matches.keys(), row)
+        writeResults()
+        sys.exit()
+
+    def resolveObject(inputObject):
+        simRA, simDEC = getCoordinates(inputObject)
+        print("Name: %s    SIMBAD RA: %f, DEC: %f"%(inputObject, simRA, simDEC))
+        return resolver.call('vizier', getUniqueVizierResult, inputObject, 10, simRA, simDEC)
+
+    for inputObject, (result, error) in zip(inputObjects, resolver.map(resolveObject, inputObjects)):
+        if error is not None:
+            print("Could not resolve %s: %s"%(inputObject, error))
+            if ledger is None: continue
+            # Network errors are left for the next run to try again.
+            if inputObject not in coordinates:
+                ledger.record(inputObject, 'unresolved')
+            elif isinstance(error, (LookupError, IndexError)):
+                ledger.record(inputObject, 'unmatched', *coordinates[inputObject])
+            continue
+        keys, closestMatch = result
+        if ledger is not None:
+            ledger.record(inputObject, 'matched', *coordinates[inputObject], row = closestMatch, columns = columns)
+            continue
+        with stageMetrics.stage('table', rows = 1):
+            resultsTable.addItem(inputObject, keys, closestMatch)
+
+    writeResults()
\ No newline at end of file
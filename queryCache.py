@@ -0,0 +1,259 @@
+import atexit, contextlib, hashlib, json, os, tempfile, threading, time
+import stageMetrics
+
+# An on-disk cache for SIMBAD and VizieR results. Each result table is kept as
+# a FITS file named after a hash of the normalized query (results stored in
+# bulk with putMany() share one file, one row per query); index.json records
+# its size, creation and last access time so that stale entries expire after
+# 'ttl' seconds and the least recently used ones are evicted once the cache
+# grows past 'maxBytes'. Changes to the index are kept in memory and written
+# every 'flushEvery' changes and when the program exits, so that a run with
+# many lookups does not rewrite the whole index for each one. Several runs may
+# share the cache: each writes only its own changes, merged into index.json
+# as it is on disk, under a lock file.
+
+defaultDirectory = os.path.join(os.path.expanduser('~'), '.cache', 'gaiaDR2')
+
+def normalizeValue(value):
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(float(value), 7)
+    if isinstance(value, (list, tuple)):
+        return [normalizeValue(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): normalizeValue(v) for k, v in value.items()}
+    if hasattr(value, 'item'):
+        return normalizeValue(value.item())
+    return value
+
+def makeKey(query):
+    normalized = json.dumps(normalizeValue(query), sort_keys=True)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class queryCache:
+    def __init__(self, directory = None, ttl = 30 * 86400., maxBytes = 1024**3, flushEvery = 1000):
+        if directory is None: directory = defaultDirectory
+        self.directory = directory
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.flushEvery = flushEvery
+        self.lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.indexFilename = os.path.join(self.directory, 'index.json')
+        self.index = self.readIndex()
+        self.totalBytes = self.getTotalBytes()
+        self.changes = 0
+        self.updated = {}
+        self.removed = set()
+        atexit.register(self.flush)
+
+    def readIndex(self):
+        try:
+            with open(self.indexFilename, 'rt') as indexFile:
+                return json.load(indexFile)
+        except (OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def lockIndex(self):
+        # Keeps other processes out of index.json (where fcntl is available).
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(self.indexFilename + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def mergeIndex(self):
+        # Applies the changes made here to the index on disk, which other runs
+        # may have changed in the meantime.
+        index = self.readIndex()
+        for key in self.removed:
+            index.pop(key, None)
+        for key, entry in self.updated.items():
+            old = index.get(key)
+            if old is not None and old['created'] > entry['created']:
+                entry = old
+            elif old is not None:
+                entry = dict(entry, accessed = max(entry['accessed'], old['accessed']))
+            index[key] = entry
+        self.index = index
+        self.totalBytes = self.getTotalBytes()
+
+    def writeIndex(self):
+        with self.lockIndex():
+            self.mergeIndex()
+            self.expire()
+            self.evict()
+            self.saveIndex()
+
+    def saveIndex(self):
+        handle, tempName = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wt') as indexFile:
+            json.dump(self.index, indexFile)
+        os.replace(tempName, self.indexFilename)
+        self.changes = 0
+        self.updated = {}
+        self.removed = set()
+
+    def touch(self, key):
+        self.updated[key] = self.index[key]
+        self.removed.discard(key)
+
+    def changed(self):
+        self.changes+= 1
+        if self.changes >= self.flushEvery:
+            self.writeIndex()
+
+    def flush(self):
+        with self.lock:
+            if self.changes > 0: self.writeIndex()
+
+    def getFilename(self, key):
+        return os.path.join(self.directory, key + '.fits')
+
+    def getTotalBytes(self):
+        return sum(entry['bytes'] for entry in self.index.values())
+
+    def remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None: return
+        self.updated.pop(key, None)
+        self.removed.add(key)
+        self.totalBytes-= entry['bytes']
+        self.changes+= 1
+        try:
+            os.remove(self.getFilename(key))
+        except OSError:
+            pass
+
+    def get(self, query):
+        return self.getMany([query])[0]
+
+    def getMany(self, queries):
+        # One table (or None) per query. Results stored together by putMany()
+        # share a file, which is read only once.
+        from astropy.table import Table
+        keys = [makeKey(query) for query in queries]
+        results = [None] * len(keys)
+        with self.lock:
+            now = time.time()
+            wanted = {}
+            for i, key in enumerate(keys):
+                entry = self.index.get(key)
+                if entry is None: continue
+                if self.ttl is not None and now - entry['created'] > self.ttl:
+                    self.remove(key)
+                    continue
+                entry['accessed'] = now
+                self.touch(key)
+                wanted.setdefault(entry.get('table', key), []).append((i, entry.get('row')))
+            for fileKey, rows in wanted.items():
+                try:
+                    with stageMetrics.stage('cache') as counts:
+                        table = Table.read(self.getFilename(fileKey), format='fits', unit_parse_strict='silent')
+                        counts['rows'] = len(rows) if rows[0][1] is not None else len(table)
+                        counts['bytes'] = self.index[fileKey]['bytes'] if fileKey in self.index else 0
+                except (OSError, ValueError):
+                    self.remove(fileKey)
+                    for i, row in rows: self.remove(keys[i])
+                    continue
+                if fileKey in self.index:
+                    self.index[fileKey]['accessed'] = now
+                    self.touch(fileKey)
+                for i, row in rows:
+                    results[i] = table if row is None else table[[row]]
+            if len(wanted) > 0: self.changed()
+        return results
+
+    def writeTable(self, key, query, table):
+        # Writes one cache file and its index entry; returns False if the
+        # table cannot be stored as FITS.
+        table = table.copy(copy_data=False)
+        table.meta.clear()
+        handle, tempName = tempfile.mkstemp(dir=self.directory, suffix='.fits')
+        os.close(handle)
+        try:
+            table.write(tempName, format='fits', overwrite=True)
+        except (ValueError, TypeError, UnicodeEncodeError) as e:
+            os.remove(tempName)
+            print("Not caching query %s: %s"%(query, e))
+            return False
+        self.remove(key)
+        os.replace(tempName, self.getFilename(key))
+        now = time.time()
+        self.index[key] = {'query': normalizeValue(query), 'bytes': os.path.getsize(self.getFilename(key)), 'created': now, 'accessed': now}
+        self.totalBytes+= self.index[key]['bytes']
+        self.touch(key)
+        return True
+
+    def put(self, query, table):
+        with self.lock:
+            if self.writeTable(makeKey(query), query, table):
+                self.evict()
+                self.changed()
+
+    def putMany(self, queries, table):
+        # Stores row i of 'table' as the result of queries[i], all in one file.
+        if len(queries) == 0: return
+        keys = [makeKey(query) for query in queries]
+        tableKey = makeKey({'rows': keys})
+        with self.lock:
+            if not self.writeTable(tableKey, {'rows': len(keys)}, table): return
+            now = time.time()
+            for row, (key, query) in enumerate(zip(keys, queries)):
+                self.remove(key)
+                self.index[key] = {'query': normalizeValue(query), 'table': tableKey, 'row': row, 'bytes': 0, 'created': now, 'accessed': now}
+                self.touch(key)
+            self.changes+= len(keys)
+            self.evict()
+            self.changed()
+
+    def expire(self):
+        if self.ttl is None: return
+        now = time.time()
+        for key in [k for k, entry in self.index.items() if now - entry['created'] > self.ttl]:
+            self.remove(key)
+
+    def evict(self):
+        # Least recently used entries go first; the index is only sorted when
+        # the cache has actually grown past 'maxBytes'.
+        if self.maxBytes is None or self.totalBytes <= self.maxBytes: return
+        self.expire()
+        for key in sorted(self.index, key=lambda k: self.index[k]['accessed']):
+            if self.totalBytes <= self.maxBytes: break
+            self.remove(key)
+
+    def clear(self):
+        with self.lock, self.lockIndex():
+            self.mergeIndex()
+            for key in list(self.index):
+                self.remove(key)
+            self.saveIndex()
+
+
+def cachedQuery(cache, query, fetch):
+    # Returns the cached table for 'query', or calls fetch() and stores its result.
+    if cache is None: return fetch()
+    table = cache.get(query)
+    if table is not None: return table
+    table = fetch()
+    if table is not None: cache.put(query, table)
+    return table
+
+def addCacheArguments(parser):
+    parser.add_argument('--cache', type=str, default=defaultDirectory, help='Directory for the local query cache (default=%s).'%defaultDirectory)
+    parser.add_argument('--cachettl', type=float, default=30., help='Days before a cached query expires (default=30).')
+    parser.add_argument('--cachesize', type=float, default=1024., help='Maximum size of the query cache in MB (default=1024).')
+    parser.add_argument('--nocache', action='store_true', help='Always go to the network, bypassing the local query cache.')
+
+def cacheFromArguments(arg):
+    if arg.nocache: return None
+    return queryCache(arg.cache, ttl = arg.cachettl * 86400., maxBytes = int(arg.cachesize * 1024**2))
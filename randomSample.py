@@ -0,0 +1,104 @@
+import numpy
+import adqlJobs
+import gaiaColumns
+import queryCache
+
+# Draws a random sample of Gaia DR2 sources that pass a parallax selection,
+# with the whole selection done by the archive. random_index is a random
+# permutation of the catalogue, so the eligible sources in a run of
+# random_index values are a random sample. Starting from a seeded point, runs
+# are requested in random_index order, each as wide as the eligible fraction
+# seen so far suggests is needed, until exactly the number asked for has come
+# back; TOP keeps the last run from returning more than that. With magnitude
+# edges, the sample is split evenly between the G magnitude bins. The archive
+# cuts synchronous results off at 'syncLimit' rows, which would look like the
+# end of a run, so larger pages are fetched as asynchronous jobs.
+
+syncLimit = 2000
+
+def selectColumns(columns):
+    # Archive columns to ask for, given the VizieR-style names of the output.
+    names = ['random_index', 'designation', 'parallax', 'parallax_error']
+    for column in columns:
+        if column in ('RAJ2000', 'DEJ2000'):
+            names+= ['ra', 'dec', 'pmra', 'pmdec']
+        else:
+            names.append(gaiaColumns.toArchiveName(column))
+    return list(dict.fromkeys(names))
+
+def sampleQuery(select, low, high, top, minParallaxOverError = None, maxParallaxError = None, magnitudes = None):
+    conditions = ["random_index BETWEEN %d AND %d"%(low, high)]
+    if maxParallaxError is not None:
+        conditions.append("parallax_error < %r"%float(maxParallaxError))
+    if minParallaxOverError is not None:
+        conditions.append("parallax / parallax_error > %r"%float(minParallaxOverError))
+    if magnitudes is not None:
+        conditions.append("phot_g_mean_mag >= %r AND phot_g_mean_mag < %r"%(float(magnitudes[0]), float(magnitudes[1])))
+    return "SELECT TOP %d %s FROM gaiadr2.gaia_source WHERE %s ORDER BY random_index"%(top, ', '.join(select), ' AND '.join(conditions))
+
+
+class randomSampler:
+    def __init__(self, tap, columns, minParallaxOverError = 20., maxParallaxError = 0.1, cache = None, pageSize = 50000, initialWidth = 1000, indexRange = adqlJobs.splitRanges['random_index']):
+        self.tap = tap
+        self.select = selectColumns(columns)
+        self.minParallaxOverError = minParallaxOverError
+        self.maxParallaxError = maxParallaxError
+        self.cache = cache
+        self.pageSize = pageSize
+        self.initialWidth = initialWidth
+        self.low, self.high = indexRange
+        self.queries = 0
+
+    def fetch(self, low, high, top, magnitudes):
+        query = sampleQuery(self.select, low, high, top, self.minParallaxOverError, self.maxParallaxError, magnitudes)
+        self.queries+= 1
+        launch = self.tap.launch_job if top <= syncLimit else self.tap.launch_job_async
+        return queryCache.cachedQuery(self.cache, {'service': 'tap', 'query': query}, lambda: launch(query).get_results())
+
+    def sampleRange(self, numObjects, start, magnitudes = None):
+        # The first 'numObjects' eligible sources at or after random_index
+        # 'start', wrapping round to the bottom of the range. Fewer come back
+        # only if the whole catalogue has fewer.
+        total = self.high - self.low + 1
+        parts = []
+        found = 0
+        covered = 0
+        position = start
+        width = numObjects * self.initialWidth
+        while found < numObjects and covered < total:
+            width = max(1, min(width, total - covered))
+            end = position + width - 1
+            runs = [(position, min(end, self.high))]
+            if end > self.high: runs.append((self.low, self.low + end - self.high - 1))
+            for low, high in runs:
+                while low <= high and found < numObjects:
+                    top = min(numObjects - found, self.pageSize)
+                    table = self.fetch(low, high, top, magnitudes)
+                    if len(table) > 0: parts.append(table)
+                    found+= len(table)
+                    if len(table) < top: break
+                    low = int(table['random_index'][-1]) + 1
+                if found >= numObjects: break
+            covered+= width
+            position = self.low + (end + 1 - self.low) % total
+            # Aim the next run at the rest of the sample, with a margin; while
+            # nothing has been found, widen quickly.
+            rate = found / covered
+            width = int((numObjects - found) / rate * 1.2) + 1 if rate > 0 else width * 8
+        return parts
+
+    def sample(self, numObjects, seed = None, magnitudeEdges = None):
+        # Returns the sample as a table with VizieR column names.
+        from astropy.table import vstack
+        start = int(numpy.random.default_rng(seed).integers(self.low, self.high + 1))
+        if magnitudeEdges is None or len(magnitudeEdges) < 2:
+            parts = self.sampleRange(numObjects, start)
+        else:
+            bins = list(zip(magnitudeEdges[:-1], magnitudeEdges[1:]))
+            counts = [numObjects // len(bins) + (1 if i < numObjects % len(bins) else 0) for i in range(len(bins))]
+            parts = []
+            for magnitudes, count in zip(bins, counts):
+                if count > 0: parts+= self.sampleRange(count, start, magnitudes)
+        if len(parts) == 0:
+            return None
+        return gaiaColumns.toVizierTable(vstack(parts, metadata_conflicts='silent'))
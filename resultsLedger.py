@@ -0,0 +1,66 @@
+import json, time
+import numpy
+import queryCache
+import tableExport
+
+# Remembers, for each target name, where SIMBAD put it and the Gaia row it was
+# matched to, so a growing target list only costs the new names on a re-run.
+# Entries are tied to the settings they were made with (columns, match mode,
+# radius, data source); an entry made with other settings is fetched again.
+# Names SIMBAD does not know, or with no Gaia match, are remembered too and
+# only retried when asked. The ledger is JSON, rewritten atomically.
+
+def jsonValue(value):
+    if value is numpy.ma.masked: return None
+    if isinstance(value, bytes): return value.decode('utf-8', 'replace')
+    if isinstance(value, numpy.generic): return value.item()
+    return value
+
+def rowValue(value):
+    return numpy.ma.masked if value is None else value
+
+
+class resultsLedger:
+    def __init__(self, filename, settings):
+        self.filename = filename
+        self.settings = queryCache.makeKey(settings)
+        self.entries = self.read()
+
+    def read(self):
+        try:
+            with open(self.filename, 'rt') as ledgerFile:
+                return json.load(ledgerFile)['targets']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def write(self):
+        with tableExport.atomicOutput(self.filename) as tempName:
+            with open(tempName, 'wt') as ledgerFile:
+                json.dump({'targets': self.entries}, ledgerFile, indent=1)
+
+    def isCurrent(self, name, retry = False):
+        entry = self.entries.get(name)
+        if entry is None or entry['settings'] != self.settings: return False
+        return entry['status'] == 'matched' or not retry
+
+    def pending(self, names, retry = False):
+        # The names that have to be resolved and matched (again), in order.
+        return [name for name in dict.fromkeys(names) if not self.isCurrent(name, retry)]
+
+    def record(self, name, status, ra = None, dec = None, row = None, columns = None):
+        # 'status' is 'matched' (with the row), 'unmatched' or 'unresolved'.
+        entry = {'settings': self.settings, 'status': status, 'updated': time.time()}
+        if ra is not None: entry['ra'], entry['dec'] = float(ra), float(dec)
+        if row is not None: entry['row'] = {col: jsonValue(row[col]) for col in columns}
+        self.entries[name] = entry
+
+    def addRows(self, names, resultsTable, columns):
+        # Adds the matched rows of 'names' to a gaiaTABLE, in the order given;
+        # returns the number added.
+        added = 0
+        for name in dict.fromkeys(names):
+            entry = self.entries.get(name)
+            if entry is None or entry['status'] != 'matched': continue
+            resultsTable.addItem(name, columns, {col: rowValue(entry['row'].get(col)) for col in columns})
+            added+= 1
+        return added
@@ -0,0 +1,129 @@
+import os, zipfile
+import numpy
+import crossMatch
+
+# A k-d tree over unit vectors on the celestial sphere. Angular radii are
+# turned into chord lengths so the tree can answer cone, box and k-nearest
+# neighbour queries without scanning the whole table. save() keeps the
+# coordinates next to their data file, and forFile() rebuilds the tree from
+# them for queries on that file (localADQL.py uses it for CONTAINS cones on
+# FITS tables). The tree itself is not saved: a pickled cKDTree may not load
+# under another scipy, and rebuilding it is quick.
+
+def unitVectors(RAs, DECs):
+    ra = numpy.radians(numpy.asarray(RAs, dtype=numpy.float64))
+    dec = numpy.radians(numpy.asarray(DECs, dtype=numpy.float64))
+    cosDec = numpy.cos(dec)
+    return numpy.column_stack((cosDec * numpy.cos(ra), cosDec * numpy.sin(ra), numpy.sin(dec)))
+
+def arcsecToChord(radius):
+    theta = numpy.radians(numpy.minimum(numpy.asarray(radius, dtype=numpy.float64), 648000.) / 3600.)
+    return 2 * numpy.sin(theta / 2)
+
+def findCoordinateColumns(columnNames):
+    for raKey, decKey in [('ra', 'dec'), ('RAJ2000', 'DEJ2000'), ('RA_ICRS', 'DE_ICRS')]:
+        if raKey in columnNames and decKey in columnNames:
+            return raKey, decKey
+    raise KeyError("No RA/DEC columns found in: %s"%', '.join(columnNames))
+
+
+class skyIndex:
+    def __init__(self, RAs, DECs, source = None):
+        from scipy.spatial import cKDTree
+        self.RAs = numpy.asarray(RAs, dtype=numpy.float64)
+        self.DECs = numpy.asarray(DECs, dtype=numpy.float64)
+        self.source = source
+        self.tree = cKDTree(unitVectors(self.RAs, self.DECs), balanced_tree=False, compact_nodes=False)
+
+    @classmethod
+    def fromFITS(cls, filename, raKey = None, decKey = None):
+        from astropy.io import fits
+        hdu = fits.open(filename, memmap=True)
+        data = hdu[1].data
+        if raKey is None or decKey is None:
+            raKey, decKey = findCoordinateColumns(data.columns.names)
+        RAs = numpy.array(data[raKey], dtype=numpy.float64)
+        DECs = numpy.array(data[decKey], dtype=numpy.float64)
+        hdu.close()
+        return cls(RAs, DECs, source = filename)
+
+    @classmethod
+    def load(cls, filename):
+        with numpy.load(filename) as saved:
+            source = str(saved['source']) if 'source' in saved.files else None
+            return cls(saved['ra'], saved['dec'], source = source)
+
+    @classmethod
+    def forFile(cls, dataFilename):
+        # The saved index of a data file, or None if there is none or the file
+        # has changed since it was saved.
+        filename = skyIndex.defaultFilename(dataFilename)
+        try:
+            if os.path.getmtime(filename) < os.path.getmtime(dataFilename): return None
+            return cls.load(filename)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+
+    @staticmethod
+    def defaultFilename(dataFilename):
+        return dataFilename + '.idx.npz'
+
+    def save(self, filename = None):
+        if filename is None:
+            filename = skyIndex.defaultFilename(self.source)
+        numpy.savez(filename, ra=self.RAs, dec=self.DECs, source=str(self.source))
+        return filename
+
+    def getLength(self):
+        return len(self.RAs)
+
+    def cone(self, ra, dec, radius):
+        # Rows within 'radius' arcseconds of (ra, dec), sorted by separation.
+        rows = numpy.array(self.tree.query_ball_point(unitVectors(ra, dec)[0], arcsecToChord(radius) * (1 + 1e-9)), dtype=numpy.int64)
+        separations = crossMatch.angularSeparation(ra, dec, self.RAs[rows], self.DECs[rows])
+        keep = separations <= radius
+        rows = rows[keep]
+        separations = separations[keep]
+        order = numpy.argsort(separations, kind='stable')
+        return rows[order], separations[order]
+
+    def cones(self, targetRAs, targetDECs, radius):
+        # Batched cone search, one (rows, separations) pair per target.
+        return [self.cone(ra, dec, radius) for ra, dec in zip(numpy.atleast_1d(targetRAs), numpy.atleast_1d(targetDECs))]
+
+    def box(self, raMin, raMax, decMin, decMax):
+        # Rows inside an RA/DEC box in degrees. raMin > raMax means the box
+        # wraps through RA=0. The box is covered by a cone first, its radius
+        # taken from points sampled along the edges plus a small margin.
+        raWidth = (raMax - raMin) % 360.
+        if raWidth == 0 and raMax != raMin: raWidth = 360.
+        raCentre = (raMin + raWidth / 2.) % 360.
+        decCentre = (decMin + decMax) / 2.
+        samples = numpy.linspace(0., 1., 65)
+        edgeRAs = numpy.concatenate((raMin + raWidth * samples, raMin + raWidth * samples, numpy.full(65, raMin), numpy.full(65, raMin + raWidth)))
+        edgeDECs = numpy.concatenate((numpy.full(65, decMin), numpy.full(65, decMax), decMin + (decMax - decMin) * samples, decMin + (decMax - decMin) * samples))
+        radius = numpy.max(crossMatch.angularSeparation(raCentre, decCentre, edgeRAs, edgeDECs)) * 1.01 + 60.
+        if radius >= 324000.:
+            rows = numpy.arange(self.getLength())
+        else:
+            rows, separations = self.cone(raCentre, decCentre, radius)
+        RAs = self.RAs[rows]
+        DECs = self.DECs[rows]
+        inside = (DECs >= decMin) & (DECs <= decMax) & (((RAs - raMin) % 360.) <= raWidth)
+        return numpy.sort(rows[inside])
+
+    def nearest(self, targetRAs, targetDECs, k = 1, radius = None):
+        # The k nearest rows for each target. Returns arrays of shape (n, k) of
+        # row indices and separations in arcsec; missing neighbours (fewer than
+        # k rows, or outside 'radius') have index -1 and separation NaN.
+        upperBound = numpy.inf if radius is None else arcsecToChord(radius) * (1 + 1e-9)
+        distances, rows = self.tree.query(unitVectors(targetRAs, targetDECs), k=k, distance_upper_bound=upperBound)
+        rows = numpy.asarray(rows).reshape(-1, k)
+        missing = rows >= self.getLength()
+        rows = numpy.where(missing, -1, rows)
+        safeRows = numpy.where(missing, 0, rows)
+        targetRAs = numpy.atleast_1d(targetRAs)[:, None]
+        targetDECs = numpy.atleast_1d(targetDECs)[:, None]
+        separations = crossMatch.angularSeparation(targetRAs, targetDECs, self.RAs[safeRows], self.DECs[safeRows])
+        separations[missing] = numpy.nan
+        return rows, separations
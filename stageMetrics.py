@@ -0,0 +1,103 @@
+import atexit, json, os, sys, threading, time
+
+# Wall time, call counts, rows and bytes for each stage of a run: name
+# resolution ('resolve'), the SIMBAD, VizieR and TAP requests ('simbad',
+# 'vizier', 'tap'), cache reads ('cache'), reading local tables ('load',
+# 'ingest'), building the output table ('table'), cross-matching
+# ('crossmatch'), derived columns ('derived'), writing files ('export') and
+# plotting ('render'). Stages run from several threads are summed, and stages
+# may nest, so their times can add up to more than the wall time of the run.
+# Nothing is recorded unless --metrics or --profile is given (see
+# metricsFromArguments()), and then 'recorder' holds the totals.
+# Bytes are those received from a --service stand-in server, read from the
+# query cache or local tables, and the size of the files written.
+
+recorder = None
+
+class stageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.created = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.start = time.perf_counter()
+
+    def add(self, name, seconds = 0., rows = 0, bytes = 0, calls = 0):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {'calls': 0, 'seconds': 0., 'rows': 0, 'bytes': 0}
+            totals = self.stages[name]
+            totals['calls']+= calls
+            totals['seconds']+= seconds
+            totals['rows']+= int(rows)
+            totals['bytes']+= int(bytes)
+
+    def summary(self):
+        with self.lock:
+            stages = {name: dict(totals) for name, totals in self.stages.items()}
+        return {'created': self.created, 'command': ' '.join(sys.argv), 'wallSeconds': time.perf_counter() - self.start, 'stages': stages}
+
+    def write(self, filename):
+        summary = self.summary()
+        if filename == '-':
+            json.dump(summary, sys.stdout, indent=1)
+            print()
+            return
+        with open(filename, 'wt') as outputFile:
+            json.dump(summary, outputFile, indent=1)
+
+
+class stage:
+    # Times a 'with' block as one call of the named stage. The block can set
+    # the 'rows' and 'bytes' it handled in the dict returned on entry.
+    def __init__(self, name, rows = 0, bytes = 0):
+        self.name = name
+        self.counts = {'rows': rows, 'bytes': bytes}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.counts
+
+    def __exit__(self, *exception):
+        if recorder is not None:
+            recorder.add(self.name, time.perf_counter() - self.start, self.counts['rows'], self.counts['bytes'], calls = 1)
+        return False
+
+def count(name, rows = 0, bytes = 0):
+    # Adds rows or bytes to a stage without counting a call.
+    if recorder is not None:
+        recorder.add(name, rows = rows, bytes = bytes)
+
+def countFile(name, filename):
+    if recorder is not None and os.path.exists(filename):
+        recorder.add(name, bytes = os.path.getsize(filename))
+
+def tableRows(tables):
+    # Rows in a table or a list of tables, as returned by the services.
+    if tables is None: return 0
+    if isinstance(tables, (list, tuple)): return sum(len(table) for table in tables if table is not None)
+    return len(tables)
+
+
+def addMetricsArguments(parser):
+    parser.add_argument('--metrics', type=str, help="Write the time, rows and bytes of each stage of the run to this JSON file ('-' for the terminal).")
+    parser.add_argument('--profile', type=str, help='Write cProfile statistics of the main thread to this file (read them with python -m pstats).')
+
+def metricsFromArguments(arg):
+    # Starts recording (and profiling) when asked to; the results are written
+    # when the script exits, however it exits.
+    global recorder
+    if arg.metrics is None and arg.profile is None: return None
+    recorder = stageMetrics()
+    profiler = None
+    if arg.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(arg.profile)
+        if arg.metrics is not None:
+            recorder.write(arg.metrics)
+    atexit.register(finish)
+    return recorder
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import json, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import backends
+import stageMetrics
+
+# A local HTTP stand-in for SIMBAD, VizieR and the Gaia TAP service, spoken
+# to by backends.httpBackend (the --service option of the scripts). It
+# replays responses saved with --record and answers the rest from local data
+# (see backends.localBackend). Every request can be delayed and a fraction of
+# them failed, and the number handled at once capped, so that the caching,
+# retries and concurrency limits of the scripts can be exercised offline.
+# GET /stats returns the request counts and the highest concurrency seen.
+
+class standInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, backend, latency = 0., jitter = 0., failRate = 0., maxConcurrent = None, seed = None):
+        ThreadingHTTPServer.__init__(self, address, standInHandler)
+        self.backend = backend
+        self.latency = latency
+        self.jitter = jitter
+        self.failRate = failRate
+        self.maxConcurrent = maxConcurrent
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.stats = {'requests': {}, 'failed': 0, 'rejected': 0, 'errors': 0, 'maxActive': 0}
+
+    def getURL(self):
+        return 'http://%s:%d'%self.server_address[:2]
+
+    def start(self):
+        # Serves from a background thread, for use within tests and benchmarks.
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def enter(self, name):
+        # Returns the HTTP status to fail the request with, or None to serve it.
+        with self.lock:
+            self.stats['requests'][name] = self.stats['requests'].get(name, 0) + 1
+            if self.maxConcurrent is not None and self.active >= self.maxConcurrent:
+                self.stats['rejected']+= 1
+                return 429
+            self.active+= 1
+            self.stats['maxActive'] = max(self.stats['maxActive'], self.active)
+            delay = self.latency + self.jitter * self.random.random()
+            fail = self.random.random() < self.failRate
+            if fail: self.stats['failed']+= 1
+        time.sleep(delay)
+        if fail:
+            self.leave()
+            return 503
+        return None
+
+    def leave(self):
+        with self.lock:
+            self.active-= 1
+
+
+class standInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, contentType = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            with self.server.lock:
+                body = json.dumps(self.server.stats).encode('utf-8')
+            return self.reply(200, body)
+        self.reply(404, b'"Not found"')
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if len(parts) != 2:
+            return self.reply(404, b'"Not found"')
+        status = self.server.enter('.'.join(parts))
+        if status is not None:
+            return self.reply(status, json.dumps("Injected failure" if status == 503 else "Too many requests").encode('utf-8'))
+        try:
+            with stageMetrics.stage(parts[0]) as counts:
+                result = self.server.backend.call(parts[0], parts[1], params)
+                if isinstance(result, list): counts['rows'] = stageMetrics.tableRows(result)
+            if isinstance(result, list) and len(result) > 0:
+                self.reply(200, backends.writeTables(result), 'application/x-votable+xml')
+            else:
+                self.reply(200, json.dumps(result).encode('utf-8'))
+        except LookupError as e:
+            self.reply(404, json.dumps(str(e)).encode('utf-8'))
+        except ValueError as e:
+            self.reply(400, json.dumps(str(e)).encode('utf-8'))
+        except Exception as e:
+            with self.server.lock:
+                self.server.stats['errors']+= 1
+            self.reply(500, json.dumps(str(e)).encode('utf-8'))
+        finally:
+            self.server.leave()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serves recorded or local SIMBAD, VizieR and GAIA TAP responses for offline testing.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default=8765).')
+    parser.add_argument('--host', type=str, default='localhost', help='Address to listen on (default=localhost).')
+    parser.add_argument('--recordings', type=str, help='Directory of responses saved with --record.')
+    parser.add_argument('--local', type=str, help='Tile store or FITS table to answer VizieR and TAP requests that were not recorded.')
+    parser.add_argument('--names', type=str, help='Table of object names with ra and dec columns (degrees) to answer SIMBAD requests.')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds added to every request (default=0).')
+    parser.add_argument('--jitter', type=float, default=0., help='Up to this many random seconds added to every request (default=0).')
+    parser.add_argument('--failrate', type=float, default=0., help='Fraction of requests to fail with HTTP 503 (default=0).')
+    parser.add_argument('--maxconcurrent', type=int, help='Reject requests with HTTP 429 beyond this many at once.')
+    parser.add_argument('--jobtime', type=float, default=0., help='Seconds before an asynchronous TAP job completes (default=0).')
+    parser.add_argument('--seed', type=int, help='Seed for the latency and failure injection.')
+    stageMetrics.addMetricsArguments(parser)
+    arg = parser.parse_args()
+    stageMetrics.metricsFromArguments(arg)
+
+    source = None
+    if arg.local is not None or arg.names is not None:
+        source = backends.localBackend(arg.local, arg.names)
+    if arg.recordings is not None:
+        source = backends.replayBackend(arg.recordings, source)
+    if source is None:
+        parser.error("Give --recordings and/or --local or --names to answer requests from")
+    source.jobTime = arg.jobtime
+    server = standInServer((arg.host, arg.port), source, arg.latency, arg.jitter, arg.failrate, arg.maxconcurrent, arg.seed)
+    print("Serving on %s"%server.getURL())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,89 @@
+import csv, os, tempfile
+from contextlib import contextmanager
+import numpy
+import stageMetrics
+
+# Writers for tables held as an ordered dict of column name -> (masked) array.
+# The output format follows the file extension and every file is written to
+# a temporary name in the same directory and renamed into place when complete,
+# so a crashed or interrupted export never leaves a half-written table behind.
+
+binaryFormats = {'.fits': 'fits', '.fit': 'fits', '.parquet': 'parquet', '.h5': 'hdf5', '.hdf5': 'hdf5'}
+csvFormats = {'.csv': ',', '.txt': '\t', '.tsv': '\t'}
+blockSize = 100000
+
+def defaultMode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+@contextmanager
+def atomicOutput(filename):
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, tempName = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+    os.close(handle)
+    try:
+        yield tempName
+        os.chmod(tempName, defaultMode())
+        os.replace(tempName, filename)
+    except BaseException:
+        if os.path.exists(tempName): os.remove(tempName)
+        raise
+
+def formatColumn(values):
+    # Masked entries are written as '--', which is what str() gives for them
+    # and what the readers of these files expect as a missing value.
+    strings = numpy.asarray(numpy.ma.getdata(values)).astype(str)
+    mask = numpy.ma.getmaskarray(values)
+    if mask.any():
+        strings = strings.astype(object)
+        strings[mask] = '--'
+    return strings.tolist()
+
+def writeDelimited(outputFile, columns, delimiter=','):
+    writer = csv.writer(outputFile, delimiter=delimiter, lineterminator='\n')
+    writer.writerow(list(columns.keys()))
+    arrays = list(columns.values())
+    length = len(arrays[0]) if len(arrays) > 0 else 0
+    for start in range(0, length, blockSize):
+        block = [formatColumn(array[start:start + blockSize]) for array in arrays]
+        writer.writerows(zip(*block))
+
+def columnLength(columns):
+    return len(next(iter(columns.values()))) if len(columns) > 0 else 0
+
+def writeCSV(filename, columns, delimiter=','):
+    with stageMetrics.stage('export', rows = columnLength(columns)) as counts:
+        with atomicOutput(filename) as tempName:
+            with open(tempName, 'wt', newline='', buffering=1024**2) as outputFile:
+                writeDelimited(outputFile, columns, delimiter)
+        counts['bytes'] = os.path.getsize(filename)
+
+def toAstropyTable(columns):
+    from astropy.table import Table, MaskedColumn
+    table = Table()
+    for name, values in columns.items():
+        if numpy.ma.is_masked(values):
+            table[name] = MaskedColumn(numpy.ma.getdata(values), mask=numpy.ma.getmaskarray(values))
+        else:
+            table[name] = numpy.ma.getdata(values)
+    return table
+
+def writeBinary(filename, columns, format):
+    with stageMetrics.stage('export', rows = columnLength(columns)) as counts:
+        table = toAstropyTable(columns)
+        with atomicOutput(filename) as tempName:
+            if format == 'hdf5':
+                table.write(tempName, format='hdf5', path='data', serialize_meta=True, overwrite=True)
+            else:
+                table.write(tempName, format=format, overwrite=True)
+        counts['bytes'] = os.path.getsize(filename)
+
+def writeTable(filename, columns):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in binaryFormats:
+        writeBinary(filename, columns, binaryFormats[extension])
+    elif extension in csvFormats:
+        writeCSV(filename, columns, csvFormats[extension])
+    else:
+        raise ValueError("Unknown output format for %s (expected one of: %s)"%(filename, ', '.join(sorted(list(binaryFormats) + list(csvFormats)))))
@@ -0,0 +1,32 @@
+import io, urllib.error
+import pytest
+import batchResolver
+
+def failing(error):
+    calls = []
+    def function():
+        calls.append(1)
+        raise error
+    return function, calls
+
+def httpError(code):
+    return urllib.error.HTTPError('http://localhost/tap/launch_job', code, 'error', {}, io.BytesIO(b''))
+
+@pytest.mark.parametrize('error, attempts', [
+    (httpError(400), 1), (httpError(403), 1), (httpError(429), 3), (httpError(503), 3),
+    (ConnectionResetError(), 3), (TimeoutError(), 3), (ValueError(), 1),
+])
+def test_retries(error, attempts):
+    resolver = batchResolver.batchResolver(1, retries = 2, backoff = 0.)
+    function, calls = failing(error)
+    with pytest.raises(type(error)):
+        resolver.call('tap', function)
+    assert len(calls) == attempts
+
+def test_map_order():
+    def function(item):
+        if item == 2: raise LookupError(item)
+        return item * 10
+    results = list(batchResolver.batchResolver(3).map(function, range(5)))
+    assert [result for result, error in results] == [0, 10, None, 30, 40]
+    assert isinstance(results[2][1], LookupError)
@@ -0,0 +1,78 @@
+import re
+import numpy
+import pytest
+from astropy.table import Table
+import bulkMatch
+import crossMatch
+import gaiaClass
+
+class fakeJob:
+    def __init__(self, results):
+        self.results = results
+
+    def get_results(self):
+        return self.results
+
+class fakeTap:
+    # Answers the upload join of bulkMatch.uploadQuery from an in-memory
+    # gaia_source table, with the archive's column names.
+    def __init__(self, sources):
+        self.sources = sources
+        self.uploads = 0
+
+    def launch_job_async(self, query, upload_resource = None, upload_table_name = None):
+        self.uploads+= 1
+        assert upload_table_name == 'targets'
+        radius = float(re.search(r"CIRCLE\('ICRS', t\.ra, t\.dec, ([0-9.eE+-]+)\)", query).group(1))
+        targets = Table.read(upload_resource, format='votable')
+        parts = []
+        for target in targets:
+            separation = crossMatch.angularSeparation(target['ra'], target['dec'], numpy.asarray(self.sources['ra']), numpy.asarray(self.sources['dec'])) / 3600.
+            inside = separation <= radius
+            part = self.sources[inside]
+            part.add_column(numpy.full(len(part), target['target_id']), name='target_id', index=0)
+            part.add_column(separation[inside], name='separation', index=1)
+            parts.append(part)
+        from astropy.table import vstack
+        return fakeJob(vstack(parts))
+
+@pytest.fixture
+def sources():
+    rng = numpy.random.default_rng(5)
+    n = 400
+    return Table({
+        'source_id': numpy.arange(n, dtype=numpy.int64) * 1000,
+        'designation': numpy.array(['Gaia DR2 %d'%(i * 1000) for i in range(n)]),
+        'ra': rng.uniform(10, 11, n),
+        'dec': rng.uniform(-1, 0, n),
+        'parallax': rng.uniform(0, 5, n),
+        'parallax_error': rng.uniform(0.01, 0.5, n),
+        'pmra': rng.normal(0, 5, n),
+        'pmdec': rng.normal(0, 5, n),
+        'phot_g_mean_mag': rng.uniform(8, 20, n),
+    })
+
+def test_tapUploadMatch(sources):
+    names = ['A', 'B', 'far']
+    RAs = numpy.array([sources['ra'][3], sources['ra'][77] + 0.5 / 3600., 200.])
+    DECs = numpy.array([sources['dec'][3], sources['dec'][77], 50.])
+    tap = fakeTap(sources)
+    matches, unmatched = bulkMatch.tapUploadMatch(names, RAs, DECs, 5., tap)
+    assert tap.uploads == 1
+    assert unmatched == ['far']
+    assert list(matches['Name']) == ['A', 'B']
+    assert list(matches['Source']) == [3000, 77000]
+    for column in ['DR2Name', 'RA_ICRS', 'DE_ICRS', 'Plx', 'e_Plx', 'pmRA', 'pmDE', 'Gmag', 'RAJ2000', 'DEJ2000']:
+        assert column in matches.colnames
+
+def test_tapUploadMatch_rows_fit_vizier_columns(sources):
+    # The rows go into a gaiaTABLE selected with VizieR column names, as in
+    # pullGAIATable.py --bulk tap.
+    columns = ['Source', 'RAJ2000', 'DEJ2000', 'Plx']
+    matches, unmatched = bulkMatch.tapUploadMatch(['A'], [sources['ra'][10]], [sources['dec'][10]], 2., fakeTap(sources))
+    table = gaiaClass.gaiaTABLE()
+    table.setColumns(columns)
+    for row in matches:
+        table.addItem(str(row['Name']), matches.keys(), row)
+    assert table.getLength() == 1
+    assert table.getColumn('Plx')[0] == pytest.approx(sources['parallax'][10])
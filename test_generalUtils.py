@@ -0,0 +1,68 @@
+import numpy
+import pytest
+import generalUtils
+
+def parse(ra, dec):
+    ra, dec, bad = generalUtils.parseSexagesimal([ra], [dec])
+    return float(ra[0]), float(dec[0]), bool(bad[0])
+
+@pytest.mark.parametrize('raText, decText, ra, dec', [
+    ('12 30 00', '+45 30 00', 187.5, 45.5),
+    ('12 30 00', '-45 30 00', 187.5, -45.5),
+    ('00 00 00', '+00 00 00', 0., 0.),
+    ('23 59 59.99', '+89 59 59.9', 359.9999583, 89.9999722),
+    ('12:30:00.5', '-00 30 00', 187.5020833, -0.5),
+    ('12h30m00s', '+45d30m00s', 187.5, 45.5),
+    ('12 30', '-45', 187.5, -45.),
+    ('  12 30 00  ', '45 30', 187.5, 45.5),
+    ('12 30 00', '+90', 187.5, 90.),
+])
+def test_valid(raText, decText, ra, dec):
+    values = parse(raText, decText)
+    assert not values[2]
+    assert values[0] == pytest.approx(ra, abs=1e-6)
+    assert values[1] == pytest.approx(dec, abs=1e-6)
+
+def test_negative_zero_degrees():
+    # The sign applies to the minutes and seconds even with zero degrees.
+    assert parse('00 00 00', '-00 00 36')[1] == pytest.approx(-0.01)
+
+@pytest.mark.parametrize('raText, decText', [
+    ('', '+45 30 00'),
+    ('12 30 00', ''),
+    ('12 30 00', '+'),
+    ('12  ', '-'),
+    ('-12 30 00', '+45 30 00'),
+    ('+12 30 00', '+45 30 00'),
+    ('12 30 00', '+-45 30 00'),
+    ('12 30 00', '45 -30 00'),
+    ('12 30 00', '+45 30 00 10'),
+    ('12 30 0x', '+45 30 00'),
+    ('12 30 00', '+45 30 00.1.2'),
+    ('12 60 00', '+45 30 00'),
+    ('12 30 60', '+45 30 00'),
+    ('12 30 00', '+45 60 00'),
+    ('12 30 00', '+45 30 60'),
+    ('24 00 00', '+45 30 00'),
+    ('12 30 00', '+90 00 01'),
+    ('12 30 00', '-91'),
+])
+def test_malformed(raText, decText):
+    ra, dec, bad = parse(raText, decText)
+    assert bad
+    assert numpy.isnan(ra) and numpy.isnan(dec)
+
+def test_column_mask():
+    ra, dec, bad = generalUtils.parseSexagesimal(['01 00 00', 'x', '02 00 00'], ['+10', '+20', '+95'])
+    assert list(bad) == [False, True, True]
+    assert ra[0] == pytest.approx(15.) and dec[0] == pytest.approx(10.)
+
+def test_masked_input():
+    raStrings = numpy.ma.array(['01 00 00', '02 00 00'], mask=[False, True])
+    ra, dec, bad = generalUtils.parseSexagesimal(raStrings, ['+10', '+20'])
+    assert list(bad) == [False, True]
+
+def test_parseCoords():
+    assert generalUtils.parseCoords('12 30 00', '-45 30 00') == pytest.approx((187.5, -45.5))
+    with pytest.raises(ValueError):
+        generalUtils.parseCoords('12 30 00', '+95 00 00')
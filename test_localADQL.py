@@ -0,0 +1,138 @@
+import numpy
+import pytest
+from astropy.table import Table
+import localADQL
+import tileStore
+
+numRows = 20000
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory):
+    rng = numpy.random.default_rng(3)
+    table = Table({
+        'source_id': numpy.sort(rng.integers(0, 6917528997577384320, numRows)),
+        'ra': rng.uniform(0, 360, numRows),
+        'dec': numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, numRows))),
+        'parallax': rng.normal(2, 3, numRows),
+        'parallax_error': rng.uniform(0.01, 1, numRows),
+        'random_index': rng.permutation(numRows),
+        'phot_g_mean_mag': rng.uniform(5, 20, numRows),
+    })
+    table['parallax'][::50] = numpy.nan
+    filename = str(tmp_path_factory.mktemp('adql') / 'source.fits')
+    table.write(filename)
+    return filename, table
+
+@pytest.fixture(scope='module')
+def store(source, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('adql') / 'store')
+    tileStore.tileStore(directory, create = True).ingest([source[0]])
+    return directory
+
+def separation(ra1, dec1, ra2, dec2):
+    # Degrees, by the haversine formula.
+    ra1, dec1, ra2, dec2 = [numpy.radians(numpy.asarray(x, dtype=numpy.float64)) for x in (ra1, dec1, ra2, dec2)]
+    h = numpy.sin((dec2 - dec1) / 2)**2 + numpy.cos(dec1) * numpy.cos(dec2) * numpy.sin((ra2 - ra1) / 2)**2
+    return numpy.degrees(2 * numpy.arcsin(numpy.sqrt(h)))
+
+def columns(table):
+    return {c: numpy.asarray(table[c]) for c in table.colnames}
+
+def test_where_and_order(source):
+    filename, table = source
+    result = localADQL.executeQuery("SELECT source_id, parallax FROM gaiadr2.gaia_source WHERE parallax > 1 AND phot_g_mean_mag < 12 ORDER BY parallax DESC", defaultSource = filename)
+    t = columns(table)
+    with numpy.errstate(invalid='ignore'):
+        keep = (t['parallax'] > 1) & (t['phot_g_mean_mag'] < 12)
+    order = numpy.argsort(-t['parallax'][keep], kind='stable')
+    assert list(result['source_id']) == list(t['source_id'][keep][order])
+    assert numpy.all(numpy.diff(result['parallax']) <= 0)
+
+def test_top(source):
+    filename, table = source
+    result = localADQL.executeQuery("SELECT TOP 25 source_id, random_index FROM x ORDER BY random_index", defaultSource = filename)
+    t = columns(table)
+    assert list(result['source_id']) == list(t['source_id'][numpy.argsort(t['random_index'])][:25])
+    result = localADQL.executeQuery("SELECT TOP 10 source_id FROM x WHERE dec > 0", defaultSource = filename)
+    assert list(result['source_id']) == list(t['source_id'][t['dec'] > 0][:10])
+
+def test_mod_and_expressions(source):
+    filename, table = source
+    result = localADQL.executeQuery("SELECT source_id, parallax / parallax_error AS poe FROM x WHERE MOD(random_index, 7) = 3 AND parallax > 0", defaultSource = filename)
+    t = columns(table)
+    with numpy.errstate(invalid='ignore'):
+        keep = (t['random_index'] % 7 == 3) & (t['parallax'] > 0)
+    assert list(result['source_id']) == list(t['source_id'][keep])
+    assert numpy.allclose(result['poe'], (t['parallax'] / t['parallax_error'])[keep])
+
+def test_null_and_between(source):
+    filename, table = source
+    t = columns(table)
+    result = localADQL.executeQuery("SELECT source_id FROM x WHERE parallax IS NULL", defaultSource = filename)
+    assert list(result['source_id']) == list(t['source_id'][numpy.isnan(t['parallax'])])
+    result = localADQL.executeQuery("SELECT source_id FROM x WHERE phot_g_mean_mag BETWEEN 10 AND 10.5 OR NOT dec > -80", defaultSource = filename)
+    keep = ((t['phot_g_mean_mag'] >= 10) & (t['phot_g_mean_mag'] <= 10.5)) | ~(t['dec'] > -80)
+    assert list(result['source_id']) == list(t['source_id'][keep])
+
+@pytest.mark.parametrize('useStore', [False, True])
+def test_contains(source, store, useStore):
+    filename, table = source
+    query = "SELECT TOP 40 g.source_id, g.ra, g.dec, parallax / parallax_error AS poe FROM gaiadr2.gaia_source AS g WHERE 1 = CONTAINS(POINT('ICRS', g.ra, g.dec), CIRCLE('ICRS', 120.0, -30.0, 10.0)) AND parallax > 0 ORDER BY poe DESC"
+    result = localADQL.executeQuery(query, defaultSource = store if useStore else filename)
+    t = columns(table)
+    with numpy.errstate(invalid='ignore'):
+        keep = (separation(120., -30., t['ra'], t['dec']) <= 10.) & (t['parallax'] > 0)
+    poe = (t['parallax'] / t['parallax_error'])[keep]
+    order = numpy.argsort(-poe, kind='stable')[:40]
+    assert sorted(result['source_id']) == sorted(t['source_id'][keep][order])
+    assert numpy.allclose(result['poe'], poe[order])
+
+def test_contains_with_sky_index(source, tmp_path):
+    import skyIndex
+    filename, table = source
+    indexed = str(tmp_path / 'indexed.fits')
+    table.write(indexed)
+    skyIndex.skyIndex(table['ra'], table['dec'], source = indexed).save()
+    query = "SELECT source_id FROM x WHERE 1 = CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', 300.0, 45.0, 5.0)) AND MOD(random_index, 2) = 0"
+    result = localADQL.executeQuery(query, defaultSource = indexed)
+    t = columns(table)
+    keep = (separation(300., 45., t['ra'], t['dec']) <= 5.) & (t['random_index'] % 2 == 0)
+    assert list(result['source_id']) == list(t['source_id'][keep])
+
+def test_errors(source):
+    filename, table = source
+    with pytest.raises(localADQL.ADQLError):
+        localADQL.executeQuery("SELECT no_such_column FROM x", defaultSource = filename)
+    with pytest.raises(localADQL.ADQLError):
+        localADQL.executeQuery("SELECT source_id FROM x WHERE", defaultSource = filename)
+
+def test_order_by_position(source):
+    filename, table = source
+    t = columns(table)
+    result = localADQL.executeQuery("SELECT TOP 5 source_id, parallax FROM x WHERE parallax > 0 ORDER BY 2 DESC", defaultSource = filename)
+    with numpy.errstate(invalid='ignore'):
+        keep = t['parallax'] > 0
+    assert list(result['parallax']) == list(numpy.sort(t['parallax'][keep])[::-1][:5])
+    result = localADQL.executeQuery("SELECT TOP 5 source_id, phot_g_mean_mag - 5 FROM x ORDER BY 2", defaultSource = filename)
+    assert numpy.allclose(result['col1'], numpy.sort(t['phot_g_mean_mag'])[:5] - 5)
+    for query in ["SELECT source_id FROM x ORDER BY 2", "SELECT * FROM x ORDER BY 1"]:
+        with pytest.raises(localADQL.ADQLError):
+            localADQL.executeQuery(query, defaultSource = filename)
+
+def test_geometry_without_coordinate_system(source):
+    filename, table = source
+    t = columns(table)
+    result = localADQL.executeQuery("SELECT source_id FROM x WHERE CONTAINS(POINT(ra, dec), CIRCLE(15, 0, 3)) = 1", defaultSource = filename)
+    assert list(result['source_id']) == list(t['source_id'][separation(15., 0., t['ra'], t['dec']) <= 3.])
+    with pytest.raises(localADQL.ADQLError):
+        localADQL.executeQuery("SELECT source_id FROM x WHERE CONTAINS(POINT(ra, dec), CIRCLE(15, 0)) = 1", defaultSource = filename)
+
+@pytest.mark.parametrize('expression, value', [
+    ('-7 / 2', -3), ('7 / 2', 3), ('7 / -2', -3), ('-7 / -2', 3), ('-6 / 2', -3),
+    ('MOD(-7, 3)', -1), ('MOD(7, -3)', 1), ('MOD(7, 3)', 1), ('7.0 / 2', 3.5),
+])
+def test_integer_arithmetic(source, expression, value):
+    # Integer division and MOD round towards zero, as in PostgreSQL.
+    filename, table = source
+    result = localADQL.executeQuery("SELECT TOP 1 source_id, %s AS v FROM x"%expression, defaultSource = filename)
+    assert result['v'][0] == value
@@ -0,0 +1,44 @@
+import os
+from astropy.table import Table
+import queryCache
+
+def fitsBytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory) if f.endswith('.fits'))
+
+def test_shared_directory(tmp_path):
+    # Two runs sharing a cache keep each other's entries.
+    directory = str(tmp_path)
+    first = queryCache.queryCache(directory)
+    second = queryCache.queryCache(directory)
+    first.put('q1', Table({'x': [1]}))
+    second.put('q2', Table({'x': [2]}))
+    first.flush()
+    second.flush()
+    cache = queryCache.queryCache(directory)
+    assert len(cache.index) == 2
+    assert cache.get('q1')['x'][0] == 1
+    assert cache.get('q2')['x'][0] == 2
+    assert cache.totalBytes == fitsBytes(directory)
+
+def test_shared_removal(tmp_path):
+    directory = str(tmp_path)
+    first = queryCache.queryCache(directory)
+    first.put('q1', Table({'x': [1]}))
+    first.put('q2', Table({'x': [2]}))
+    first.flush()
+    second = queryCache.queryCache(directory)
+    second.remove(queryCache.makeKey('q1'))
+    second.flush()
+    first.get('q2')
+    first.flush()
+    cache = queryCache.queryCache(directory)
+    assert cache.get('q1') is None
+    assert cache.get('q2')['x'][0] == 2
+
+def test_putMany(tmp_path):
+    cache = queryCache.queryCache(str(tmp_path))
+    cache.putMany(['a', 'b', 'c'], Table({'x': [1, 2, 3]}))
+    tables = cache.getMany(['c', 'missing', 'a'])
+    assert tables[0]['x'][0] == 3 and tables[1] is None and tables[2]['x'][0] == 1
+    cache.flush()
+    assert queryCache.queryCache(str(tmp_path)).get('b')['x'][0] == 2
@@ -0,0 +1,220 @@
+import json, operator, os, re
+import numpy
+import crossMatch
+import gaiaColumns
+import tableExport
+import stageMetrics
+
+# A local store of Gaia DR2 extracts split into HEALPix tiles. The tile of a
+# source comes straight from its source_id (which encodes the level 12 nested
+# HEALPix index), and every column of a tile is a raw binary file, so a query
+# only opens the tiles whose bounding boxes can hold matches and only reads
+# the columns it needs. manifest.json records the level, column types, the
+# files ingested and the row count and RA/DEC bounding box of every tile. It
+# is rewritten after each file, so rows appended by an interrupted ingest are
+# ignored, and cut off before the next one.
+
+filterOperators = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '=': operator.eq, '==': operator.eq, '!=': operator.ne, '<>': operator.ne}
+
+def parseFilter(text):
+    # "parallax_over_error >= 20" -> ('parallax_over_error', '>=', 20.0)
+    match = re.fullmatch(r'\s*([\w\-\(\)]+?)\s*(<=|>=|==|!=|<>|<|>|=)\s*(\S+)\s*', text)
+    if match is None:
+        raise ValueError("Cannot parse filter: %s"%text)
+    column, op, value = match.groups()
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+    return column, op, value
+
+def healpixFromSourceID(sourceIDs, level):
+    return numpy.asarray(sourceIDs, dtype=numpy.int64) // (2**35 * 4**(12 - level))
+
+def raOverlaps(raMin, raMax, tile):
+    # Does the RA interval raMin..raMax (wrapping through 0 if raMin > raMax) meet the tile's?
+    if raMin <= raMax:
+        return tile['raMax'] >= raMin and tile['raMin'] <= raMax
+    return tile['raMax'] >= raMin or tile['raMin'] <= raMax
+
+
+class tileStore:
+    def __init__(self, directory, create = False):
+        # A store to query must exist already; with create=True, a missing one
+        # is started by the first ingest().
+        self.directory = directory
+        self.manifestFilename = os.path.join(directory, 'manifest.json')
+        try:
+            with open(self.manifestFilename, 'rt') as manifestFile:
+                self.manifest = json.load(manifestFile)
+        except FileNotFoundError:
+            if not create:
+                raise FileNotFoundError("No tile store in %s (%s not found); build one with tileStore.py"%(directory, self.manifestFilename))
+            self.manifest = None
+
+    def writeManifest(self):
+        with tableExport.atomicOutput(self.manifestFilename) as tempName:
+            with open(tempName, 'wt') as manifestFile:
+                json.dump(self.manifest, manifestFile)
+
+    def getColumnNames(self):
+        return list(self.manifest['columns'].keys())
+
+    def getLength(self):
+        return sum(tile['rows'] for tile in self.manifest['tiles'].values())
+
+    def getTileFilename(self, pixel, column):
+        return os.path.join(self.directory, 'tiles', str(pixel), column + '.bin')
+
+    def ingest(self, filenames, level = 5, blockSize = 1000000):
+        # Adds the rows of FITS tables (e.g. from adqlGAIATable.py) to the store.
+        from astropy.io import fits
+        os.makedirs(self.directory, exist_ok=True)
+        if self.manifest is None:
+            self.manifest = {'level': level, 'columns': {}, 'tiles': {}}
+        level = self.manifest['level']
+        sources = self.manifest.setdefault('sources', [])
+        self.truncateTiles()
+        for filename in filenames:
+            if os.path.abspath(filename) in sources:
+                print("Skipping %s, which is already in the store"%filename)
+                continue
+            hdu = fits.open(filename, memmap=True)
+            data = hdu[1].data
+            length = hdu[1].header['NAXIS2']
+            names = [name for name in data.columns.names]
+            if len(self.manifest['columns']) == 0:
+                self.manifest['columns'] = {name: numpy.asarray(data[name][:0]).dtype.newbyteorder('=').str for name in names}
+            elif set(names) != set(self.manifest['columns']):
+                raise ValueError("Columns of %s do not match the store"%filename)
+            for start in range(0, length, blockSize):
+                end = min(start + blockSize, length)
+                pixels = healpixFromSourceID(data['source_id'][start:end], level)
+                order = numpy.argsort(pixels, kind='stable')
+                tilePixels, firsts, counts = numpy.unique(pixels[order], return_index=True, return_counts=True)
+                block = {name: numpy.asarray(data[name][start:end], dtype=self.manifest['columns'][name])[order] for name in names}
+                for pixel, first, count in zip(tilePixels, firsts, counts):
+                    self.appendTile(int(pixel), {name: values[first:first + count] for name, values in block.items()})
+            del data
+            hdu.close()
+            print("Ingested %d rows from %s"%(length, filename))
+            sources.append(os.path.abspath(filename))
+            self.writeManifest()
+
+    def truncateTiles(self):
+        # Cuts the tile files back to the rows in the manifest, dropping any
+        # left by an interrupted ingest.
+        tilesDirectory = os.path.join(self.directory, 'tiles')
+        if not os.path.isdir(tilesDirectory): return
+        for pixel in os.listdir(tilesDirectory):
+            tile = self.manifest['tiles'].get(pixel)
+            for name, dtype in self.manifest['columns'].items():
+                tileFilename = self.getTileFilename(pixel, name)
+                size = (tile['rows'] if tile is not None else 0) * numpy.dtype(dtype).itemsize
+                if os.path.exists(tileFilename) and os.path.getsize(tileFilename) > size:
+                    os.truncate(tileFilename, size)
+
+    def appendTile(self, pixel, columns):
+        os.makedirs(os.path.dirname(self.getTileFilename(pixel, 'x')), exist_ok=True)
+        for name, values in columns.items():
+            with open(self.getTileFilename(pixel, name), 'ab') as tileFile:
+                values.tofile(tileFile)
+        ra = columns['ra']
+        dec = columns['dec']
+        tile = self.manifest['tiles'].setdefault(str(pixel), {'rows': 0, 'raMin': 360., 'raMax': 0., 'decMin': 90., 'decMax': -90.})
+        tile['rows']+= len(ra)
+        tile['raMin'] = min(tile['raMin'], float(numpy.nanmin(ra)))
+        tile['raMax'] = max(tile['raMax'], float(numpy.nanmax(ra)))
+        tile['decMin'] = min(tile['decMin'], float(numpy.nanmin(dec)))
+        tile['decMax'] = max(tile['decMax'], float(numpy.nanmax(dec)))
+
+    def readTileColumn(self, pixel, column):
+        rows = self.manifest['tiles'][str(pixel)]['rows']
+        return numpy.memmap(self.getTileFilename(pixel, column), dtype=self.manifest['columns'][column], mode='r', shape=(rows,))
+
+    def selectTiles(self, cone = None, box = None):
+        pixels = []
+        for pixel, tile in self.manifest['tiles'].items():
+            if cone is not None:
+                ra, dec, radius = cone
+                radiusDeg = radius / 3600.
+                if tile['decMax'] < dec - radiusDeg or tile['decMin'] > dec + radiusDeg: continue
+                if abs(dec) + radiusDeg < 89.:
+                    halfWidth = radiusDeg / numpy.cos(numpy.radians(abs(dec) + radiusDeg))
+                    if halfWidth < 180. and not raOverlaps((ra - halfWidth) % 360., (ra + halfWidth) % 360., tile): continue
+            if box is not None:
+                raMin, raMax, decMin, decMax = box
+                if tile['decMax'] < decMin or tile['decMin'] > decMax: continue
+                if not raOverlaps(raMin % 360., raMax % 360., tile): continue
+            pixels.append(pixel)
+        return sorted(pixels, key=int)
+
+    def query(self, columns = None, cone = None, box = None, filters = [], limit = None, vizier = False):
+        # Rows matching every condition: a cone (ra, dec, radius in arcsec), a box
+        # (raMin, raMax, decMin, decMax in degrees, wrapping if raMin > raMax) and
+        # column filters given as strings ("e_Plx < 0.1") or (column, op, value).
+        # With vizier=True, columns and filters may use VizieR names and the
+        # result comes back with VizieR names and RAJ2000/DEJ2000 added.
+        from astropy.table import Table
+        filters = [parseFilter(f) if isinstance(f, str) else f for f in filters]
+        if vizier:
+            filters = [(gaiaColumns.toArchiveName(c), op, value) for c, op, value in filters]
+            if columns is not None: columns = [gaiaColumns.toArchiveName(c) for c in columns if c not in ('RAJ2000', 'DEJ2000')]
+        if columns is None: columns = self.getColumnNames()
+        if vizier: columns = columns + [c for c in ['ra', 'dec', 'pmra', 'pmdec'] if c not in columns and c in self.manifest['columns']]
+        for c in list(columns) + [f[0] for f in filters]:
+            if c not in self.manifest['columns']:
+                raise KeyError("Column %s is not in the store"%c)
+        parts = {c: [] for c in columns}
+        found = 0
+        for pixel in self.selectTiles(cone, box):
+            keep = numpy.ones(self.manifest['tiles'][pixel]['rows'], dtype=bool)
+            if cone is not None or box is not None:
+                ra = self.readTileColumn(pixel, 'ra')
+                dec = self.readTileColumn(pixel, 'dec')
+                if cone is not None:
+                    keep&= crossMatch.angularSeparation(cone[0], cone[1], ra, dec) <= cone[2]
+                if box is not None:
+                    raMin, raMax, decMin, decMax = box
+                    keep&= (dec >= decMin) & (dec <= decMax) & (((ra - raMin) % 360.) <= ((raMax - raMin) % 360.))
+            for column, op, value in filters:
+                with numpy.errstate(invalid='ignore'):
+                    keep&= filterOperators[op](self.readTileColumn(pixel, column), value)
+            rows = numpy.nonzero(keep)[0]
+            if limit is not None: rows = rows[:limit - found]
+            for c in columns:
+                values = numpy.array(self.readTileColumn(pixel, c)[rows])
+                if values.dtype.kind == 'S': values = numpy.char.decode(values, 'ascii')
+                parts[c].append(values)
+            found+= len(rows)
+            if limit is not None and found >= limit: break
+        table = Table({c: numpy.concatenate(parts[c]) if len(parts[c]) > 0 else numpy.empty(0, dtype=self.manifest['columns'][c].replace('S', 'U')) for c in columns})
+        if vizier: gaiaColumns.toVizierTable(table)
+        return table
+
+    def cone(self, ra, dec, radius, columns = None, filters = [], vizier = False):
+        table = self.query(columns, cone = (ra, dec, radius), filters = filters, vizier = vizier)
+        raKey, decKey = ('RA_ICRS', 'DE_ICRS') if vizier else ('ra', 'dec')
+        table['_r'] = crossMatch.angularSeparation(ra, dec, numpy.asarray(table[raKey]), numpy.asarray(table[decKey]))
+        table.sort('_r')
+        return table
+
+    def box(self, raMin, raMax, decMin, decMax, columns = None, filters = [], vizier = False):
+        return self.query(columns, box = (raMin, raMax, decMin, decMax), filters = filters, vizier = vizier)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds a local HEALPix tiled store from saved GAIA FITS tables.')
+    parser.add_argument('store', type=str, help='Directory of the tile store.')
+    parser.add_argument('sources', type=str, nargs='*', help='FITS tables of GAIA data to ingest.')
+    parser.add_argument('--level', type=int, default=5, help='HEALPix level of the tiles (default=5).')
+    stageMetrics.addMetricsArguments(parser)
+    arg = parser.parse_args()
+    stageMetrics.metricsFromArguments(arg)
+
+    store = tileStore(arg.store, create = True)
+    with stageMetrics.stage('ingest') as counts:
+        store.ingest(arg.sources, level = arg.level)
+        counts['rows'] = store.getLength()
+    print("%d rows in %d tiles of %s"%(store.getLength(), len(store.manifest['tiles']), arg.store))